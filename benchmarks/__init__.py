@@ -0,0 +1,8 @@
+"""
+Benchmarks for epubhv, run them from the repo root like:
+
+    python -m benchmarks.bench_parser
+
+`python -m benchmarks` times every mode on a synthetic book and compares the
+results with a baseline, see `benchmarks/__main__.py`.
+"""
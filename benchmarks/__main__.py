@@ -0,0 +1,178 @@
+"""
+Time every mode of epubhv on a synthetic book, stage by stage.
+
+    python -m benchmarks [--chapters N] [--chapter-chars N] [--language ja]
+        [--assets N] [--no-css] [--mode ruby ...] [--repeat N]
+        [--output results.json] [--baseline baseline.json] [--threshold 1.2]
+
+The best of `--repeat` runs of each mode is kept, with the wall time of its
+stages from `epubhv.stats`. The results are written as JSON, and compared
+with `--baseline` (the results of an older run on the same book), every
+mode or stage slower than `--threshold` times the baseline is a regression
+and the exit status is 1. The backends are loaded before the runs, so they
+are not in the times.
+"""
+
+import json
+import os
+import platform
+import sys
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.synthetic import CORPORA, BookSpec, make_epub
+from epubhv.cache import library_version
+from epubhv.epubhv import EPUBHV, PARSERS, warmup
+from epubhv.stats import Stats
+
+# method and the `EPUBHV` options of every mode, like the CLI flags
+MODES: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    "vertical": ("to_vertical", {}),
+    "horizontal": ("to_horizontal", {}),
+    "convert": ("to_vertical", {}),
+    "ruby": ("to_vertical", {"need_ruby": True}),
+    "ruby-block": ("to_vertical", {"need_ruby": True, "ruby_scope": "block"}),
+    "cantonese": ("to_vertical", {"need_ruby": True, "need_cantonese": True}),
+}
+# `--convert` of the convert mode for each language, OpenCC has no config
+# for Japanese that is shipped, so there is no convert mode for ja
+CONVERSIONS: Dict[str, str] = {"zh-hans": "s2t", "zh-hant": "t2s"}
+
+
+def run_mode(
+    epub: Path, mode: str, repeat: int, dest: Path, options: Dict[str, Any]
+) -> Dict[str, Any]:
+    method, mode_options = MODES[mode]
+    best: Dict[str, Any] = {}
+    runs: List[float] = []
+    for _ in range(repeat):
+        stats: Stats = Stats()
+        EPUBHV(epub, stats=stats, **mode_options, **options).run(method, dest=dest)
+        wall: float = sum(t.wall for t in stats.stages.values())
+        runs.append(wall)
+        if wall <= min(runs):
+            best = {
+                "wall": wall,
+                "stages": {name: t.wall for name, t in stats.stages.items()},
+                "max_rss": stats.max_rss,
+                "counters": dict(stats.counters),
+            }
+    return {**best, "runs": runs}
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], threshold: float
+) -> List[str]:
+    """
+    print the ratios to the baseline, return the regressions
+    """
+    regressions: List[str] = []
+    for mode, result in results["modes"].items():
+        old: Dict[str, Any] = baseline["modes"].get(mode, {})
+        if not old:
+            continue
+        times: List[Tuple[str, float, float]] = [(mode, old["wall"], result["wall"])]
+        times += [
+            (f"{mode}.{stage}", old["stages"][stage], wall)
+            for stage, wall in result["stages"].items()
+            if stage in old["stages"]
+        ]
+        for name, old_wall, new_wall in times:
+            ratio: float = new_wall / old_wall if old_wall > 0 else 1.0
+            # the tiny stages are all noise
+            regressed: bool = ratio > threshold and new_wall - old_wall > 0.01
+            if regressed:
+                regressions.append(name)
+            print(
+                f"{name:<24} {old_wall * 1000:>10.1f}ms -> {new_wall * 1000:>10.1f}ms"
+                f" {ratio:>6.2f}x{'  REGRESSION' if regressed else ''}"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--chapters", default=20, type=int)
+    parser.add_argument("--chapter-chars", default=5000, type=int)
+    parser.add_argument("--language", default="zh-hans", choices=CORPORA)
+    parser.add_argument("--assets", default=10, type=int)
+    parser.add_argument("--asset-kb", default=100, type=int)
+    parser.add_argument("--no-css", dest="css", action="store_false")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--mode", nargs="*", default=list(MODES), choices=MODES)
+    parser.add_argument("--parser", default="html.parser", choices=PARSERS)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--output", default="benchmark-results.json", type=Path)
+    parser.add_argument("--baseline", default=None, type=Path)
+    parser.add_argument("--threshold", default=1.2, type=float)
+    options = parser.parse_args()
+
+    spec: BookSpec = BookSpec(
+        chapters=options.chapters,
+        chapter_chars=options.chapter_chars,
+        language=options.language,
+        css=options.css,
+        assets=options.assets,
+        asset_kb=options.asset_kb,
+        seed=options.seed,
+    )
+    epub_options: Dict[str, Any] = dict(
+        parser=options.parser, streaming=options.streaming
+    )
+    results: Dict[str, Any] = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "epubhv": library_version(),
+        },
+        "book": spec._asdict(),
+        "options": epub_options,
+        "modes": {},
+    }
+    modes: List[str] = options.mode
+    if "convert" in modes and spec.language not in CONVERSIONS:
+        print(f"no convert mode for {spec.language}")
+        modes = [mode for mode in modes if mode != "convert"]
+    warmup(conversions=[CONVERSIONS[spec.language]] if "convert" in modes else [])
+
+    with tempfile.TemporaryDirectory(prefix="epubhv-benchmark-") as tmpdir:
+        epub: Path = make_epub(spec, Path(tmpdir) / "synthetic.epub")
+        results["book"]["bytes"] = epub.stat().st_size
+        print(
+            f"{spec.chapters} chapters of {spec.chapter_chars} {spec.language} chars,"
+            f" {spec.assets} assets, {epub.stat().st_size >> 10}KB"
+        )
+        for mode in modes:
+            mode_options: Dict[str, Any] = dict(epub_options)
+            if mode == "convert":
+                mode_options["convert_to"] = CONVERSIONS[spec.language]
+            result: Dict[str, Any] = run_mode(
+                epub, mode, options.repeat, Path(tmpdir), mode_options
+            )
+            results["modes"][mode] = result
+            stages: str = " ".join(
+                f"{name}={wall * 1000:.0f}ms" for name, wall in result["stages"].items()
+            )
+            print(f"{mode:<10} {result['wall'] * 1000:>10.1f}ms  {stages}")
+
+    options.output.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f"results are written to {options.output}")
+
+    if options.baseline is not None:
+        baseline: Dict[str, Any] = json.loads(options.baseline.read_text())
+        if (baseline["book"], baseline["options"]) != (
+            results["book"],
+            results["options"],
+        ):
+            sys.exit(f"{options.baseline} is not from the same book and options")
+        regressions: List[str] = compare(results, baseline, options.threshold)
+        if regressions:
+            sys.exit(f"{len(regressions)} regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
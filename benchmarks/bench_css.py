@@ -0,0 +1,78 @@
+"""
+The tokenizer of `epubhv.stylesheet` against a full cssutils parse, adding
+and removing the writing mode of the stylesheets of the test books, and of
+big stylesheets made of all of them repeated, like the ones of some
+publishers.
+
+    python -m benchmarks.bench_css [--repeat N] [--size KB ...]
+
+cssutils takes about a minute for `--size 500`.
+"""
+
+import time
+import zipfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from epubhv.stylesheet import (
+    add_vertical,
+    cssutils_add_vertical,
+    cssutils_remove_writing_mode,
+    remove_writing_mode,
+)
+
+TEST_DIR = Path(__file__).parent.parent / "tests" / "test_epub"
+
+CASES: List[
+    Tuple[str, Callable[[str], Optional[str]], Callable[[bytes], Optional[bytes]]]
+] = [
+    ("vertical", add_vertical, cssutils_add_vertical),
+    ("horizontal", remove_writing_mode, cssutils_remove_writing_mode),
+]
+
+
+def read_stylesheets() -> List[bytes]:
+    stylesheets: List[bytes] = []
+    for epub in sorted(TEST_DIR.glob("**/*.epub")):
+        with zipfile.ZipFile(epub) as f:
+            stylesheets += [f.read(n) for n in f.namelist() if n.endswith(".css")]
+    return stylesheets
+
+
+def best_of(repeat: int, func: Callable[[], object]) -> float:
+    best: float = float("inf")
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--size", nargs="*", default=[100], type=int)
+    options = parser.parse_args()
+
+    stylesheets: List[bytes] = read_stylesheets()
+    one: bytes = b"\n".join(s.replace(b"\xef\xbb\xbf", b"") for s in stylesheets)
+    inputs: List[Tuple[str, List[bytes]]] = [
+        (f"{len(stylesheets)} test stylesheets", stylesheets)
+    ]
+    for size in options.size:
+        inputs.append((f"{size}KB", [one * (size * 1024 // len(one) + 1)]))
+
+    for name, data in inputs:
+        texts: List[str] = [d.decode("utf-8") for d in data]
+        for case, fast, slow in CASES:
+            old: float = best_of(options.repeat, lambda: [slow(d) for d in data])
+            new: float = best_of(options.repeat, lambda: [fast(t) for t in texts])
+            print(
+                f"{name:<20} {case:<10} cssutils: {old * 1000:>8.1f}ms"
+                f"  tokenizer: {new * 1000:>7.1f}ms {old / new:>6.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+The startup time of a fresh interpreter: importing epubhv, and warming up
+each language backend.
+
+    python -m benchmarks.bench_import [--repeat N]
+"""
+
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict
+
+ROOT = Path(__file__).parent.parent
+
+CASES: Dict[str, str] = {
+    "python": "pass",
+    "import epubhv": "import epubhv.epubhv",
+    "warmup ja": "from epubhv import warmup; warmup(['ja'], detect=False)",
+    "warmup zh": "from epubhv import warmup; warmup(['zh'], detect=False)",
+    "warmup cantonese": (
+        "from epubhv import warmup; warmup(['cantonese'], detect=False)"
+    ),
+    "warmup s2t": "from epubhv import warmup; warmup([], ['s2t'], detect=False)",
+    "warmup langdetect": "from epubhv import warmup; warmup([])",
+    "warmup all": "from epubhv import warmup; warmup()",
+}
+
+# the modules which should only be imported on first use
+LAZY_MODULES = (
+    "fugashi",
+    "jieba",
+    "pypinyin",
+    "ToJyutping",
+    "langdetect",
+    "cssutils",
+)
+
+
+def best_of(repeat: int, code: str) -> float:
+    best: float = float("inf")
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", default=5, type=int)
+    options = parser.parse_args()
+
+    loaded: str = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, epubhv.epubhv; "
+            f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+        ],
+        check=True,
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    print(f"loaded by import epubhv: {loaded or 'none'}")
+    for name, code in CASES.items():
+        print(f"{name:<18} {best_of(options.repeat, code) * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+The opencc-python-reimplemented `OpenCC` against the compiled converter of
+`epubhv.opencc_engine`, one call per text node, and one call per document
+with `batch_convert`, for each conversion config.
+
+    python -m benchmarks.bench_opencc [--repeat N] [--config s2t ...]
+
+The configs that start with `t`, `tw` or `hk` read the text converted by
+`s2t` first, so they have something to do.
+"""
+
+import time
+import zipfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Callable, List, Union
+
+import opencc
+from bs4 import BeautifulSoup as bs
+
+from epubhv.epubhv import batch_convert, load_converter
+from epubhv.opencc_engine import CompiledOpenCC, compile_config
+
+TEST_DIR = Path(__file__).parent.parent / "tests" / "test_epub"
+
+Converter = Union[opencc.OpenCC, CompiledOpenCC]
+
+CONFIGS: List[str] = [
+    "s2t",
+    "s2tw",
+    "s2twp",
+    "s2hk",
+    "t2s",
+    "t2tw",
+    "t2hk",
+    "tw2s",
+    "tw2sp",
+    "hk2s",
+]
+
+
+def read_documents(epub: Path) -> List[List[str]]:
+    """the text nodes of every document, as `convert_soup_text` sees them"""
+    documents: List[List[str]] = []
+    with zipfile.ZipFile(epub) as f:
+        for name in f.namelist():
+            if name.endswith((".html", ".xhtml", ".htm")):
+                soup = bs(f.read(name).decode("utf-8", errors="ignore"), "html.parser")
+                documents.append([str(s) for s in soup.find_all(string=True)])
+    return documents
+
+
+def best_of(
+    repeat: int,
+    func: Callable[[Converter, List[str]], List[str]],
+    converter: Converter,
+    documents: List[List[str]],
+) -> float:
+    best: float = float("inf")
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        for texts in documents:
+            func(converter, texts)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def per_node(converter: Converter, texts: List[str]) -> List[str]:
+    return [converter.convert(text) for text in texts]  # type: ignore
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--config", nargs="*", default=CONFIGS, choices=CONFIGS)
+    options = parser.parse_args()
+
+    simplified: List[List[str]] = read_documents(TEST_DIR / "sanguo.epub")
+    s2t: CompiledOpenCC = load_converter("s2t")
+    traditional: List[List[str]] = [per_node(s2t, texts) for texts in simplified]
+    nodes: int = sum(len(texts) for texts in simplified)
+    print(f"{len(simplified)} documents, {nodes} text nodes")
+
+    for config in options.config:
+        start: float = time.perf_counter()
+        reference: opencc.OpenCC = opencc.OpenCC(config)
+        reference.convert("")
+        load: float = time.perf_counter() - start
+        start = time.perf_counter()
+        compile_config(config)
+        compile: float = time.perf_counter() - start
+        converter: CompiledOpenCC = load_converter(config)
+        documents = traditional if config[0] in "th" else simplified
+        expected = [per_node(reference, texts) for texts in documents]
+        assert expected == [per_node(converter, texts) for texts in documents]
+        assert expected == [batch_convert(converter, texts) for texts in documents]
+        old: float = best_of(options.repeat, per_node, reference, documents)
+        new: float = best_of(options.repeat, per_node, converter, documents)
+        batched: float = best_of(options.repeat, batch_convert, converter, documents)
+        print(
+            f"{config:<6} load: {load * 1000:>6.1f}ms compile: {compile * 1000:>6.1f}ms"
+            f"  OpenCC: {old * 1000:>8.1f}ms"
+            f"  compiled: {new * 1000:>8.1f}ms {old / new:>4.1f}x"
+            f"  batched: {batched * 1000:>8.1f}ms {old / batched:>4.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Per-chapter time of `convert_document` with the BeautifulSoup `html.parser`
+backend and the lxml backend.
+
+    python -m benchmarks.bench_parser [epub ...] [--repeat N]
+"""
+
+import time
+import zipfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from epubhv.epubhv import V_STYLE_LINE, DocumentOptions, convert_document
+
+TEST_DIR = Path(__file__).parent.parent / "tests" / "test_epub"
+
+# (book, options) pairs, the same modes the CLI runs
+CASES: List[Tuple[str, DocumentOptions]] = [
+    ("animal_farm.epub", DocumentOptions(stylesheet_line=V_STYLE_LINE)),
+    ("sanguo.epub", DocumentOptions(convert_to="s2t", punctuation="s2t")),
+    ("books/lemo.epub", DocumentOptions(ruby_language="ja")),
+    ("books/animal.epub", DocumentOptions(ruby_language="cantonese")),
+]
+
+
+def read_chapters(epub: Path) -> List[str]:
+    with zipfile.ZipFile(epub) as f:
+        return [
+            f.read(name).decode("utf-8", errors="ignore")
+            for name in f.namelist()
+            if name.endswith((".html", ".xhtml", ".htm"))
+        ]
+
+
+def time_chapters(chapters: List[str], options: DocumentOptions, repeat: int) -> float:
+    # warm up the converters and the tokenizers first
+    convert_document(chapters[0], options)
+    best: float = float("inf")
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        for chapter in chapters:
+            convert_document(chapter, options)
+        best = min(best, time.perf_counter() - start)
+    return best / len(chapters)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", default=3, type=int)
+    options = parser.parse_args()
+
+    print(f"{'book':<20} {'mode':<12} {'html.parser':>12} {'lxml':>12} {'speedup':>8}")
+    for book, document_options in CASES:
+        chapters: List[str] = read_chapters(TEST_DIR / book)
+        per_chapter: Dict[str, float] = {
+            parser: time_chapters(
+                chapters, document_options._replace(parser=parser), options.repeat
+            )
+            for parser in ("html.parser", "lxml")
+        }
+        mode: str = (
+            document_options.convert_to
+            or document_options.ruby_language
+            or "stylesheet"
+        )
+        print(
+            f"{book:<20} {mode:<12} "
+            f"{per_chapter['html.parser'] * 1000:>10.2f}ms "
+            f"{per_chapter['lxml'] * 1000:>10.2f}ms "
+            f"{per_chapter['html.parser'] / per_chapter['lxml']:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
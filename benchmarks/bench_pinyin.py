@@ -0,0 +1,71 @@
+"""
+`hantei_chinese` for every jieba token against the batched
+`hantei_chinese_text` with the reading table.
+
+    python -m benchmarks.bench_pinyin [--repeat N]
+"""
+
+import time
+import zipfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Callable, List
+
+import jieba
+
+from epubhv.detect import document_text
+from epubhv.yomituki import chinese_reading, hantei_chinese, hantei_chinese_text
+
+TEST_DIR = Path(__file__).parent.parent / "tests" / "test_epub"
+
+
+def read_lines(epub: Path) -> List[str]:
+    with zipfile.ZipFile(epub) as f:
+        texts: List[str] = [
+            document_text(f.read(name).decode("utf-8", errors="ignore"), 0)
+            for name in f.namelist()
+            if name.endswith((".html", ".xhtml", ".htm"))
+        ]
+    return [line for text in texts for line in text.split() if line]
+
+
+def old_path(line: str) -> list:
+    return [hantei_chinese(word) for word in jieba.cut(line)]
+
+
+def best_of(repeat: int, func: Callable[[str], list], lines: List[str]) -> float:
+    best: float = float("inf")
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        for line in lines:
+            func(line)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", default=3, type=int)
+    options = parser.parse_args()
+
+    lines: List[str] = read_lines(TEST_DIR / "sanguo.epub")
+    # load the jieba dictionary first
+    jieba.initialize()
+    assert [old_path(line) for line in lines[:200]] == [
+        hantei_chinese_text(line) for line in lines[:200]
+    ]
+    old: float = best_of(options.repeat, old_path, lines)
+    chinese_reading.cache_clear()
+    # the first round fills the reading table
+    cold: float = best_of(1, hantei_chinese_text, lines)
+    warm: float = best_of(options.repeat, hantei_chinese_text, lines)
+    chars: int = sum(len(line) for line in lines)
+    print(f"{len(lines)} lines, {chars} characters")
+    print(f"hantei_chinese per token:   {old * 1000:>9.1f}ms")
+    print(f"hantei_chinese_text (cold): {cold * 1000:>9.1f}ms {old / cold:>6.1f}x")
+    print(f"hantei_chinese_text (warm): {warm * 1000:>9.1f}ms {old / warm:>6.1f}x")
+    print(f"reading table: {chinese_reading.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Concurrent uploads to the conversion service, against converting every
+upload in its own request thread like `web.py` used to.
+
+    python -m benchmarks.bench_server [--clients N] [--requests N] [--workers N]
+"""
+
+import json
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List
+
+from epubhv.epubhv import EPUBHV
+from epubhv.server import ConversionServer, ConversionService
+
+TEST_DIR = Path(__file__).parent.parent / "tests" / "test_epub"
+
+
+def upload_and_download(url: str, data: bytes) -> None:
+    while True:
+        req = urllib.request.Request(
+            f"{url}/jobs?name=animal_farm.epub&convert_to=s2t", data=data
+        )
+        try:
+            with urllib.request.urlopen(req) as r:
+                job_id: str = json.load(r)["id"]
+            break
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                raise
+            time.sleep(0.05)
+    while True:
+        with urllib.request.urlopen(f"{url}/jobs/{job_id}") as r:
+            status: str = json.load(r)["status"]
+        if status in ("done", "failed"):
+            break
+        time.sleep(0.02)
+    with urllib.request.urlopen(f"{url}/jobs/{job_id}/result") as r:
+        r.read()
+    urllib.request.urlopen(
+        urllib.request.Request(f"{url}/jobs/{job_id}", method="DELETE")
+    )
+
+
+def in_thread(epub: Path) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        EPUBHV(epub, convert_to="s2t", streaming=True).run(dest=Path(tmpdir))
+
+
+def run_clients(clients: int, requests: int, func: Callable[[], None]) -> List[float]:
+    def timed(_: int) -> float:
+        start: float = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        return list(executor.map(timed, range(requests)))
+
+
+def report(name: str, latencies: List[float], total: float) -> None:
+    latencies = sorted(latencies)
+    p95: float = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{name:<10} {len(latencies) / total:>6.2f} books/s"
+        f"  p50: {statistics.median(latencies) * 1000:>8.1f}ms"
+        f"  p95: {p95 * 1000:>8.1f}ms  max: {latencies[-1] * 1000:>8.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--clients", default=8, type=int)
+    parser.add_argument("--requests", default=32, type=int)
+    parser.add_argument("--workers", default=4, type=int)
+    options = parser.parse_args()
+
+    epub: Path = TEST_DIR / "animal_farm.epub"
+    data: bytes = epub.read_bytes()
+
+    start: float = time.perf_counter()
+    latencies: List[float] = run_clients(
+        options.clients, options.requests, lambda: in_thread(epub)
+    )
+    report("threads", latencies, time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        service = ConversionService(
+            Path(workdir),
+            workers=options.workers,
+            max_queue=options.clients,
+            warmup_languages=(),
+            warmup_conversions=("s2t",),
+        )
+        server = ConversionServer(("127.0.0.1", 0), service, quiet=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url: str = f"http://127.0.0.1:{server.server_address[1]}"
+        # the workers are started on the first job
+        upload_and_download(url, data)
+        start = time.perf_counter()
+        latencies = run_clients(
+            options.clients, options.requests, lambda: upload_and_download(url, data)
+        )
+        report("service", latencies, time.perf_counter() - start)
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Synthetic epub books of any size, for the benchmarks.
+
+The text is made of the paragraphs of the test books, picked by a seeded
+random generator, so the same `BookSpec` always makes the same book:
+
+    ja: lemo.epub
+    zh-hans: sanguo.epub
+    zh-hant: books/animal.epub
+"""
+
+import html
+import random
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+from bs4 import BeautifulSoup as bs
+
+TEST_DIR = Path(__file__).parent.parent / "tests" / "test_epub"
+
+CORPORA: Dict[str, Path] = {
+    "ja": TEST_DIR / "books" / "lemo.epub",
+    "zh-hans": TEST_DIR / "sanguo.epub",
+    "zh-hant": TEST_DIR / "books" / "animal.epub",
+}
+
+CONTAINER: str = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+STYLE: str = """@charset "utf-8";
+body { margin: 0 1em; line-height: 1.8; }
+h1 { font-size: 1.4em; text-align: center; margin: 2em 0 1em; }
+p { text-indent: 1em; margin: 0; }
+em { font-style: normal; font-weight: bold; }
+.note { font-size: 0.8em; color: #666; }
+img { max-width: 100%; }
+"""
+
+
+class BookSpec(NamedTuple):
+    chapters: int = 20
+    # characters of text in every chapter
+    chapter_chars: int = 5000
+    # ja, zh-hans or zh-hant
+    language: str = "zh-hans"
+    # with a stylesheet, or without any css file
+    css: bool = True
+    # images, `asset_kb` of random bytes each
+    assets: int = 10
+    asset_kb: int = 100
+    seed: int = 0
+
+
+@lru_cache(maxsize=None)
+def corpus(language: str) -> List[str]:
+    """
+    the text of the paragraphs of the test book, without the ruby readings
+    """
+    paragraphs: List[str] = []
+    with zipfile.ZipFile(CORPORA[language]) as f:
+        for name in sorted(f.namelist()):
+            if not name.endswith((".html", ".xhtml", ".htm")):
+                continue
+            soup = bs(f.read(name).decode("utf-8", errors="ignore"), "html.parser")
+            for tag in soup.find_all(["rt", "rp"]):
+                tag.decompose()
+            for p in soup.find_all("p"):
+                text: str = " ".join(p.get_text().split())
+                if len(text) >= 10:
+                    paragraphs.append(text)
+    assert paragraphs, f"no text in {CORPORA[language]}"
+    return paragraphs
+
+
+def chapter(rng: random.Random, spec: BookSpec, index: int, images: List[str]) -> str:
+    paragraphs: List[str] = corpus(spec.language)
+    body: List[str] = [f"<h1>{index + 1}</h1>"]
+    size: int = 0
+    while size < spec.chapter_chars:
+        text: str = rng.choice(paragraphs)
+        size += len(text)
+        # some inline markup, like most real books
+        cut: int = rng.randrange(len(text))
+        end: int = min(len(text), cut + rng.randrange(2, 8))
+        body.append(
+            f"<p>{html.escape(text[:cut])}<em>{html.escape(text[cut:end])}</em>"
+            f"{html.escape(text[end:])}</p>"
+        )
+    if images:
+        body.append(f'<p class="note"><img src="../Images/{images[0]}" alt=""/></p>')
+    stylesheet: str = (
+        '<link href="../Styles/style.css" rel="stylesheet" type="text/css"/>'
+        if spec.css
+        else ""
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<!DOCTYPE html>\n<html xmlns="http://www.w3.org/1999/xhtml">\n'
+        f"<head><title>{index + 1}</title>{stylesheet}</head>\n"
+        "<body>\n" + "\n".join(body) + "\n</body>\n</html>\n"
+    )
+
+
+def make_epub(spec: BookSpec, path: Path) -> Path:
+    rng: random.Random = random.Random(spec.seed)
+    chapters: List[str] = [f"chapter{i:04d}.xhtml" for i in range(spec.chapters)]
+    images: List[str] = [f"image{i:04d}.jpg" for i in range(spec.assets)]
+    manifest: List[str] = [
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+    ]
+    manifest += [
+        f'<item id="c{i}" href="Text/{c}" media-type="application/xhtml+xml"/>'
+        for i, c in enumerate(chapters)
+    ]
+    manifest += [
+        f'<item id="i{i}" href="Images/{m}" media-type="image/jpeg"/>'
+        for i, m in enumerate(images)
+    ]
+    if spec.css:
+        manifest.append(
+            '<item id="css" href="Styles/style.css" media-type="text/css"/>'
+        )
+    spine: str = "".join(f'<itemref idref="c{i}"/>' for i in range(len(chapters)))
+    opf: str = f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>synthetic {spec.language}</dc:title>
+    <dc:language>{spec.language}</dc:language>
+    <dc:identifier id="id">epubhv-benchmark-{spec.seed}</dc:identifier>
+  </metadata>
+  <manifest>
+    {chr(10).join(manifest)}
+  </manifest>
+  <spine toc="ncx">{spine}</spine>
+</package>
+"""
+    ncx: str = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+        "<head/><docTitle><text>synthetic</text></docTitle><navMap>"
+        + "".join(
+            f'<navPoint id="n{i}" playOrder="{i + 1}"><navLabel><text>{i + 1}</text>'
+            f'</navLabel><content src="Text/{c}"/></navPoint>'
+            for i, c in enumerate(chapters)
+        )
+        + "</navMap></ncx>\n"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as f:
+        f.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        f.writestr("META-INF/container.xml", CONTAINER)
+        f.writestr("OEBPS/content.opf", opf)
+        f.writestr("OEBPS/toc.ncx", ncx)
+        if spec.css:
+            f.writestr("OEBPS/Styles/style.css", STYLE)
+        for i, c in enumerate(chapters):
+            # every chapter shows one of the images
+            shown: List[str] = images[i % len(images) :][:1] if images else []
+            f.writestr(f"OEBPS/Text/{c}", chapter(rng, spec, i, shown))
+        for m in images:
+            size: int = spec.asset_kb * 1024
+            # random bytes do not compress, like real jpegs
+            data: bytes = rng.getrandbits(size * 8).to_bytes(size, "little")
+            f.writestr(f"OEBPS/Images/{m}", data, compress_type=zipfile.ZIP_STORED)
+    return path
@@ -1 +1,2 @@
 from .epubhv import EPUBHV as EPUBHV
+from .epubhv import warmup as warmup
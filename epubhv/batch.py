@@ -0,0 +1,146 @@
+"""
+Convert a batch of epub books with a process pool.
+
+Every worker process builds its own `EPUBHV` for each book, the heavy
+resources the options need (OpenCC dictionaries, jieba, fugashi `Tagger`)
+are loaded once before the workers are forked, and shared by all of them,
+see `epubhv.workers`.
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence
+
+from epubhv.epubhv import EPUBHV, warmup
+from epubhv.stats import Stats
+from epubhv.workers import preloaded_executor
+
+
+class BatchResult(NamedTuple):
+    epub: Path
+    output: Optional[Path] = None
+    error: Optional[str] = None
+    # content documents taken from the document cache, and converted
+    documents_reused: int = 0
+    documents_recomputed: int = 0
+    # `Stats.as_dict` of the book, with `collect_stats`
+    stats: Optional[Dict[str, Any]] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def convert_one_epub(
+    epub: Path,
+    method: str,
+    dest: Path,
+    options: Dict[str, Any],
+    collect_stats: bool = False,
+) -> BatchResult:
+    """
+    convert one book, errors are returned in the result so one bad book will
+    not stop the others.
+    """
+    stats: Optional[Stats] = Stats() if collect_stats else None
+    try:
+        epubhv: EPUBHV = EPUBHV(file_path=epub, stats=stats, **options)
+        output: Path = epubhv.run(method=method, dest=dest)
+        return BatchResult(
+            epub=epub,
+            output=output,
+            documents_reused=epubhv.documents_reused,
+            documents_recomputed=epubhv.documents_recomputed,
+            stats=stats.as_dict() if stats is not None else None,
+        )
+    except Exception as e:
+        error: str = str(e) or type(e).__name__
+        if stats is not None:
+            # the stages done before the failure
+            stats.info["error"] = error
+        return BatchResult(
+            epub=epub,
+            error=error,
+            stats=stats.as_dict() if stats is not None else None,
+        )
+
+
+def preload(options: Dict[str, Any]) -> Callable[[], None]:
+    """
+    `warmup` of the backends the books may need with the `EPUBHV` options,
+    the ruby language is only known once a book is read
+    """
+    languages: Sequence[str] = ()
+    if options.get("need_ruby"):
+        languages = ("cantonese",) if options.get("need_cantonese") else ("ja", "zh")
+    convert_to: Optional[str] = options.get("convert_to")
+    return partial(
+        warmup,
+        languages,
+        (convert_to,) if convert_to is not None else (),
+        bool(options.get("need_ruby")),
+    )
+
+
+def run_batch(
+    epubs: Sequence[Path],
+    method: str = "to_vertical",
+    dest: Path = Path.cwd(),
+    jobs: int = 1,
+    collect_stats: bool = False,
+    **options: Any,
+) -> List[BatchResult]:
+    """
+    convert all the books, the results are in the same order as `epubs`.
+
+    options are passed to `EPUBHV` as is, like `convert_to` or `need_ruby`.
+    collect_stats records a `Stats` for every book, in `BatchResult.stats`.
+    """
+    assert jobs >= 1, "jobs must be at least 1"
+    if jobs == 1 or len(epubs) <= 1:
+        return [
+            convert_one_epub(epub, method, dest, options, collect_stats)
+            for epub in epubs
+        ]
+
+    workers: int = min(jobs, len(epubs))
+    results: List[Optional[BatchResult]] = [None] * len(epubs)
+    todo: Deque[int] = deque(range(len(epubs)))
+    while todo:
+        # the books which were in flight when a worker died, one of them
+        # killed it (e.g. the OOM killer or a crash in a backend)
+        suspects: List[int] = []
+        with preloaded_executor(workers, preload(options)) as executor:
+            # one book per worker, so the books in flight are the running ones
+            running: Dict[Future, int] = {}
+            while todo or running:
+                while todo and len(running) < workers and not suspects:
+                    i: int = todo.popleft()
+                    future: Future = executor.submit(
+                        convert_one_epub, epubs[i], method, dest, options, collect_stats
+                    )
+                    running[future] = i
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        results[i] = future.result()
+                    except BrokenProcessPool:
+                        suspects.append(i)
+                    except Exception as e:
+                        results[i] = BatchResult(epub=epubs[i], error=str(e) or repr(e))
+        # every one of them failed with the pool, try each one alone
+        for i in suspects:
+            with preloaded_executor(1, preload(options)) as executor:
+                try:
+                    results[i] = executor.submit(
+                        convert_one_epub, epubs[i], method, dest, options, collect_stats
+                    ).result()
+                except Exception as e:
+                    results[i] = BatchResult(epub=epubs[i], error=str(e) or repr(e))
+    return [r for r in results if r is not None]
@@ -0,0 +1,177 @@
+"""
+Content-addressed caches of converted books and documents.
+
+The key is the sha256 of the input, the options which change the output and
+the version of epubhv, so a new release never serves a result made by an old
+one. The store is a dir of `<key[:2]>/<key><suffix>` files, the mtime of a
+file is its last use, and the least recently used ones are removed once the
+store is over `max_bytes`. A converted book has a `<key>.name` file next to
+it with the name of the output, which depends on the detected language.
+Files are written to a temp name and renamed, so processes can share the
+same store.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+CHUNK_SIZE: int = 1 << 20
+
+
+@lru_cache(maxsize=None)
+def library_version() -> str:
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("epubhv")
+    except PackageNotFoundError:
+        # running from a source tree which is not installed
+        return "unknown"
+
+
+def file_digest(file_path: Path) -> str:
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    suffix: str = ".epub"
+
+    def __init__(self, path: Path, max_bytes: int = 1 << 30) -> None:
+        """
+        path: dir of the store, it is created on the first write
+        max_bytes: size of the store, the least recently used books are
+        removed when it is over
+        """
+        self.path: Path = path
+        self.max_bytes: int = max_bytes
+
+    def key(self, epub: Path, method: str, options: Dict[str, Any]) -> str:
+        h = hashlib.sha256(file_digest(epub).encode("utf-8"))
+        h.update(
+            json.dumps(
+                {"method": method, "version": library_version(), **options},
+                sort_keys=True,
+            ).encode("utf-8")
+        )
+        return h.hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}{self.suffix}"
+
+    def name_entry(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.name"
+
+    def output_name(self, key: str) -> Optional[str]:
+        """
+        the name of the output the book was put with, None if it is unknown
+        """
+        try:
+            return self.name_entry(key).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: str, target: Path) -> bool:
+        """
+        copy the cached book to target, False if it is not in the cache
+        """
+        entry: Path = self.entry(key)
+        try:
+            source = open(entry, "rb")
+        except FileNotFoundError:
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with source, open(target, "wb") as f:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+        try:
+            # mark it as used
+            os.utime(entry)
+        except FileNotFoundError:
+            # evicted by another process while we were reading it
+            pass
+        return True
+
+    def put(self, key: str, output: Path) -> None:
+        entry: Path = self.entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp: Path = entry.with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(output, tmp)
+        os.replace(tmp, entry)
+        tmp.write_text(output.name, encoding="utf-8")
+        os.replace(tmp, self.name_entry(key))
+        self.evict()
+
+    def entries(self) -> List[Tuple[float, int, Path]]:
+        """
+        (last use, size, path) of all the books in the store
+        """
+        entries: List[Tuple[float, int, Path]] = []
+        for entry in self.path.glob(f"*/*{self.suffix}"):
+            try:
+                stat: os.stat_result = entry.stat()
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def evict(self) -> None:
+        entries: List[Tuple[float, int, Path]] = sorted(self.entries())
+        total: int = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            try:
+                entry.with_suffix(".name").unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class DocumentCache(ResultCache):
+    """
+    converted content documents by their text and `DocumentOptions`, so a
+    new edition of a book only converts the documents which changed. Writes
+    do not evict, call `evict` once after a book.
+    """
+
+    suffix: str = ".html"
+
+    def document_key(self, content: str, options: NamedTuple) -> str:
+        h = hashlib.sha256(
+            json.dumps(
+                {"version": library_version(), **options._asdict()}, sort_keys=True
+            ).encode("utf-8")
+        )
+        h.update(content.encode("utf-8", errors="surrogatepass"))
+        return h.hexdigest()
+
+    def load(self, key: str) -> Optional[bytes]:
+        entry: Path = self.entry(key)
+        try:
+            data: bytes = entry.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def save(self, key: str, data: bytes) -> None:
+        entry: Path = self.entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp: Path = entry.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, entry)
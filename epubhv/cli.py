@@ -1,8 +1,20 @@
+import json
+import sys
 from argparse import ArgumentParser, RawTextHelpFormatter
 from pathlib import Path
-from typing import cast
+from typing import Any, Dict, List, Optional, cast
 
-from epubhv.epubhv import EPUBHV, list_all_epub_in_dir
+from epubhv.batch import BatchResult, run_batch
+from epubhv.cache import DocumentCache, ResultCache
+from epubhv.detect import LanguageDetector
+from epubhv.epubhv import (
+    EPUBHV,
+    PARSERS,
+    TEMP_DIR,
+    TMPFS_DIR,
+    list_all_epub_in_dir,
+)
+from epubhv.stats import Stats
 
 
 class Options:
@@ -12,6 +24,24 @@ class Options:
     punctuation: str
     ruby: bool
     cantonese: bool
+    streaming: bool
+    jobs: int
+    doc_jobs: int
+    doc_chunksize: int
+    parser: str
+    detect_samples: int
+    yomi_cache: Optional[str]
+    ruby_emit: str
+    ruby_scope: str
+    temp_dir: Path
+    tmpfs: bool
+    cache_dir: Optional[Path]
+    document_cache: Optional[Path]
+    cache_size: int
+    stats: Optional[str]
+    stats_file: Optional[Path]
+    memory_budget: Optional[int]
+    max_in_flight: Optional[int]
     dest: Path
 
 
@@ -45,6 +75,142 @@ def main() -> None:
         action="store_true",
         help="Ruby it for cantonese.",
     )
+    parser.add_argument(
+        "--streaming",
+        dest="streaming",
+        action="store_true",
+        help="rewrite the epub in memory instead of extracting it to a temp dir.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        default=1,
+        type=int,
+        help="number of worker processes to convert the epub files in a dir, default to 1",
+    )
+    parser.add_argument(
+        "--doc-jobs",
+        dest="doc_jobs",
+        default=1,
+        type=int,
+        help="number of worker processes to convert the documents inside one epub file, default to 1",
+    )
+    parser.add_argument(
+        "--doc-chunksize",
+        dest="doc_chunksize",
+        default=1,
+        type=int,
+        help="number of documents sent to a worker process at a time, default to 1",
+    )
+    parser.add_argument(
+        "--parser",
+        dest="parser",
+        choices=PARSERS,
+        default="html.parser",
+        help="""parser backend for the html files (default: html.parser)
+
+        lxml is much faster, it falls back to html.parser if a file is not well-formed
+        """,
+    )
+    parser.add_argument(
+        "--detect-samples",
+        dest="detect_samples",
+        default=10,
+        type=int,
+        help="number of documents to detect the ruby language, 0 for all the documents, default to 10",
+    )
+    parser.add_argument(
+        "--yomi-cache",
+        dest="yomi_cache",
+        default=None,
+        help="sqlite file to keep the ruby readings across runs, default to memory only",
+    )
+    parser.add_argument(
+        "--ruby-emit",
+        dest="ruby_emit",
+        choices=["tags", "string"],
+        default="tags",
+        help="""how to build the ruby markup with html.parser (default: tags)
+
+        string builds the markup of a text node as one string, it uses much less memory
+        """,
+    )
+    parser.add_argument(
+        "--ruby-scope",
+        dest="ruby_scope",
+        choices=["text", "block"],
+        default="text",
+        help="""what the ruby languages segment at a time (default: text)
+
+        block segments a paragraph at once, across its inline tags like <em> and <span>,
+        it is much faster on books with a lot of styles, and the words split by a tag get their readings
+        """,
+    )
+    parser.add_argument(
+        "--temp-dir",
+        dest="temp_dir",
+        default=TEMP_DIR,
+        type=Path,
+        help=f"root of the dirs the epub files are extracted to, default to {TEMP_DIR}",
+    )
+    parser.add_argument(
+        "--tmpfs",
+        dest="tmpfs",
+        action="store_true",
+        help=f"extract the epub files to memory ({TMPFS_DIR}) instead of --temp-dir",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        default=None,
+        type=Path,
+        help="dir to keep the converted epub files, the same book with the same options is not converted again",
+    )
+    parser.add_argument(
+        "--document-cache",
+        dest="document_cache",
+        default=None,
+        type=Path,
+        help="dir to keep the converted html files, only the changed ones of a new edition are converted again",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        default=1024,
+        type=int,
+        help="max size of --cache-dir and of --document-cache in MiB, the least recently used files are removed, default to 1024",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        choices=["json"],
+        default=None,
+        help="print the time and CPU time of every stage and document, the counters and the max memory, one JSON line per epub file to stderr",
+    )
+    parser.add_argument(
+        "--stats-file",
+        dest="stats_file",
+        default=None,
+        type=Path,
+        help="append the --stats lines to this file instead of stderr",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        dest="memory_budget",
+        default=None,
+        type=int,
+        help="""max memory in MiB of a book and its --doc-jobs processes, it fails instead of going over
+        the html trees are freed as soon as they are written, with --streaming the html files are kept on disk
+        """,
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        dest="max_in_flight",
+        default=None,
+        type=int,
+        help="max number of html files sent to the --doc-jobs processes and not written yet, default to 2 chunks per process",
+    )
     parser.add_argument(
         "-d",
         "--dest",
@@ -106,33 +272,95 @@ tw2t: Traditional Chinese (OpenCC Standard) to Traditional Chinese (Taiwan stand
     )
 
     options = cast(Options, parser.parse_args())
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.doc_jobs < 1 or options.doc_chunksize < 1:
+        parser.error("--doc-jobs and --doc-chunksize must be at least 1")
+    if options.memory_budget is not None and options.memory_budget < 1:
+        parser.error("--memory-budget must be at least 1")
+    if options.max_in_flight is not None and options.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    if options.tmpfs:
+        if not TMPFS_DIR.is_dir():
+            parser.error(f"--tmpfs needs {TMPFS_DIR}")
+        options.temp_dir = TMPFS_DIR / "epubhv"
+    epub_options = dict(
+        convert_to=options.convert,
+        convert_punctuation=options.punctuation,
+        need_ruby=options.ruby,
+        need_cantonese=options.cantonese,
+        streaming=options.streaming,
+        document_workers=options.doc_jobs,
+        document_chunksize=options.doc_chunksize,
+        parser=options.parser,
+        language_detector=LanguageDetector(samples=options.detect_samples),
+        yomi_cache_path=options.yomi_cache,
+        ruby_emit=options.ruby_emit,
+        ruby_scope=options.ruby_scope,
+        temp_dir=options.temp_dir,
+        memory_budget=(
+            options.memory_budget << 20 if options.memory_budget is not None else None
+        ),
+        max_documents_in_flight=options.max_in_flight,
+        result_cache=(
+            ResultCache(options.cache_dir, max_bytes=options.cache_size << 20)
+            if options.cache_dir is not None
+            else None
+        ),
+        document_cache=(
+            DocumentCache(options.document_cache, max_bytes=options.cache_size << 20)
+            if options.document_cache is not None
+            else None
+        ),
+    )
+
+    def print_stats(stats: Dict[str, Any]) -> None:
+        line: str = json.dumps(stats, ensure_ascii=False)
+        if options.stats_file is None:
+            print(line, file=sys.stderr)
+            return
+        with open(options.stats_file, "a", encoding="utf-8") as f:
+            print(line, file=f)
+
+    def documents(reused: int, recomputed: int) -> str:
+        if options.document_cache is None:
+            return ""
+        return f" ({reused} documents reused, {recomputed} recomputed)"
+
     epub_files = Path(options.epub)
     if epub_files.exists():
         if epub_files.is_dir():
-            files: set[Path] = list_all_epub_in_dir(path=epub_files)
-            f: Path
-            for f in files:
-                print(f"{str(f)} is {options.method}")
-                try:
-                    epubhv: EPUBHV = EPUBHV(
-                        file_path=f,
-                        convert_to=options.convert,
-                        convert_punctuation=options.punctuation,
-                        need_ruby=options.ruby,
-                        need_cantonese=options.cantonese,
+            files: List[Path] = sorted(list_all_epub_in_dir(path=epub_files))
+            results: List[BatchResult] = run_batch(
+                files,
+                method=options.method,
+                dest=options.dest,
+                jobs=options.jobs,
+                collect_stats=options.stats is not None,
+                **epub_options,
+            )
+            for r in results:
+                if r.ok:
+                    print(
+                        f"{str(r.epub)} is {options.method} -> {str(r.output)}"
+                        + documents(r.documents_reused, r.documents_recomputed)
                     )
-                    epubhv.run(method=options.method, dest=options.dest)
-                except Exception as e:
-                    print(f"{str(f)} {options.method} is failed by {str(e)}")
+                else:
+                    print(f"{str(r.epub)} {options.method} is failed by {r.error}")
+                if r.stats is not None:
+                    print_stats(r.stats)
+            failed: int = len([r for r in results if not r.ok])
+            print(f"{len(results) - failed} done, {failed} failed")
         else:
-            print(f"{str(epub_files)} is {options.method}")
-            epubhv: EPUBHV = EPUBHV(
-                file_path=epub_files,
-                convert_to=options.convert,
-                need_ruby=options.ruby,
-                need_cantonese=options.cantonese,
-            )
+            stats: Optional[Stats] = Stats() if options.stats is not None else None
+            epubhv: EPUBHV = EPUBHV(file_path=epub_files, stats=stats, **epub_options)
             epubhv.run(method=options.method, dest=options.dest)
+            print(
+                f"{str(epub_files)} is {options.method}"
+                + documents(epubhv.documents_reused, epubhv.documents_recomputed)
+            )
+            if stats is not None:
+                print_stats(stats.as_dict())
     else:
         raise Exception("Please make sure it is a dir contains epub or is a epub file.")
 
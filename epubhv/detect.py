@@ -0,0 +1,159 @@
+"""
+Detect the language of a book from a sample of its documents.
+
+Steps:
+  1. pick `samples` documents spread over the spine
+  2. take at most `max_chars` characters of the body text of each one
+  3. count the kana, Han and Hangul code points, when the script makes the
+     answer obvious we do not need langdetect at all
+  4. stop once one language has the majority of the samples
+"""
+
+from collections import Counter
+from functools import lru_cache
+from types import ModuleType
+from typing import Iterable, List, Optional, Sequence, TypeVar
+
+from lxml import etree
+from lxml import html as lxml_html
+
+T = TypeVar("T")
+
+# common characters only used in simplified or in traditional Chinese
+SIMPLIFIED_CHARS: str = (
+    "这们个说时来对会为发过还没样经点现问开长进见东给让两国头门车马鸟书学习实应关动"
+)
+TRADITIONAL_CHARS: str = (
+    "這們個說時來對會為爲發過還沒樣經點現問開長進見東給讓兩國頭門車馬鳥書學習實應關動"
+)
+
+# we have already decoded the documents as utf-8
+html_parser = lxml_html.HTMLParser(encoding="utf-8")
+
+# the text in these tags is not the text to read
+SKIP_TAGS = ("script", "style", "rt", "rp", "template")
+
+
+@lru_cache(maxsize=None)
+def load_langdetect() -> ModuleType:
+    """
+    import langdetect and load its language profiles, only when the script
+    check is not enough
+    """
+    import langdetect
+    from langdetect.detector_factory import init_factory
+
+    init_factory()
+    return langdetect
+
+
+def pick_samples(documents: Sequence[T], samples: int) -> List[T]:
+    """
+    pick documents spread over the whole book, so the front matter will not
+    decide the language alone
+    """
+    if samples <= 0 or len(documents) <= samples:
+        return list(documents)
+    step: float = len(documents) / samples
+    return [documents[int(step * i + step / 2)] for i in range(samples)]
+
+
+def document_text(content: str, max_chars: int) -> str:
+    """
+    the body text of a (x)html document, at most `max_chars` characters
+    """
+    try:
+        root = lxml_html.document_fromstring(
+            content.encode("utf-8", errors="ignore"), parser=html_parser
+        )
+    except (etree.ParserError, ValueError):
+        return ""
+    body = root.find("body")
+    if body is None:
+        return ""
+    etree.strip_elements(body, *SKIP_TAGS, with_tail=False)
+    text: List[str] = []
+    length: int = 0
+    for t in body.itertext():
+        text.append(t)
+        length += len(t)
+        if max_chars > 0 and length >= max_chars:
+            break
+    body_text: str = "".join(text)
+    return body_text[:max_chars] if max_chars > 0 else body_text
+
+
+def detect_by_script(text: str) -> Optional[str]:
+    """
+    a cheap check by the code points, None if it is not obvious
+    """
+    kana = han = hangul = 0
+    for ch in text:
+        o: int = ord(ch)
+        if 0x3040 <= o <= 0x30FF:
+            kana += 1
+        elif 0x4E00 <= o <= 0x9FFF or 0x3400 <= o <= 0x4DBF:
+            han += 1
+        elif 0xAC00 <= o <= 0xD7AF or 0x1100 <= o <= 0x11FF:
+            hangul += 1
+    total: int = kana + han + hangul
+    # too short or not a CJK text
+    if total < 20 or total < len(text.strip()) / 2:
+        return None
+    if kana >= total * 0.1:
+        return "ja"
+    if hangul >= total * 0.5:
+        return "ko"
+    if han < total * 0.9:
+        return None
+    simplified: int = sum(text.count(ch) for ch in SIMPLIFIED_CHARS)
+    traditional: int = sum(text.count(ch) for ch in TRADITIONAL_CHARS)
+    if simplified + traditional < 5:
+        return None
+    if simplified >= (simplified + traditional) * 0.9:
+        return "zh-cn"
+    if traditional >= (simplified + traditional) * 0.9:
+        return "zh-tw"
+    return None
+
+
+class LanguageDetector:
+    def __init__(
+        self, samples: int = 10, max_chars: int = 2000, script_check: bool = True
+    ) -> None:
+        """
+        samples: number of documents to detect, 0 for all the documents
+        max_chars: number of characters of each document, 0 for no limit
+        script_check: try `detect_by_script` before langdetect
+        """
+        self.samples: int = samples
+        self.max_chars: int = max_chars
+        self.script_check: bool = script_check
+
+    def detect_text(self, text: str) -> Optional[str]:
+        if self.script_check:
+            language: Optional[str] = detect_by_script(text)
+            if language is not None:
+                return language
+        langdetect: ModuleType = load_langdetect()
+        try:
+            return langdetect.detect(text)
+        except langdetect.LangDetectException:
+            return None
+
+    def detect(self, contents: Iterable[str]) -> Counter:
+        """
+        count the languages of the documents, `contents` should already be the
+        samples, it is read lazily so we stop reading once we are sure
+        """
+        c: Counter = Counter()
+        for content in contents:
+            language: Optional[str] = self.detect_text(
+                document_text(content, self.max_chars)
+            )
+            if language is None:
+                continue
+            c[language] += 1
+            if self.samples > 0 and c[language] > self.samples // 2:
+                break
+        return c
@@ -2,32 +2,63 @@
 Follow these steps to change epub books to vertical or horizontal.
 """
 
-import logging
+import copy
+import io
 import os
+import posixpath
 import shutil
+import struct
+import tempfile
 import zipfile
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future
+from contextlib import nullcontext
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from urllib.parse import unquote
 
-import cssutils
-import opencc
 from bs4 import BeautifulSoup as bs
-from bs4 import NavigableString, PageElement, ResultSet, Tag
-from cssutils import CSSParser
-from cssutils.css import CSSStyleSheet
-from langdetect import LangDetectException, detect
-
-from epubhv.punctuation import Punctuation
-from epubhv.yomituki import RubySoup, string_containers  # pyright: ignore
+from bs4 import NavigableString, PageElement, Tag
 
-cssutils.log.setLevel(logging.CRITICAL)  # type: ignore
+from epubhv.cache import DocumentCache, ResultCache
+from epubhv.detect import LanguageDetector, load_langdetect, pick_samples
+from epubhv.lxml_backend import convert_tree, parse_document, serialize_document
+from epubhv.memory import MemoryBudget
+from epubhv.opencc_engine import CompiledOpenCC, load_opencc
+from epubhv.opf import Package
+from epubhv.punctuation import Punctuation, translation_table
+from epubhv.stats import (
+    DocumentStats,
+    Measurement,
+    Stats,
+    Timing,
+    count,
+    measure,
+    step,
+)
+from epubhv.stylesheet import to_horizontal, to_vertical
+from epubhv.workers import preloaded_executor
+from epubhv.yomituki import (  # pyright: ignore
+    RubySoup,
+    load_yomi_cache,
+    string_containers,
+)
+from epubhv.yomituki import warmup as warmup_languages  # pyright: ignore
 
-WRITING_KEY_LIST: List[str] = [
-    "writing-mode",
-    "-webkit-writing-mode",
-    "-epub-writing-mode",
-]
 V_STYLE_LINE: str = (
     '<link rel="stylesheet" href="../Style/style.css" type="text/css" />'
 )
@@ -35,8 +66,6 @@ V_STYLE_LINE: str = (
 H_STYLE_LINE: str = (
     '<link rel="stylesheet" href="../Style/style.css" type="text/css" />'
 )
-V_STYLE_LINE_IN_OPF: str = '<meta content="vertical-rl" name="primary-writing-mode"/>'
-H_STYLE_LINE_IN_OPF: str = '<meta content="horizontal-lr" name="primary-writing-mode"/>'
 V_ITEM_TO_ADD_IN_MANIFEST: str = (
     '<item id="stylesheet" href="Style/style.css" media-type="text/css" />'
 )
@@ -45,6 +74,46 @@ H_ITEM_TO_ADD_IN_MANIFEST: str = (
     '<item id="stylesheet" href="Style/style.css" media-type="text/css" />'
 )
 
+# joins the strings of a document for one OpenCC call, "\x00" is not allowed
+# in XML so it should never be in the text
+OPENCC_SENTINEL: str = "\n\x00\n"
+
+# every book is extracted to its own unique dir under this root
+TEMP_DIR: Path = Path(".epub_temp_dir")
+# memory backed root for the workspaces, on Linux
+TMPFS_DIR: Path = Path("/dev/shm")
+
+# parser backends for the content documents
+PARSERS: List[str] = ["html.parser", "lxml"]
+
+
+def load_converter(convert_to: str) -> CompiledOpenCC:
+    """
+    the compiled OpenCC dictionaries, loaded once per process and shared
+    between books
+    """
+    return load_opencc(convert_to)
+
+
+def warmup(
+    languages: Iterable[str] = ("ja", "zh", "cantonese"),
+    conversions: Iterable[str] = (),
+    detect: bool = True,
+) -> None:
+    """
+    load the heavy resources now instead of on their first use, for long
+    running services which should not make the first request wait.
+
+    languages: ruby languages, "ja", "zh" or "cantonese"
+    conversions: OpenCC configs, like "s2t"
+    detect: the langdetect profiles
+    """
+    warmup_languages(languages)
+    for convert_to in conversions:
+        load_converter(convert_to)
+    if detect:
+        load_langdetect()
+
 
 def list_all_epub_in_dir(path: Path) -> set[Path]:
     return set(path.rglob("*.epub"))
@@ -58,11 +127,266 @@ def make_epub_files_dict(dir_path: Path) -> Dict[str, List[Path]]:
     return files_dict
 
 
-def load_opf_meta_data(opf_file: Path) -> bs:
-    with open(opf_file, encoding="utf-8", errors="ignore") as f:
-        content: str = f.read()
-        soup: bs = bs(content, "xml")
-    return soup
+def make_zip_files_dict(epub_zip: zipfile.ZipFile) -> Dict[str, List[Path]]:
+    files_dict: Dict[str, List[Path]] = defaultdict(list)
+    for info in epub_zip.infolist():
+        if info.is_dir():
+            continue
+        files_dict[Path(info.filename).suffix].append(Path(info.filename))
+    return files_dict
+
+
+# the raw copy of `copy_zip_member` needs these internals of zipfile, they
+# are not a public api, so it falls back to a plain copy without them
+RAW_ZIP_COPY: bool = all(
+    hasattr(zipfile, name)
+    for name in (
+        "structFileHeader",
+        "sizeFileHeader",
+        "_FH_FILENAME_LENGTH",
+        "_FH_EXTRA_FIELD_LENGTH",
+    )
+)
+
+
+def copy_zip_member(
+    source: zipfile.ZipFile, info: zipfile.ZipInfo, target: zipfile.ZipFile
+) -> None:
+    """
+    copy the compressed bytes of one member from source to target as is,
+    so the member will not be decompressed and recompressed again.
+    """
+    if not (
+        RAW_ZIP_COPY and hasattr(target, "start_dir") and hasattr(target, "_didModify")
+    ):
+        # same compression and attributes, but compressed again
+        target.writestr(info, source.read(info))
+        return
+    assert source.fp is not None and target.fp is not None
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(
+        zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader)
+    )
+    source.fp.seek(
+        header[zipfile._FH_FILENAME_LENGTH]  # type: ignore
+        + header[zipfile._FH_EXTRA_FIELD_LENGTH],  # type: ignore
+        os.SEEK_CUR,
+    )
+    new_info = copy.copy(info)
+    # we know the sizes and crc here, so we do not need the data descriptor
+    new_info.flag_bits &= ~0x08
+    new_info.header_offset = target.fp.tell()
+    target.fp.write(new_info.FileHeader())
+    remain: int = info.compress_size
+    while remain > 0:
+        chunk: bytes = source.fp.read(min(remain, 1 << 20))
+        assert chunk, f"{info.filename} is truncated"
+        target.fp.write(chunk)
+        remain -= len(chunk)
+    target.filelist.append(new_info)
+    target.NameToInfo[new_info.filename] = new_info
+    target.start_dir = target.fp.tell()  # type: ignore
+    target._didModify = True  # type: ignore
+
+
+def load_opf_meta_data(opf_file: Path) -> Package:
+    return Package(opf_file.read_bytes())
+
+
+class DocumentOptions(NamedTuple):
+    """
+    everything `convert_document` needs, it is small and picklable so the
+    documents can be converted in other processes.
+    """
+
+    # stylesheet link to add to the head, for books without css files
+    stylesheet_line: Optional[str] = None
+    convert_to: Optional[str] = None
+    # resolved punctuation conversion like `s2t`, `none` for no conversion
+    punctuation: str = "none"
+    horizontal: bool = False
+    # None for no ruby
+    ruby_language: Optional[str] = None
+    # `html.parser` (BeautifulSoup) or `lxml`
+    parser: str = "html.parser"
+    # sqlite file to keep the readings across runs, None for memory only
+    yomi_cache_path: Optional[str] = None
+    # `tags` or `string`, see `RubySoup`
+    ruby_emit: str = "tags"
+    # `text` or `block`, see `RubySoup`
+    ruby_scope: str = "text"
+    # decompose the soup once it is serialized, so its memory is freed now
+    # and not at the next garbage collection, the output is the same
+    release_trees: bool = False
+
+
+def add_stylesheet_to_soup(soup: bs, stylesheet_line: str) -> None:
+    # Find the head section or create if not present
+    head: Optional[Tag | NavigableString] = soup.find("head")
+    if not head or type(head) is NavigableString:
+        head = soup.new_tag("head")  # type: ignore
+        soup.html.insert(0, head)  # type: ignore
+
+    # Add the stylesheet line inside the head section
+    head.append(bs(stylesheet_line, "html.parser").contents[0])
+
+
+def batch_convert(converter: CompiledOpenCC, texts: List[str]) -> List[str]:
+    """
+    convert all the strings of a document with one OpenCC call.
+
+    The strings are joined with `OPENCC_SENTINEL`, its newlines are sentence
+    separators for OpenCC, so no phrase can match across two strings and the
+    result is the same as converting them one by one. If a string has the
+    sentinel in it, we fall back to one call per string.
+    """
+    if len(texts) > 1 and not any("\x00" in text for text in texts):
+        new_texts: List[str] = converter.convert(OPENCC_SENTINEL.join(texts)).split(
+            OPENCC_SENTINEL
+        )
+        if len(new_texts) == len(texts):
+            return new_texts
+    return [converter.convert(text) for text in texts]
+
+
+def make_text_converter(
+    options: DocumentOptions,
+) -> Callable[[List[str]], List[str]]:
+    """
+    OpenCC then the punctuation, for all the strings of a document at once.
+    """
+    assert options.convert_to is not None
+    converter: CompiledOpenCC = load_converter(options.convert_to)
+    # the punctuation table is built once for all the strings
+    table: Dict[int, str] = {}
+    if options.punctuation != "none":
+        source, target = options.punctuation.split("2")
+        punc_converter = Punctuation()
+        table = translation_table(
+            options.horizontal,
+            punc_converter.map_locale(source),
+            punc_converter.map_locale(target),
+        )
+
+    def convert_texts(texts: List[str]) -> List[str]:
+        count("text_nodes", len(texts))
+        count("characters_converted", sum(map(len, texts)))
+        with step("opencc"):
+            new_texts: List[str] = batch_convert(converter, texts)
+            if table:
+                new_texts = [text.translate(table) for text in new_texts]
+        return new_texts
+
+    return convert_texts
+
+
+def convert_soup_text(soup: bs, options: DocumentOptions) -> bool:
+    """
+    convert all the strings in the soup with OpenCC, then the punctuation,
+    return True if any of them changed.
+    """
+    html_element = soup.find("html")
+    assert isinstance(html_element, Tag)
+    text_elements: List[NavigableString] = html_element.find_all(
+        string=True
+    )  # type: ignore
+    new_texts: List[str] = make_text_converter(options)(
+        [str(element) for element in text_elements]
+    )
+
+    changed: bool = False
+    element: NavigableString
+    for element, new_text in zip(text_elements, new_texts):
+        if new_text != element:
+            # keep the string class, so comments and <rt> stay what they are
+            element.replace_with(type(element)(new_text))
+            changed = True
+    return changed
+
+
+def convert_document(content: str, options: DocumentOptions) -> Optional[str]:
+    """
+    parse one (x)html document once, then run all the stages on the same tree:
+      1. add the stylesheet link
+      2. OpenCC and punctuation
+      3. ruby
+    and serialize it at the end, compactly. None if no stage changed the
+    document, so it can be kept as it is.
+
+    with the `lxml` parser the document is parsed as XML by lxml, if it is
+    not well-formed we fall back to BeautifulSoup with `html.parser`.
+    """
+    ruby: Optional[RubySoup] = None
+    if options.ruby_language is not None:
+        # TODO fix this maybe support unruby
+        ruby = RubySoup(
+            options.ruby_language,
+            True,
+            load_yomi_cache(options.yomi_cache_path),
+            emit=options.ruby_emit,
+            scope=options.ruby_scope,
+        )
+    new_content: Optional[str] = _convert_document(content, options, ruby)
+    if ruby is not None:
+        # keep the new readings on disk, the worker processes never close it
+        ruby.cache.flush()
+    return new_content
+
+
+def measure_document(
+    content: str, options: DocumentOptions
+) -> Tuple[Optional[str], Measurement]:
+    """
+    `convert_document` with its timing and counters, for `Stats`
+    """
+    with measure() as m:
+        new_content: Optional[str] = convert_document(content, options)
+    return new_content, m
+
+
+def convert_documents(
+    contents: List[str], options: DocumentOptions
+) -> List[Tuple[Optional[str], Measurement]]:
+    """
+    `measure_document` for a chunk of documents, one task of the process pool
+    """
+    return [measure_document(content, options) for content in contents]
+
+
+def _convert_document(
+    content: str, options: DocumentOptions, ruby: Optional[RubySoup]
+) -> Optional[str]:
+    if options.parser == "lxml":
+        with step("parse"):
+            root = parse_document(content)
+        if root is not None:
+            convert: Optional[Callable[[List[str]], List[str]]] = (
+                make_text_converter(options) if options.convert_to is not None else None
+            )
+            if not convert_tree(root, options.stylesheet_line, convert, ruby):
+                return None
+            with step("serialize"):
+                return serialize_document(
+                    root, xml_declaration=content.lstrip().startswith("<?xml")
+                )
+    with step("parse"):
+        soup: bs = bs(content, "html.parser", string_containers=string_containers)
+    changed: bool = False
+    if options.stylesheet_line is not None:
+        add_stylesheet_to_soup(soup, options.stylesheet_line)
+        changed = True
+    if options.convert_to is not None:
+        changed = convert_soup_text(soup, options) or changed
+    if ruby is not None:
+        with step("ruby"):
+            changed = bool(ruby.ruby_soup(soup.body)) or changed
+    new_content: Optional[str] = None
+    if changed:
+        with step("serialize"):
+            new_content = str(soup)
+    if options.release_trees:
+        soup.decompose()
+    return new_content
 
 
 class EPUBHV:
@@ -77,60 +401,190 @@ class EPUBHV:
         convert_punctuation: str = "auto",
         need_ruby: bool = False,
         need_cantonese: bool = False,
+        streaming: bool = False,
+        document_workers: int = 1,
+        document_chunksize: int = 1,
+        parser: str = "html.parser",
+        language_detector: Optional[LanguageDetector] = None,
+        yomi_cache_path: Optional[str] = None,
+        ruby_emit: str = "tags",
+        ruby_scope: str = "text",
+        temp_dir: Optional[Path] = None,
+        result_cache: Optional[ResultCache] = None,
+        document_cache: Optional[DocumentCache] = None,
+        stats: Optional[Stats] = None,
+        memory_budget: Optional[int] = None,
+        max_documents_in_flight: Optional[int] = None,
     ) -> None:
         # declare instance fields
         self.epub_file = file_path
+        # root of the workspace the book is extracted to, every conversion
+        # gets a new unique dir in it so parallel jobs never share files
+        self.temp_dir: Path = temp_dir if temp_dir is not None else TEMP_DIR
+        self.workspace: Optional[Path] = None
+        # converted books by the input and the options
+        self.result_cache: Optional[ResultCache] = result_cache
+        # converted documents by their content and options
+        self.document_cache: Optional[DocumentCache] = document_cache
+        self.documents_reused: int = 0
+        self.documents_recomputed: int = 0
+        # content documents which are written, the others are kept as is
+        self.documents_changed: int = 0
+        # timings and counters of the stages and documents, None to skip
+        self.stats: Optional[Stats] = stats
+        # streaming mode never extracts the epub, it rewrites the members we
+        # need in memory and copies all the others to the new epub directly
+        self.streaming: bool = streaming
+        self.source_zip: Optional[zipfile.ZipFile] = None
+        self.rewritten_members: Dict[str, bytes] = {}
+        # with a memory budget the rewritten members are kept in files of the
+        # workspace instead of memory
+        self.spilled_members: Dict[str, Path] = {}
+        # max RSS in bytes of this process and the document workers, the
+        # trees are released as soon as they are serialized, None for no limit
+        self.memory_budget: Optional[MemoryBudget] = (
+            MemoryBudget(memory_budget) if memory_budget is not None else None
+        )
+        # documents read and not written yet with `document_workers` > 1,
+        # None for 2 chunks per worker
+        assert (
+            max_documents_in_flight is None or max_documents_in_flight >= 1
+        ), "max_documents_in_flight must be at least 1"
+        self.max_documents_in_flight: Optional[int] = max_documents_in_flight
+        # process pool for the content documents of this book
+        assert document_workers >= 1, "document_workers must be at least 1"
+        self.document_workers: int = document_workers
+        self.document_chunksize: int = document_chunksize
+        assert parser in PARSERS, f"parser must be one of {PARSERS}"
+        self.parser: str = parser
         self.has_css_file: bool = False
+        self.stylesheet_line: Optional[str] = None
         # for language ruby
         self.need_ruby: bool = need_ruby
         self.ruby_language = None
+        # sample the documents to detect the ruby language
+        self.language_detector: LanguageDetector = (
+            language_detector or LanguageDetector()
+        )
         self.cantonese = need_cantonese
+        self.yomi_cache_path: Optional[str] = yomi_cache_path
+        self.ruby_emit: str = ruby_emit
+        self.ruby_scope: str = ruby_scope
         self.files_dict: Dict[str, List[Path]] = {}
         self.content_files_list: List[Path] = []
         self.convert_punctuation = convert_punctuation
         self.convert_to = convert_to
 
-        self.converter = opencc.OpenCC(convert_to) if convert_to is not None else None
+        self.converter = load_converter(convert_to) if convert_to is not None else None
 
     def extract_one_epub_to_dir(self) -> None:
         assert self.epub_file.suffix == ".epub", f"{self.epub_file} Must be epub file"
-        book_name: str = self.epub_file.name.split(".")[0]
-        self.book_name = book_name
-        book_path = Path(".epub_temp_dir") / Path(book_name)
-        Path(".epub_temp_dir").mkdir(parents=True, exist_ok=True)
+        self.book_name = self.epub_file.stem
+        # extracted again, do not leak the old workspace
+        self.cleanup()
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.workspace = Path(
+            tempfile.mkdtemp(prefix=f"{self.book_name}-", dir=self.temp_dir)
+        )
+        self.book_path = self.workspace
         with zipfile.ZipFile(self.epub_file) as f:
-            f.extractall(book_path)
-        self.book_path = book_path
+            f.extractall(self.book_path)
+
+    def open_one_epub_archive(self) -> None:
+        assert self.epub_file.suffix == ".epub", f"{self.epub_file} Must be epub file"
+        self.book_name = self.epub_file.stem
+        self.book_path = Path()
+        # opened again, do not leak the old archive and workspace
+        self.cleanup()
+        self.source_zip = zipfile.ZipFile(self.epub_file)
+        self.rewritten_members = {}
+        self.spilled_members = {}
+        if self.memory_budget is not None:
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+            self.workspace = Path(
+                tempfile.mkdtemp(prefix=f"{self.book_name}-", dir=self.temp_dir)
+            )
 
     @staticmethod
-    def _add_stylesheet_to_html(html_file_path: Path, stylesheet_line: str):
-        with open(html_file_path, "r", encoding="utf-8", errors="ignore") as file:
-            content: str = file.read()
+    def _member_name(file_path: Path) -> str:
+        return posixpath.normpath(file_path.as_posix())
 
-        soup: bs = bs(content, "html.parser")
+    def _stage(self, name: str) -> ContextManager[Any]:
+        if self.stats is None:
+            return nullcontext()
+        return self.stats.stage(name)
 
-        # Find the head section or create if not present
-        head: Optional[Tag | NavigableString] = soup.find("head")
-        if not head or type(head) is NavigableString:
-            head = soup.new_tag("head")  # type: ignore
-            soup.html.insert(0, head)  # type: ignore
+    def _count(self, name: str, n: int = 1) -> None:
+        if self.stats is not None:
+            self.stats.count(name, n)
 
-        # Add the stylesheet line inside the head section
-        head.append(bs(stylesheet_line, "html.parser").contents[0])
+    def _read_bytes(self, file_path: Path) -> bytes:
+        content: bytes
+        if not self.streaming:
+            content = file_path.read_bytes()
+        else:
+            assert self.source_zip is not None
+            name: str = self._member_name(file_path)
+            if name in self.spilled_members:
+                content = self.spilled_members[name].read_bytes()
+            elif name in self.rewritten_members:
+                content = self.rewritten_members[name]
+            else:
+                content = self.source_zip.read(name)
+        self._count("bytes_read", len(content))
+        return content
+
+    def _read_text(self, file_path: Path) -> str:
+        if not self.streaming:
+            if self.stats is not None:
+                self.stats.count("bytes_read", file_path.stat().st_size)
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
+                return file.read()
+        # same newline and error handling as reading the extracted file
+        with io.TextIOWrapper(
+            io.BytesIO(self._read_bytes(file_path)), encoding="utf-8", errors="ignore"
+        ) as file:
+            return file.read()
+
+    def _write_bytes(self, file_path: Path, content: bytes) -> None:
+        self._count("bytes_written", len(content))
+        if not self.streaming:
+            with open(file_path, "wb") as file:
+                file.write(content)
+            return
+        name: str = self._member_name(file_path)
+        if self.workspace is not None:
+            spilled: Path = self.spilled_members.setdefault(
+                name, self.workspace / str(len(self.spilled_members))
+            )
+            spilled.write_bytes(content)
+            return
+        self.rewritten_members[name] = content
 
-        with open(html_file_path, "w", encoding="utf-8", errors="ignore") as file:
-            file.write(str(soup))
+    def _write_text(self, file_path: Path, content: str) -> None:
+        if not self.streaming:
+            with open(file_path, "w", encoding="utf-8", errors="ignore") as file:
+                file.write(content)
+            if self.stats is not None:
+                self.stats.count("bytes_written", file_path.stat().st_size)
+            return
+        self._write_bytes(file_path, content.encode("utf-8", errors="ignore"))
 
     def make_epub_values(self) -> None:
         """
         setups:
-          1. extract the epub files
+          1. extract the epub files (or open it when streaming)
           2. make the file dict
           3. find the key file -> opf file
           4. find if has css file and make all css files to list
         """
-        self.extract_one_epub_to_dir()
-        self.files_dict = make_epub_files_dict(self.book_path)
+        if self.streaming:
+            self.open_one_epub_archive()
+            assert self.source_zip is not None
+            self.files_dict = make_zip_files_dict(self.source_zip)
+        else:
+            self.extract_one_epub_to_dir()
+            self.files_dict = make_epub_files_dict(self.book_path)
         self.content_files_list = (
             self.files_dict.get(".html", [])
             + self.files_dict.get(".xhtml", [])
@@ -139,41 +593,60 @@ class EPUBHV:
         opf_files = self.files_dict.get(".opf", [])
         assert len(opf_files) == 1, "Epub must have only one opf file"
         self.opf_file = opf_files[0]
-        self.opf_dir = self.opf_file.parent.absolute()
-
-    def __detect_language(self):
-        c = Counter()
-        for f in self.content_files_list:
-            with open(f, "r", encoding="utf-8", errors="ignore") as f:
-                content: str = f.read()
-            sp: bs = bs(content, "html.parser")
-            if sp.body:
-                body_text: str = sp.body.get_text()
-                try:
-                    language = detect(body_text)
-                    c[language] += 1
-                except LangDetectException:
-                    pass
+        if self.streaming:
+            self.opf_dir = self.opf_file.parent
+        else:
+            self.opf_dir = self.opf_file.parent.absolute()
+
+    def read_package(self) -> Package:
+        with self._stage("opf"):
+            return Package(self._read_bytes(self.opf_file))
+
+    def spine_files(self, package: Package) -> List[Path]:
+        """
+        the content files in reading order, from the spine of the opf file
+        """
+        key = self._member_name if self.streaming else os.path.abspath
+        content_files: Dict[str, Path] = {key(f): f for f in self.content_files_list}
+        manifest: Dict[str, str] = {i.id: i.href for i in package.items}
+        files: List[Path] = []
+        for idref in package.spine:
+            href: str = unquote(manifest.get(idref, ""))
+            f: Optional[Path] = content_files.get(key(self.opf_dir / href))
+            if href and f is not None and f not in files:
+                files.append(f)
+        return files or self.content_files_list
+
+    def __detect_language(self, package: Package):
+        samples: List[Path] = pick_samples(
+            self.spine_files(package), self.language_detector.samples
+        )
+        c = self.language_detector.detect(self._read_text(f) for f in samples)
         if c:
             language = c.most_common()[0][0]
             # WTF sometimes Chinese will detect as ko?
             # TODO change to a better detect
-            if language in ["ko", "zh-tw"]:
+            if language in ["ko"]:
                 self.ruby_language = "cantonese" if self.cantonese else language
                 self.need_ruby = True
             elif language in ["ja"]:
                 self.ruby_language = "ja"
                 self.need_ruby = True
+            elif language in ["zh-tw"]:
+                # the script check finds most traditional Chinese books, they
+                # get the same pinyin as simplified, or jyutping
+                self.ruby_language = "cantonese" if self.cantonese else "zh"
+                self.need_ruby = True
             elif language in ["zh", "zh-cn"]:
                 self.ruby_language = "zh"
                 self.need_ruby = True
 
-    def _make_ruby_language(self, soup):
+    def _make_ruby_language(self, package: Package):
         if self.need_ruby:
             # if we need ruby we need to find the ruby language
-            languages = soup.find("dc:language")
+            languages = package.languages
             if languages and 0:
-                language = languages.contents[0]
+                language = languages[0]
                 if language in ["ja", "zh", "zh-cn"]:
                     self.ruby_language = language
                     self.need_ruby = True
@@ -183,13 +656,25 @@ class EPUBHV:
                     )
                     self.need_ruby = False
             else:
-                self.__detect_language()
+                with self._stage("detect_language"):
+                    self.__detect_language(package)
                 if not self.ruby_language:
                     print(
                         "There's no language meta data in meta file and can not detect the language, we use Japanese as default. we can not ruby it"
                     )
                     self.need_ruby = False
 
+    def _rewrite_css(
+        self, css: Path, rewrite: Callable[[bytes, Optional[Path]], Optional[bytes]]
+    ) -> None:
+        with self._stage("stylesheets"):
+            # the path is only used by cssutils, to resolve `@import`
+            new_css: Optional[bytes] = rewrite(
+                self._read_bytes(css), None if self.streaming else css
+            )
+            if new_css is not None:
+                self._write_bytes(css, new_css)
+
     def change_epub_to_vertical(self) -> None:
         """
         steps:
@@ -201,83 +686,47 @@ class EPUBHV:
           6. if have not `html` we add it
           7. if we do not have css file, we add one with html `vertical-rl` and change all the html to add the css files
         """
-        soup: bs = load_opf_meta_data(self.opf_file)
-        self._make_ruby_language(soup)
-        # change it to rtl -> right to left
-        spine: Optional[Tag | NavigableString] = soup.find("spine")
-        assert spine is not None
-        if spine.attrs.get("page-progression-direction", "") != "rtl":  # type: ignore
-            spine.attrs["page-progression-direction"] = "rtl"  # type: ignore
-        meta_list: ResultSet[Tag] = soup.find_all("meta")
-        for m in meta_list:
-            if m.attrs.get("name", "") == "primary-writing-mode":
-                m.attrs["content"] = "vertical-rl"
-        else:
-            meta_list.append(bs(V_STYLE_LINE_IN_OPF, "xml").contents[0])  # type: ignore
-
-        manifest: Tag = soup.find_all("manifest")[0]
-        items = [i for i in manifest.find_all("item")]
+        package: Package = self.read_package()
+        self._make_ruby_language(package)
+        new_item: Optional[str] = None
         self.css_files = [
-            self.opf_dir / Path(i.attrs.get("href", ""))
-            for i in items
-            if i.attrs.get("media-type", "") == "text/css"
+            self.opf_dir / Path(i.href)
+            for i in package.items
+            if i.media_type == "text/css"
         ]
         self.has_css_file = len(self.css_files) > 0
         if self.has_css_file:
             css: Path
             for css in self.css_files:
-                c: CSSParser = CSSParser()
-                p: CSSStyleSheet = c.parseFile(css)  # type: ignore
-                has_html_or_body: bool = False
-                for s in p.cssRules.rulesOfType(1):  # type: ignore
-                    if s.selectorText == "html":  # type: ignore
-                        has_html_or_body = True
-                        for w in WRITING_KEY_LIST:
-                            if w not in s.style.keys():  # type: ignore
-                                # set it to vertical
-                                s.style[w] = "vertical-rl"  # type: ignore
-                if not has_html_or_body:
-                    p.add(  # type: ignore
-                        """
-                        html {
-                            -epub-writing-mode: vertical-rl;
-                            writing-mode: vertical-rl;
-                            -webkit-writing-mode: vertical-rl;
-                        }
-                        """
-                    )
-                css_style = p.cssText  # type: ignore
-                with open(css, "wb") as file:
-                    file.write(css_style)  # type: ignore
+                # add vertical-rl to the `html` rule, or add the rule
+                self._rewrite_css(css, to_vertical)
         else:
             # if we have no css file in the epub than we create one.
             style_path: Path = Path(self.opf_dir) / Path("Style")
-            if not style_path.exists():
+            if not self.streaming and not style_path.exists():
                 os.mkdir(style_path)
             new_css_file: Path = style_path / Path("style.css")
-            with open(new_css_file, "w", encoding="utf-8", errors="ignore") as file:
-                file.write(
-                    """
+            self._write_text(
+                new_css_file,
+                """
 @charset "utf-8";
 html {
   -epub-writing-mode: vertical-rl;
   writing-mode: vertical-rl;
   -webkit-writing-mode: vertical-rl;
 }
-                        """
-                )
-            # add css item to manifest items
-            soup.find_all("manifest")[0].append(
-                bs(V_ITEM_TO_ADD_IN_MANIFEST, "xml").contents[0]
+                        """,
             )
-            # then we need to change all html files
-            f: Path
-            for f in self.content_files_list:
-                self._add_stylesheet_to_html(
-                    html_file_path=f, stylesheet_line=V_STYLE_LINE
-                )
-        with open(self.opf_file, "w", encoding="utf-8", errors="ignore") as file:
-            file.write(str(soup))
+            # add css item to manifest items
+            new_item = V_ITEM_TO_ADD_IN_MANIFEST
+            # then we need to change all html files, it is done in `convert`
+            self.stylesheet_line = V_STYLE_LINE
+        # change it to rtl -> right to left, the opf is only written when
+        # it changes
+        with self._stage("opf"):
+            new_opf: Optional[bytes] = package.patch("rtl", "vertical-rl", new_item)
+            if new_opf is not None:
+                self._write_bytes(self.opf_file, new_opf)
 
     def change_epub_to_horizontal(self) -> None:
         """
@@ -287,130 +736,331 @@ html {
           3. check `primary-writing-mode` in opf file's meta, if have change it to horizontal-rl, if not add it.
           4. check all css files and remove all "writing-mode", "-webkit-writing-mode", "-epub-writing-mode" to make it default that is horizontal
         """
-        soup: bs = load_opf_meta_data(self.opf_file)
-        self._make_ruby_language(soup)
-        # change it to ltr -> left to right
-        spine: Optional[Tag | NavigableString] = soup.find("spine")
-        assert spine is not None
-        if spine.attrs.get("page-progression-direction", "") != "ltr":  # type: ignore
-            spine.attrs["page-progression-direction"] = "ltr"  # type: ignore
-        meta_list: ResultSet[Tag] = soup.find_all("meta")
-        for m in meta_list:
-            if m.attrs.get("name", "") == "primary-writing-mode":
-                m.attrs["content"] = "horizontal-lr"
-        else:
-            meta_list.append(bs(H_STYLE_LINE_IN_OPF, "xml").contents[0])  # type: ignore
-        with open(self.opf_file, "w", encoding="utf-8", errors="ignore") as file:
-            file.write(str(soup))
+        package: Package = self.read_package()
+        self._make_ruby_language(package)
+        # change it to ltr -> left to right, the opf is only written when it
+        # changes
+        with self._stage("opf"):
+            new_opf: Optional[bytes] = package.patch("ltr", "horizontal-lr")
+            if new_opf is not None:
+                self._write_bytes(self.opf_file, new_opf)
 
-        manifest: Tag = soup.find_all("manifest")[0]
-        items = [i for i in manifest.find_all("item")]
         self.css_files = [
-            self.opf_dir / Path(i.attrs.get("href", ""))
-            for i in items
-            if i.attrs.get("media-type", "") == "text/css"
+            self.opf_dir / Path(i.href)
+            for i in package.items
+            if i.media_type == "text/css"
         ]
         self.has_css_file = len(self.css_files) > 0
         if self.has_css_file:
             for css in self.css_files:
-                c: CSSParser = CSSParser()
-                p: CSSStyleSheet = c.parseFile(css)  # type: ignore
-                for s in p.cssRules.rulesOfType(1):  # type: ignore
-                    for k in s.style.keys():  # type: ignore
-                        if k in WRITING_KEY_LIST:
-                            del s.style[k]  # type: ignore
-                css_style = p.cssText  # type: ignore
-                with open(css, "wb") as file:
-                    file.write(css_style)  # type: ignore
+                self._rewrite_css(css, to_horizontal)
+
+    def document_options(self, method: str = "to_vertical") -> DocumentOptions:
+        punctuation: str = self.convert_punctuation
+        if punctuation == "auto":
+            if self.convert_to is None:
+                # default: convert “‘’” to 「『』」 in vertical mode,
+                # but not to “‘’” in horizontal mode
+                punctuation = "s2t" if method == "to_vertical" else "t2t"
+            else:
+                punctuation = self.convert_to
+        return DocumentOptions(
+            stylesheet_line=self.stylesheet_line,
+            convert_to=self.convert_to,
+            punctuation=punctuation,
+            horizontal=method == "to_horizontal",
+            ruby_language=self.ruby_language if self.need_ruby else None,
+            parser=self.parser,
+            yomi_cache_path=self.yomi_cache_path,
+            ruby_emit=self.ruby_emit,
+            ruby_scope=self.ruby_scope,
+            release_trees=self.memory_budget is not None,
+        )
 
     def convert(self, method: str = "to_vertical") -> None:
-        if self.converter is None and not self.need_ruby:
+        """
+        convert all the content documents, with `document_workers` > 1 the
+        documents are converted by a process pool, `document_chunksize`
+        documents at a time, the results are the same as the serial path.
+        With a memory budget no document is started while over it.
+        """
+        if self.converter is None and not self.need_ruby and not self.stylesheet_line:
             return
 
-        html_file: Path
-        for html_file in self.content_files_list:
-            with open(html_file, "r", encoding="utf-8", errors="ignore") as f:
-                content: str = f.read()
-            soup: bs = bs(content, "html.parser")
-            if self.converter:
-                html_element = soup.find("html")
-                assert isinstance(html_element, Tag)
-                text_elements: ResultSet[PageElement] = html_element.find_all(
-                    string=True
-                )  # type: ignore
-
-                element: Tag
-                for element in text_elements:  # type: ignore
-                    old_text = element.string
-                    if old_text is not None:
-                        new_text = self.converter.convert(old_text)  # type: ignore
-                        punc = self.convert_punctuation
-                        if punc != "none":
-                            if punc == "auto":
-                                if self.convert_to is None:
-                                    punc = "s2t" if method == "to_vertical" else "t2t"
-                                    # default: convert “‘’” to 「『』」 in vertical mode,
-                                    # but not to “‘’” in horizontal mode
-                                else:
-                                    punc = self.convert_to
-                            source, target = punc.split("2")
-                            punc_converter = Punctuation()
-                            new_text = punc_converter.convert(  # type: ignore
-                                new_text,
-                                horizontal=method == "to_horizontal",
-                                source_locale=punc_converter.map_locale(source),  # type: ignore
-                                target_locale=punc_converter.map_locale(target),  # type: ignore
+        options: DocumentOptions = self.document_options(method)
+        html_files: List[Path] = self.content_files_list
+        keys: Dict[Path, str] = {}
+        self.documents_changed = 0
+        if self.document_cache is not None:
+            html_files = []
+            for html_file in self.content_files_list:
+                content: str = self._read_text(html_file)
+                # released trees do not change the output
+                key: str = self.document_cache.document_key(
+                    content, options._replace(release_trees=False)
+                )
+                cached: Optional[bytes] = self.document_cache.load(key)
+                if cached is None:
+                    keys[html_file] = key
+                    html_files.append(html_file)
+                else:
+                    if cached:
+                        self._write_text(html_file, cached.decode("utf-8"))
+                        self.documents_changed += 1
+                    if self.stats is not None:
+                        self.stats.add_document(
+                            DocumentStats(
+                                self._document_name(html_file),
+                                Timing(),
+                                changed=bool(cached),
+                                cached=True,
                             )
-                    element.string.replace_with(new_text)  # type: ignore
-                    html_element.replace_with(html_element)
+                        )
+        self.documents_reused = len(self.content_files_list) - len(html_files)
+        self.documents_recomputed = len(html_files)
 
-                with open(html_file, "w", encoding="utf-8") as file:
-                    html_element.replace_with(html_element)
+        html_file: Path
+        result: Tuple[Optional[str], Measurement]
+        if self.document_workers > 1 and len(html_files) > 1:
+            for html_file, result in self._convert_in_pool(html_files, options):
+                self._write_document(html_file, result, keys)
+        else:
+            for html_file in html_files:
+                if self.memory_budget is not None:
+                    self.memory_budget.check()
+                self._write_document(
+                    html_file,
+                    measure_document(self._read_text(html_file), options),
+                    keys,
+                )
+        if self.document_cache is not None:
+            self.document_cache.evict()
 
-                with open(html_file, "w", encoding="utf-8", errors="ignore") as file:
-                    file.write(soup.prettify())
-            if self.need_ruby:
-                ruby_soup = bs(
-                    content, "html.parser", string_containers=string_containers
+    def _convert_in_pool(
+        self, html_files: List[Path], options: DocumentOptions
+    ) -> Iterator[Tuple[Path, Tuple[Optional[str], Measurement]]]:
+        """
+        convert the documents in a process pool and yield the results in
+        order. A chunk is read only when it is sent to a worker, and at most
+        `max_documents_in_flight` documents are sent and not yielded yet, so
+        the memory does not grow with the size of the book
+        """
+        chunksize: int = self.document_chunksize
+        max_in_flight: int = (
+            self.max_documents_in_flight or 2 * self.document_workers * chunksize
+        )
+        budget: Optional[MemoryBudget] = self.memory_budget
+        files: Iterator[Path] = iter(html_files)
+        pending: Deque[Tuple[List[Path], "Future[Any]"]] = deque()
+        in_flight: int = 0
+        languages: Tuple[str, ...] = (
+            (options.ruby_language,) if options.ruby_language is not None else ()
+        )
+        conversions: Tuple[str, ...] = (
+            (options.convert_to,) if options.convert_to is not None else ()
+        )
+        with preloaded_executor(
+            self.document_workers, partial(warmup, languages, conversions, False)
+        ) as executor:
+            if budget is not None:
+                # the workers are started on demand, so ask for them each time
+                budget.pids = lambda: list(getattr(executor, "_processes", None) or ())
+            try:
+                while True:
+                    chunk: List[Path] = list(islice(files, chunksize))
+                    if not chunk and not pending:
+                        break
+                    # wait for the oldest chunk until there is room for this one
+                    while pending and (
+                        not chunk
+                        or in_flight + len(chunk) > max_in_flight
+                        or (budget is not None and budget.over())
+                    ):
+                        done, future = pending.popleft()
+                        in_flight -= len(done)
+                        yield from zip(done, future.result())
+                    if not chunk:
+                        continue
+                    if budget is not None:
+                        budget.check()
+                    contents: List[str] = [self._read_text(f) for f in chunk]
+                    pending.append(
+                        (chunk, executor.submit(convert_documents, contents, options))
+                    )
+                    in_flight += len(chunk)
+            finally:
+                if budget is not None:
+                    budget.pids = lambda: ()
+                for _, future in pending:
+                    future.cancel()
+
+    def _document_name(self, html_file: Path) -> str:
+        return Path(os.path.relpath(html_file, self.book_path)).as_posix()
+
+    def _write_document(
+        self,
+        html_file: Path,
+        result: Tuple[Optional[str], Measurement],
+        keys: Dict[Path, str],
+    ) -> None:
+        """
+        write a converted document, unchanged ones (None) are not written, so
+        they are copied to the new epub as they are
+        """
+        new_content, m = result
+        if self.stats is not None:
+            self.stats.add_document(
+                DocumentStats(
+                    self._document_name(html_file),
+                    m.timing,
+                    changed=new_content is not None,
+                    counters=dict(m.counters),
+                    steps=dict(m.steps),
                 )
-                # TODO fix this maybe support unruby
-                r = RubySoup(self.ruby_language, True)
-                r.ruby_soup(ruby_soup.body)
-                with open(html_file, "w", encoding="utf-8") as file:
-                    file.write(ruby_soup.prettify())
+            )
+        if new_content is not None:
+            self._write_text(html_file, new_content)
+            self.documents_changed += 1
+        if self.document_cache is not None:
+            # an empty entry is an unchanged document
+            self.document_cache.save(
+                keys[html_file],
+                (new_content or "").encode("utf-8", errors="ignore"),
+            )
 
-    def pack(self, method: str = "to_vertical", dest: Path = Path.cwd()) -> Path:
+    def output_name(self, method: str = "to_vertical") -> str:
         lang = "original"
         if self.convert_to is not None:
             lang = self.convert_to
         if self.need_ruby:
             lang = f"{lang}-ruby"
         if method == "to_vertical":
-            book_name = f"{self.book_name}-v-{lang}.epub"
-        else:
-            book_name = f"{self.book_name}-h-{lang}.epub"
-        pack_to = dest / book_name
+            return f"{self.epub_file.stem}-v-{lang}.epub"
+        return f"{self.epub_file.stem}-h-{lang}.epub"
+
+    def cache_options(self) -> Dict[str, Any]:
+        """
+        the options which change the output, for the result cache key
+        """
+        return dict(
+            convert_to=self.convert_to,
+            convert_punctuation=self.convert_punctuation,
+            need_ruby=self.need_ruby,
+            need_cantonese=self.cantonese,
+            # lxml serializes the documents differently
+            parser=self.parser,
+            # the tokens are not the same across inline tags
+            ruby_scope=self.ruby_scope,
+            # they may detect another ruby language
+            language_detector=dict(
+                samples=self.language_detector.samples,
+                max_chars=self.language_detector.max_chars,
+                script_check=self.language_detector.script_check,
+            ),
+        )
+
+    def pack(self, method: str = "to_vertical", dest: Path = Path.cwd()) -> Path:
+        pack_to = dest / self.output_name(method)
 
+        if self.streaming:
+            self._pack_archive(pack_to)
+            return pack_to
         shutil.make_archive(
             base_name=str(pack_to), format="zip", root_dir=self.book_path
         )
         os.rename(src=f"{pack_to}.zip", dst=pack_to)
-        shutil.rmtree(self.book_path)
+        self.cleanup()
         return pack_to
 
+    def cleanup(self) -> None:
+        """
+        remove the workspace and close the source archive, it is safe to call
+        more than once
+        """
+        if self.workspace is not None:
+            shutil.rmtree(self.workspace, ignore_errors=True)
+            self.workspace = None
+        if self.source_zip is not None:
+            self.source_zip.close()
+            self.source_zip = None
+
+    def _pack_archive(self, pack_to: Path) -> None:
+        """
+        write the new epub from the source archive:
+          1. rewritten members are written with the same compression as before
+          2. other members are copied without recompressing
+          3. new members (like the added stylesheet) go to the end
+        """
+        assert self.source_zip is not None
+        rewritten: Dict[str, bytes] = dict(self.rewritten_members)
+        spilled: Dict[str, Path] = dict(self.spilled_members)
+        with self.source_zip, zipfile.ZipFile(pack_to, "w") as target:
+            for info in self.source_zip.infolist():
+                content: Optional[bytes] = rewritten.pop(info.filename, None)
+                if info.filename in spilled:
+                    content = spilled.pop(info.filename).read_bytes()
+                if content is None:
+                    copy_zip_member(self.source_zip, info, target)
+                    continue
+                new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                new_info.compress_type = info.compress_type
+                new_info.external_attr = info.external_attr
+                target.writestr(new_info, content)
+            for name, content in rewritten.items():
+                target.writestr(name, content, compress_type=zipfile.ZIP_DEFLATED)
+            for name, path in spilled.items():
+                target.writestr(
+                    name, path.read_bytes(), compress_type=zipfile.ZIP_DEFLATED
+                )
+        self.source_zip = None
+        self.rewritten_members = {}
+        self.spilled_members = {}
+
     def run(self, method: str = "to_vertical", dest: Path = Path.cwd()) -> Path:
         assert method in [
             "to_horizontal",
             "to_vertical",
         ], "must be to_horizontal or to_vertical."
-        ### make the basic epub value we need ###
-        self.make_epub_values()
-        if method == "to_vertical":
-            self.change_epub_to_vertical()
-        elif method == "to_horizontal":
-            self.change_epub_to_horizontal()
-        else:
-            raise Exception("Only support epub to vertical or horizontal for now")
+        if self.stats is not None:
+            self.stats.info.update(epub=str(self.epub_file), method=method)
+        cache_key: Optional[str] = None
+        if self.result_cache is not None:
+            with self._stage("cache"):
+                cache_key = self.result_cache.key(
+                    self.epub_file, method, self.cache_options()
+                )
+                # the name of the output depends on the detected language
+                name: Optional[str] = self.result_cache.output_name(cache_key)
+                pack_to: Path = dest / (name or self.output_name(method))
+                hit: bool = name is not None and self.result_cache.get(
+                    cache_key, pack_to
+                )
+            if hit:
+                self._count("result_cache_hits")
+                return pack_to
+        try:
+            ### make the basic epub value we need ###
+            with self._stage("extract"):
+                self.make_epub_values()
+            if method == "to_vertical":
+                self.change_epub_to_vertical()
+            elif method == "to_horizontal":
+                self.change_epub_to_horizontal()
+            else:
+                raise Exception("Only support epub to vertical or horizontal for now")
 
-        self.convert(method=method)
-        return self.pack(method=method, dest=dest)
+            with self._stage("documents"):
+                self.convert(method=method)
+            with self._stage("pack"):
+                output: Path = self.pack(method=method, dest=dest)
+        finally:
+            # nothing is left behind when the conversion fails
+            self.cleanup()
+        if self.result_cache is not None and cache_key is not None:
+            with self._stage("cache"):
+                self.result_cache.put(cache_key, output)
+        self._count("documents", len(self.content_files_list))
+        self._count("documents_changed", self.documents_changed)
+        if self.stats is not None:
+            self.stats.info["output"] = str(output)
+        return output
@@ -0,0 +1,264 @@
+"""
+The lxml parser backend for content documents.
+
+It parses the (x)html as XML with lxml and walks the text nodes (`.text` and
+`.tail`) directly, which is much faster than the pure python `html.parser`
+with BeautifulSoup. Documents that are not well-formed XML are not parsed, so
+the caller can fall back to the BeautifulSoup backend.
+"""
+
+from typing import Callable, List, Optional, Tuple, Union
+
+from lxml import etree
+
+from epubhv.stats import step
+from epubhv.yomituki import RubySoup, inline_tags  # pyright: ignore
+
+# the text in these tags is not for reading, same as the string containers
+# in `yomituki`
+NO_RUBY_TAGS = ("ruby", "rt", "rp", "style", "script", "template")
+
+xml_parser = etree.XMLParser(
+    encoding="utf-8",
+    resolve_entities=False,
+    no_network=True,
+    remove_blank_text=False,
+    huge_tree=True,
+)
+
+
+def local_name(element: etree._Element) -> str:
+    return etree.QName(element).localname
+
+
+def new_element(like: etree._Element, name: str) -> etree._Element:
+    # new tags are in the same namespace as the document, so they are
+    # serialized without prefix
+    namespace: Optional[str] = etree.QName(like).namespace
+    return etree.Element(f"{{{namespace}}}{name}" if namespace else name)
+
+
+def find_element(root: etree._Element, name: str) -> Optional[etree._Element]:
+    for element in root.iter(etree.Element):
+        if local_name(element) == name:
+            return element
+    return None
+
+
+def add_stylesheet(root: etree._Element, stylesheet_line: str) -> None:
+    head: Optional[etree._Element] = find_element(root, "head")
+    if head is None:
+        head = new_element(root, "head")
+        root.insert(0, head)
+    line: etree._Element = etree.fromstring(stylesheet_line)
+    link: etree._Element = new_element(head, local_name(line))
+    for k, v in line.attrib.items():
+        link.set(k, v)
+    head.append(link)
+
+
+def convert_text(
+    root: etree._Element, convert: Callable[[List[str]], List[str]]
+) -> bool:
+    """
+    convert all the text and tails at once, same strings as
+    `find_all(string=True)`, return True if any of them changed
+    """
+    slots: List[Tuple[etree._Element, str]] = []
+    for element in root.iter(etree.Element, etree.Comment):
+        if element.text:
+            slots.append((element, "text"))
+        if element is not root and element.tail:
+            slots.append((element, "tail"))
+    texts: List[str] = [getattr(element, name) for element, name in slots]
+    changed: bool = False
+    for (element, name), text, new_text in zip(slots, texts, convert(texts)):
+        if new_text != text:
+            setattr(element, name, new_text)
+            changed = True
+    return changed
+
+
+class RubyTree:
+    """
+    same as `RubySoup.ruby_soup` but for the lxml tree
+    """
+
+    def __init__(self, ruby: RubySoup) -> None:
+        self.ruby = ruby
+
+    def ruby_element(self, like: etree._Element, yomis: List[tuple]) -> etree._Element:
+        ruby_tag: etree._Element = new_element(like, "ruby")
+        last: Optional[etree._Element] = None
+        for text, yomi in yomis:
+            if last is None:
+                ruby_tag.text = (ruby_tag.text or "") + text
+            else:
+                last.tail = (last.tail or "") + text
+            names = ("rp", "rt", "rp") if self.ruby.is_ruby_rp else ("rt",)
+            contents = ("(", yomi, ")") if self.ruby.is_ruby_rp else (yomi,)
+            for name, content in zip(names, contents):
+                last = new_element(like, name)
+                last.text = content
+                ruby_tag.append(last)
+        return ruby_tag
+
+    def ruby_parts(
+        self, like: etree._Element, string: str
+    ) -> Optional[List[Union[str, etree._Element]]]:
+        """
+        the new parts of the string, None if it does not change
+        """
+        return self.pieces_parts(like, string, list(self.ruby.ruby_string(string)))
+
+    def pieces_parts(
+        self, like: etree._Element, string: str, pieces: list
+    ) -> Optional[List[Union[str, etree._Element]]]:
+        if all(isinstance(p, str) for p in pieces) and "".join(pieces) == string:
+            return None
+        parts: List[Union[str, etree._Element]] = []
+        for piece in pieces:
+            if isinstance(piece, str):
+                parts.append(piece)
+            else:
+                parts.append(self.ruby_element(like, piece))
+        return parts
+
+    @staticmethod
+    def splice(
+        parent: etree._Element,
+        index: int,
+        parts: List[Union[str, etree._Element]],
+    ) -> Optional[str]:
+        """
+        insert the parts into parent at index, return the leading text
+        """
+        leading: str = ""
+        last: Optional[etree._Element] = None
+        for part in parts:
+            if isinstance(part, str):
+                if last is None:
+                    leading += part
+                else:
+                    last.tail = (last.tail or "") + part
+            else:
+                parent.insert(index, part)
+                index += 1
+                last = part
+        return leading or None
+
+    def ruby_tree(self, element: etree._Element) -> bool:
+        """
+        ruby all the text in the element, return True if anything changed
+        """
+        if self.ruby.scope == "block":
+            return self.ruby_runs(element)
+        changed: bool = False
+        parts: Optional[List[Union[str, etree._Element]]]
+        if element.text and element.text.strip():
+            parts = self.ruby_parts(element, element.text)
+            if parts is not None:
+                element.text = self.splice(element, 0, parts)
+                changed = True
+        for child in list(element):
+            if not isinstance(child.tag, str):
+                # comments and processing instructions
+                pass
+            elif local_name(child) not in NO_RUBY_TAGS:
+                changed = self.ruby_tree(child) or changed
+            if child.tail and child.tail.strip():
+                parts = self.ruby_parts(element, child.tail)
+                if parts is not None:
+                    child.tail = self.splice(element, element.index(child) + 1, parts)
+                    changed = True
+        return changed
+
+    def ruby_runs(self, element: etree._Element) -> bool:
+        """
+        `ruby_tree` for the `block` scope, see `RubySoup.ruby_block`
+        """
+        runs: List[List[Tuple[etree._Element, str]]] = [[]]
+        self.text_runs(element, runs)
+        changed: bool = False
+        for run in runs:
+            strings: List[str] = [getattr(e, name) for e, name in run]
+            pieces: Optional[List[list]] = self.ruby.ruby_block(strings)
+            if pieces is None:
+                pieces = [list(self.ruby.ruby_string(s)) for s in strings]
+            for (e, name), string, string_pieces in zip(run, strings, pieces):
+                if not string.strip():
+                    continue
+                # the text is in e, a tail is in the parent of e
+                parent: etree._Element = e if name == "text" else e.getparent()
+                parts = self.pieces_parts(parent, string, string_pieces)
+                if parts is None:
+                    continue
+                index: int = 0 if name == "text" else parent.index(e) + 1
+                setattr(e, name, self.splice(parent, index, parts))
+                changed = True
+        return changed
+
+    def text_runs(
+        self, element: etree._Element, runs: List[List[Tuple[etree._Element, str]]]
+    ) -> None:
+        """
+        same as `RubySoup.text_runs`, a run is a list of (element, "text")
+        and (element, "tail")
+        """
+        if element.text:
+            runs[-1].append((element, "text"))
+        for child in element:
+            inline: bool = (
+                isinstance(child.tag, str) and local_name(child) in inline_tags
+            )
+            if inline:
+                self.text_runs(child, runs)
+            else:
+                if runs[-1]:
+                    runs.append([])
+                if isinstance(child.tag, str) and local_name(child) not in NO_RUBY_TAGS:
+                    self.text_runs(child, runs)
+                    if runs[-1]:
+                        runs.append([])
+            if child.tail:
+                runs[-1].append((child, "tail"))
+
+
+def parse_document(content: str) -> Optional[etree._Element]:
+    """
+    the root of the document, None if it is not well-formed XML
+    """
+    try:
+        return etree.fromstring(content.encode("utf-8", errors="ignore"), xml_parser)
+    except etree.XMLSyntaxError:
+        return None
+
+
+def convert_tree(
+    root: etree._Element,
+    stylesheet_line: Optional[str] = None,
+    convert: Optional[Callable[[List[str]], List[str]]] = None,
+    ruby: Optional[RubySoup] = None,
+) -> bool:
+    """
+    the lxml version of the stages of `convert_document`, return True if the
+    tree changed
+    """
+    changed: bool = False
+    if stylesheet_line is not None:
+        add_stylesheet(root, stylesheet_line)
+        changed = True
+    if convert is not None:
+        changed = convert_text(root, convert) or changed
+    if ruby is not None:
+        body: Optional[etree._Element] = find_element(root, "body")
+        if body is not None:
+            with step("ruby"):
+                changed = RubyTree(ruby).ruby_tree(body) or changed
+    return changed
+
+
+def serialize_document(root: etree._Element, xml_declaration: bool) -> str:
+    return etree.tostring(
+        root.getroottree(), encoding="utf-8", xml_declaration=xml_declaration
+    ).decode("utf-8")
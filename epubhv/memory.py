@@ -0,0 +1,83 @@
+"""
+Keep the memory of a conversion under a budget.
+
+`MemoryBudget` adds up the resident memory of this process and of its
+document workers. A conversion checks it before it starts a document: when
+it is over, the garbage is collected first, then no new document is started
+until the ones in flight are done. If it is still over with nothing in
+flight the conversion fails with `MemoryBudgetExceeded`, instead of being
+killed by the OOM killer of the container.
+
+The language backends are in the budget too, jieba and the unidic
+dictionary of fugashi are more than a hundred MB. The workers forked by
+`epubhv.workers` share them, so the memory of a process is its proportional
+set size where Linux has it: a page shared by n processes counts 1/n in
+each of them.
+"""
+
+import gc
+import os
+from typing import Callable, Iterable, Optional
+
+from epubhv.stats import peak_rss
+
+PAGE_SIZE: int = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def rss(pid: Optional[int] = None) -> int:
+    """
+    resident memory of a process in bytes, from /proc on Linux. Elsewhere it
+    is the peak of this process, and 0 for the others
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss() if pid is None else 0
+
+
+def pss(pid: Optional[int] = None) -> int:
+    """
+    proportional set size of a process in bytes, its `rss` if it is unknown
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return rss(pid)
+
+
+class MemoryBudget:
+    def __init__(self, max_bytes: int) -> None:
+        """
+        max_bytes: resident memory of this process and its workers
+        """
+        assert max_bytes > 0, "memory budget must be positive"
+        self.max_bytes: int = max_bytes
+        # pids of the worker processes, set while a pool is running
+        self.pids: Callable[[], Iterable[int]] = lambda: ()
+
+    def used(self) -> int:
+        return pss() + sum(pss(pid) for pid in self.pids())
+
+    def over(self) -> bool:
+        """
+        True if the memory is over the budget, even after a collection
+        """
+        if self.used() <= self.max_bytes:
+            return False
+        gc.collect()
+        return self.used() > self.max_bytes
+
+    def check(self) -> None:
+        if self.over():
+            raise MemoryBudgetExceeded(
+                f"{self.used() >> 20}MiB is used, the budget is {self.max_bytes >> 20}MiB"
+            )
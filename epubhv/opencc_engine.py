@@ -0,0 +1,236 @@
+"""
+A compiled version of the opencc-python-reimplemented converter.
+
+`OpenCC` in the package keeps every phrase dictionary as a plain dict and, for
+every sentence, tries every substring length from the longest key down, then
+splits the sentence around the match and starts again on both sides. Here
+each dictionary is compiled once into:
+
+  - `table`: key -> value, with the first of the multiple values already picked
+  - `lengths`: first character -> the key lengths starting with it, longest
+    first, so we only look up substrings that can be keys
+  - `chars`: a `str.translate` table for the single character dictionaries
+
+and the compiled chain is pickled to the cache dir, so the next process does
+not need to parse the dictionary files again. The result is the same as
+`opencc.OpenCC(config).convert(text)`: taking the longest match first and
+then the longest match on each side is the same as taking all the matches by
+(longest, leftmost) and skipping the ones that overlap an earlier one.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import opencc
+
+# bump it when the compiled format changes
+ENGINE_VERSION: int = 1
+
+OPENCC_DIR: Path = Path(opencc.__file__).parent
+
+# same sentence separators as `opencc.OpenCC.split_chars_re`, no dictionary
+# key has them
+split_chars_re = re.compile(
+    r"(\s+|-|,|\.|\?|!|\*|　|，|。|、|；|：|？|！|…|“|”|‘|’|『|』|「|」|﹁|﹂|—|－|（|）|《|》|〈|〉|～|．|／|＼|︒|︑|︔|︓|︿|﹀|︹|︺|︙|︐|［|﹇|］|﹈|︕|︖|︰|︳|︴|︽|︾|︵|︶|｛|︷|｝|︸|﹃|﹄|【|︻|】|︼)"
+)
+
+
+def default_cache_dir() -> Path:
+    return (
+        Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+        / "epubhv"
+        / "opencc"
+    )
+
+
+class Dictionary(NamedTuple):
+    table: Dict[str, str]
+    lengths: Dict[str, Tuple[int, ...]]
+    chars: Dict[int, str]
+    max_len: int
+
+
+def compile_dictionary(dict_file: Path) -> Dictionary:
+    table: Dict[str, str] = {}
+    with open(dict_file, encoding="utf-8") as f:
+        for line in f:
+            key, value = line.strip().split("\t")
+            # multiple mapping, use the first one like `OpenCC`
+            table[key] = value.split(" ")[0]
+    key_lengths: Dict[str, set] = {}
+    for key in table:
+        key_lengths.setdefault(key[0], set()).add(len(key))
+    lengths: Dict[str, Tuple[int, ...]] = {
+        ch: tuple(sorted(ls, reverse=True)) for ch, ls in key_lengths.items()
+    }
+    max_len: int = max(map(len, table), default=1)
+    chars: Dict[int, str] = {}
+    if max_len == 1:
+        chars = {ord(k): v for k, v in table.items()}
+    return Dictionary(table, lengths, chars, max_len)
+
+
+def find_matches(d: Dictionary, string: str) -> List[Tuple[int, int]]:
+    """
+    the (start, end) of the matches in `string`, sorted by start
+    """
+    table: Dict[str, str] = d.table
+    lengths: Dict[str, Tuple[int, ...]] = d.lengths
+    n: int = len(string)
+    candidates: List[Tuple[int, int]] = []
+    longest: int = 0
+    for i, ch in enumerate(string):
+        for length in lengths.get(ch, ()):
+            if i + length <= n and string[i : i + length] in table:
+                candidates.append((-length, i))
+                if length > longest:
+                    longest = length
+    if longest <= 1:
+        # nothing can overlap
+        return [(i, i + 1) for _, i in candidates]
+    candidates.sort()
+    taken: bytearray = bytearray(n)
+    matches: List[Tuple[int, int]] = []
+    for length, i in candidates:
+        end: int = i - length
+        if not any(taken[i:end]):
+            taken[i:end] = b"\x01" * (end - i)
+            matches.append((i, end))
+    matches.sort()
+    return matches
+
+
+def replace(d: Dictionary, string: str) -> str:
+    if d.max_len == 1:
+        return string.translate(d.chars)
+    pieces: List[str] = []
+    last: int = 0
+    for start, end in find_matches(d, string):
+        pieces.append(string[last:start])
+        pieces.append(d.table[string[start:end]])
+        last = end
+    pieces.append(string[last:])
+    return "".join(pieces)
+
+
+def replace_group(group: List[Dictionary], string: str) -> str:
+    """
+    a group of dictionaries: the parts matched by one dictionary are not
+    matched again by the next ones
+    """
+    # (text, done)
+    pieces: List[Tuple[str, bool]] = [(string, False)]
+    for d in group[:-1]:
+        new_pieces: List[Tuple[str, bool]] = []
+        for text, done in pieces:
+            if done or not text:
+                new_pieces.append((text, done))
+                continue
+            last: int = 0
+            for start, end in find_matches(d, text):
+                new_pieces.append((text[last:start], False))
+                new_pieces.append((d.table[text[start:end]], True))
+                last = end
+            new_pieces.append((text[last:], False))
+        pieces = new_pieces
+    return "".join(
+        text if done or not text else replace(group[-1], text) for text, done in pieces
+    )
+
+
+class CompiledOpenCC:
+    """
+    drop-in for `opencc.OpenCC(config)`, only `convert` is supported
+    """
+
+    def __init__(self, conversion: str, chain: List[List[Dictionary]]) -> None:
+        self.conversion: str = conversion
+        self.chain: List[List[Dictionary]] = chain
+
+    def convert_segment(self, string: str) -> str:
+        for group in self.chain:
+            if len(group) == 1:
+                string = replace(group[0], string)
+            else:
+                string = replace_group(group, string)
+        return string
+
+    def convert(self, string: str) -> str:
+        return "".join(
+            piece if i % 2 else self.convert_segment(piece)
+            for i, piece in enumerate(split_chars_re.split(string))
+        )
+
+
+def available_conversions() -> List[str]:
+    return sorted(path.stem for path in (OPENCC_DIR / "config").glob("*.json"))
+
+
+def config_files(conversion: str) -> Tuple[Path, List[List[Path]]]:
+    config_file: Path = OPENCC_DIR / "config" / f"{conversion}.json"
+    with open(config_file, encoding="utf-8") as f:
+        setting: dict = json.load(f)
+    chain: List[List[Path]] = []
+    for step in setting["conversion_chain"]:
+        d: dict = step["dict"]
+        dicts: List[dict] = d["dicts"] if d.get("type") == "group" else [d]
+        chain.append([OPENCC_DIR / "dictionary" / x["file"] for x in dicts])
+    return config_file, chain
+
+
+def cache_key(conversion: str, files: List[Path]) -> str:
+    h = hashlib.sha1(f"{ENGINE_VERSION} {conversion}".encode("utf-8"))
+    for file in files:
+        stat = os.stat(file)
+        h.update(f" {file.name} {stat.st_size} {stat.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def compile_config(conversion: str, cache_dir: Optional[Path] = None) -> CompiledOpenCC:
+    """
+    compile the config, or load it from the cache dir if it is there
+    """
+    config_file, chain_files = config_files(conversion)
+    files: List[Path] = [config_file] + [f for group in chain_files for f in group]
+    cache_file: Optional[Path] = None
+    if cache_dir is not None:
+        cache_file = cache_dir / f"{conversion}-{cache_key(conversion, files)}.pickle"
+        try:
+            with open(cache_file, "rb") as f:
+                return CompiledOpenCC(conversion, pickle.load(f))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    compiled: Dict[Path, Dictionary] = {}
+    chain: List[List[Dictionary]] = []
+    for group in chain_files:
+        for file in group:
+            if file not in compiled:
+                compiled[file] = compile_dictionary(file)
+        chain.append([compiled[file] for file in group])
+
+    if cache_file is not None:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp: Path = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump(chain, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_file)
+        except OSError:
+            # a read-only home is fine, we just compile again next time
+            pass
+    return CompiledOpenCC(conversion, chain)
+
+
+@lru_cache(maxsize=None)
+def load_opencc(conversion: str) -> CompiledOpenCC:
+    """
+    one compiled converter per config for the whole process
+    """
+    return compile_config(conversion, default_cache_dir())
@@ -0,0 +1,156 @@
+"""
+Read and patch the package document (the opf file) in one pass.
+
+The opf is scanned tag by tag with a regex, no tree is built and the text
+between the tags is never parsed, so a comic book with tens of thousands of
+manifest items is read quickly and only its items are kept. A patch is a
+few edits of attribute values, the rest of the bytes are written as is.
+"""
+
+import html
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# comments, CDATA, processing instructions and doctype are skipped, the
+# last one is a start or end tag: `/`, name and the attributes
+TAG_RE = re.compile(
+    rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!.*?>"
+    rb"""|<(/?)([^\s/>!?]+)((?:[^>"']|"[^"]*"|'[^']*')*)>""",
+    re.S,
+)
+ATTRIBUTE_RE = re.compile(rb"""([^\s=/]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+
+class Attribute(NamedTuple):
+    value: str
+    # the raw value between the quotes
+    start: int
+    end: int
+
+
+class StartTag(NamedTuple):
+    attrs: Dict[str, Attribute]
+    # where a new attribute goes, after the last one
+    attrs_end: int
+
+
+class ManifestItem(NamedTuple):
+    id: str
+    href: str
+    media_type: str
+
+
+def decode(raw: bytes) -> str:
+    return html.unescape(raw.decode("utf-8", errors="ignore"))
+
+
+def start_tag(data: bytes, m: "re.Match[bytes]") -> StartTag:
+    attrs: Dict[str, Attribute] = {}
+    attrs_end: int = m.end(2)
+    for a in ATTRIBUTE_RE.finditer(data, m.start(3), m.end(3)):
+        group: int = 2 if a.group(2) is not None else 3
+        attrs[decode(a.group(1))] = Attribute(
+            decode(a.group(group)), a.start(group), a.end(group)
+        )
+        attrs_end = a.end()
+    return StartTag(attrs, attrs_end)
+
+
+class Package:
+    def __init__(self, data: bytes) -> None:
+        """
+        data: the bytes of the opf file
+        """
+        self.data: bytes = data
+        self.items: List[ManifestItem] = []
+        # idref of the itemrefs in reading order
+        self.spine: List[str] = []
+        self.languages: List[str] = []
+        self.spine_tag: Optional[StartTag] = None
+        # the `primary-writing-mode` metas
+        self.writing_modes: List[StartTag] = []
+        # where the manifest ends, new items go there
+        self.manifest_end: Optional[int] = None
+        self.manifest_prefix: str = ""
+        self.scan()
+
+    def scan(self) -> None:
+        data: bytes = self.data
+        language_start: Optional[int] = None
+        for m in TAG_RE.finditer(data):
+            name: Optional[bytes] = m.group(2)
+            if name is None:
+                continue
+            prefix, _, local = name.rpartition(b":")
+            if m.group(1):
+                if local == b"manifest" and self.manifest_end is None:
+                    self.manifest_end = m.start()
+                    self.manifest_prefix = decode(prefix + b":" if prefix else b"")
+                elif local == b"language" and language_start is not None:
+                    self.languages.append(decode(data[language_start : m.start()]))
+                    language_start = None
+                continue
+            if local == b"item":
+                attrs = start_tag(data, m).attrs
+                self.items.append(
+                    ManifestItem(
+                        *(
+                            attrs[k].value if k in attrs else ""
+                            for k in ("id", "href", "media-type")
+                        )
+                    )
+                )
+            elif local == b"itemref":
+                attrs = start_tag(data, m).attrs
+                self.spine.append(attrs["idref"].value if "idref" in attrs else "")
+            elif local == b"spine" and self.spine_tag is None:
+                self.spine_tag = start_tag(data, m)
+            elif local == b"meta" and b"primary-writing-mode" in m.group(3):
+                tag: StartTag = start_tag(data, m)
+                if "name" in tag.attrs:
+                    if tag.attrs["name"].value == "primary-writing-mode":
+                        self.writing_modes.append(tag)
+            elif local == b"language" and prefix == b"dc":
+                language_start = m.end()
+
+    def patch(
+        self,
+        direction: str,
+        writing_mode: str,
+        new_item: Optional[str] = None,
+    ) -> Optional[bytes]:
+        """
+        set the `page-progression-direction` of the spine and the existing
+        `primary-writing-mode` metas, and add new_item to the manifest.
+        None if nothing changed.
+        """
+        edits: List[Tuple[int, int, bytes]] = []
+
+        def set_attribute(tag: StartTag, name: str, value: str) -> None:
+            if name not in tag.attrs:
+                edits.append(
+                    (tag.attrs_end, tag.attrs_end, f' {name}="{value}"'.encode())
+                )
+            elif tag.attrs[name].value != value:
+                edits.append(
+                    (tag.attrs[name].start, tag.attrs[name].end, value.encode())
+                )
+
+        assert self.spine_tag is not None, "opf file must have a spine"
+        set_attribute(self.spine_tag, "page-progression-direction", direction)
+        for meta in self.writing_modes:
+            set_attribute(meta, "content", writing_mode)
+        if new_item is not None:
+            assert self.manifest_end is not None, "opf file must have a manifest"
+            item: str = new_item.replace("<", f"<{self.manifest_prefix}", 1)
+            edits.append((self.manifest_end, self.manifest_end, item.encode()))
+        if not edits:
+            return None
+        edits.sort()
+        parts: List[bytes] = []
+        last: int = 0
+        for start, end, new in edits:
+            parts += [self.data[last:start], new]
+            last = end
+        parts.append(self.data[last:])
+        return b"".join(parts)
@@ -1,59 +1,91 @@
 import re
-from typing import Dict, Literal
+from functools import lru_cache
+from typing import Dict, List, Literal
+
+
+@lru_cache(maxsize=None)
+def translation_table(
+    horizontal: bool, source_locale: str, target_locale: str
+) -> Dict[int, str]:
+    """
+    all the replacements of `Punctuation.replacement_chain` in one table for
+    `str.translate`, so a text only needs one pass. Every replacement maps a
+    single character, so the chain is the composition of them.
+    """
+    chain: List[Dict[str, str]] = Punctuation.replacement_chain(
+        horizontal, source_locale, target_locale
+    )
+    table: Dict[int, str] = {}
+    for ch in {k for replacement_dict in chain for k in replacement_dict}:
+        new_ch: str = ch
+        for replacement_dict in chain:
+            new_ch = replacement_dict.get(new_ch, new_ch)
+        if new_ch != ch:
+            table[ord(ch)] = new_ch
+    return table
 
 
 class Punctuation:
     def convert(
         self, text: str, horizontal: bool, source_locale: str, target_locale: str
     ) -> str:
+        return text.translate(
+            translation_table(horizontal, source_locale, target_locale)
+        )
+
+    @staticmethod
+    def replacement_chain(
+        horizontal: bool, source_locale: str, target_locale: str
+    ) -> List[Dict[str, str]]:
+        """
+        the replacements in order, each one is done at the same time for all
+        its keys
+        """
+        chain: List[Dict[str, str]] = []
         if horizontal:
             # Horizontal punctuations will be displayed as vertical
             # punctuations in vertical writing mode (but not vice versa),
             # so we'll just use horizontal ones.
-            text = self.batch_replace(
-                text=text,
-                replacement_dict={
+            chain.append(
+                {
                     "﹁": "「",
                     "﹂": "」",
                     "﹃": "『",
                     "﹄": "』",
-                },
+                }
             )
         if source_locale != target_locale:
             if source_locale == "hans":
-                text = self.batch_replace(
-                    text=text,
-                    replacement_dict={
+                chain.append(
+                    {
                         "‘": "「",
                         "’": "」",
                         "“": "『",
                         "”": "』",
-                    },
+                    }
                 )
 
             # swap single quotes with double quotes
-            text = self.batch_replace(
-                text=text,
-                replacement_dict={
+            chain.append(
+                {
                     "『": "「",
                     "』": "」",
                     "「": "『",
                     "」": "』",
-                },
+                }
             )
 
             if target_locale == "hans" and horizontal:
-                text = self.batch_replace(
-                    text=text,
-                    replacement_dict={
+                chain.append(
+                    {
                         "「": "‘",
                         "」": "’",
                         "『": "“",
                         "』": "”",
-                    },
+                    }
                 )
 
-        return text
+        return chain
 
     def map_locale(self, x: str) -> Literal["hans", "hant"]:
         if x in ["s", "sp"]:
@@ -0,0 +1,606 @@
+"""
+A local HTTP conversion service.
+
+    epubhv-server --port 8000 --workers 2 --max-queue 8
+
+    POST   /jobs?method=to_vertical&convert_to=s2t&ruby=1&name=book.epub
+           the body is the epub file
+           202 {"id": ..., "status": "queued"}, 503 when the queue is full
+    GET    /jobs/<id>          the status of the job
+    GET    /jobs/<id>/result   the converted epub, streamed from disk
+    DELETE /jobs/<id>          remove the job and its files
+    GET    /health             the number of queued and running jobs
+
+The books are converted by a bounded process pool, the language backends,
+OpenCC dictionaries and langdetect profiles are loaded before the workers
+are forked, so no request pays for them and the workers share them, see
+`epubhv.workers`. At most `workers + max_queue` jobs are accepted at
+the same time, the others are refused with 503 and `Retry-After` instead of
+piling up in memory. Uploads and results go through files, the request
+threads never hold a whole book in memory.
+
+A job is sent to the pool only when a worker is free, so when a worker dies
+only the jobs it was running fail with the pool, they are tried once more,
+each on its own, in a new pool.
+"""
+
+import json
+import shutil
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import (
+    Any,
+    BinaryIO,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
+from urllib.parse import parse_qs, quote, urlsplit
+
+from epubhv.batch import BatchResult, convert_one_epub
+from epubhv.cache import ResultCache
+from epubhv.epubhv import PARSERS, warmup
+from epubhv.opencc_engine import available_conversions
+from epubhv.workers import preloaded_executor
+
+METHODS: List[str] = ["to_vertical", "to_horizontal"]
+PUNCTUATIONS: List[str] = ["auto", "t2s", "s2t", "none"]
+CHUNK_SIZE: int = 1 << 16
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id: str, workdir: Path) -> None:
+        self.id: str = job_id
+        self.workdir: Path = workdir
+        self.created: float = time.time()
+        self.finished: Optional[float] = None
+        # the arguments of `convert_one_epub`, once the upload is saved
+        self.args: Tuple[Any, ...] = ()
+        self.future: Optional[Future] = None
+        # the job was running in a pool which broke, it runs alone next time
+        self.retried: bool = False
+        self.result: Optional[BatchResult] = None
+        self.done: threading.Event = threading.Event()
+
+    @property
+    def status(self) -> str:
+        if self.result is not None:
+            return "done" if self.result.ok else "failed"
+        if self.future is not None and not self.future.done():
+            return "running"
+        return "queued"
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done.wait(timeout)
+
+    def info(self) -> Dict[str, Any]:
+        info: Dict[str, Any] = {"id": self.id, "status": self.status}
+        # `finish` sets finished before result, from another thread
+        result: Optional[BatchResult] = self.result
+        if result is not None:
+            if result.output is not None:
+                info["name"] = result.output.name
+            info["error"] = result.error
+            info["seconds"] = round(cast(float, self.finished) - self.created, 3)
+        return info
+
+
+def content_disposition(name: str) -> str:
+    """
+    the header of a download, headers are latin-1 so the name is sent as an
+    ASCII fallback and as UTF-8 (RFC 5987), without control characters and
+    quotes which could break the header
+    """
+    name = "".join(ch for ch in name if ch.isprintable() and ch not in '"\\')
+    fallback: str = "".join(ch if " " <= ch <= "~" else "_" for ch in name)
+    return (
+        f'attachment; filename="{fallback}"; '
+        f"filename*=UTF-8''{quote(name, safe='')}"
+    )
+
+
+def epub_options(query: Dict[str, List[str]]) -> Dict[str, Any]:
+    """
+    the `EPUBHV` options from the query string, ValueError if one is wrong
+    """
+
+    def get(name: str, default: str) -> str:
+        return query.get(name, [default])[-1]
+
+    convert_to: str = get("convert_to", "none")
+    if convert_to != "none" and convert_to not in available_conversions():
+        raise ValueError(f"unknown convert_to {convert_to}")
+    punctuation: str = get("punctuation", "auto")
+    if punctuation not in PUNCTUATIONS:
+        raise ValueError(f"unknown punctuation {punctuation}")
+    parser: str = get("parser", "html.parser")
+    if parser not in PARSERS:
+        raise ValueError(f"unknown parser {parser}")
+    return dict(
+        convert_to=None if convert_to == "none" else convert_to,
+        convert_punctuation=punctuation,
+        need_ruby=get("ruby", "0") in ("1", "true"),
+        need_cantonese=get("cantonese", "0") in ("1", "true"),
+        # every job has its own dir, and the book is rewritten in memory
+        streaming=True,
+        parser=parser,
+    )
+
+
+class ConversionService:
+    def __init__(
+        self,
+        workdir: Path,
+        workers: int = 2,
+        max_queue: int = 8,
+        result_ttl: float = 3600.0,
+        warmup_languages: Sequence[str] = ("ja", "zh", "cantonese"),
+        warmup_conversions: Sequence[str] = (),
+        warmup_detect: bool = True,
+        result_cache: Optional[ResultCache] = None,
+    ) -> None:
+        """
+        workdir: the uploads and results of the jobs
+        workers: number of worker processes
+        max_queue: number of jobs waiting for a worker, more are refused
+        result_ttl: seconds to keep a finished job which is not deleted
+        result_cache: converted books, shared by all the workers
+        """
+        assert workers >= 1, "workers must be at least 1"
+        assert max_queue >= 0, "max_queue must not be negative"
+        self.workdir: Path = workdir
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.workers: int = workers
+        self.max_queue: int = max_queue
+        self.result_ttl: float = result_ttl
+        self.result_cache: Optional[ResultCache] = result_cache
+        self.warmup_args = (
+            tuple(warmup_languages),
+            tuple(warmup_conversions),
+            warmup_detect,
+        )
+        self.jobs: Dict[str, Job] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.executor: ProcessPoolExecutor = self.new_executor()
+        # the jobs waiting for a worker, and the ones sent to the pool
+        self.queue: Deque[Job] = deque()
+        self.running: Set[Job] = set()
+        self.broken: Optional[ProcessPoolExecutor] = None
+        self.closed: bool = False
+        # the pool is only used, and replaced, by the dispatcher thread
+        self.wakeup: threading.Event = threading.Event()
+        self.dispatcher: threading.Thread = threading.Thread(
+            target=self.dispatch_loop, name="epubhv-dispatcher", daemon=True
+        )
+        self.dispatcher.start()
+
+    def new_executor(self) -> ProcessPoolExecutor:
+        return preloaded_executor(self.workers, partial(warmup, *self.warmup_args))
+
+    def dispatch_loop(self) -> None:
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                if self.closed:
+                    return
+                started: List[Tuple[Job, Future, ProcessPoolExecutor]] = self.dispatch()
+            # a callback added to a finished future runs at once, and takes
+            # the lock
+            for job, future, executor in started:
+                future.add_done_callback(partial(self.finish, job, executor))
+
+    def dispatch(self) -> List[Tuple[Job, Future, ProcessPoolExecutor]]:
+        """
+        send the queued jobs to the pool while a worker is free, with the
+        lock held, a job which was running when a pool broke runs alone
+        """
+        if self.broken is self.executor:
+            self.executor = self.new_executor()
+        self.broken = None
+        started: List[Tuple[Job, Future, ProcessPoolExecutor]] = []
+        while self.queue and len(self.running) < self.workers:
+            job: Job = self.queue[0]
+            if job.id not in self.jobs:
+                self.queue.popleft()
+                continue
+            if any(other.retried for other in self.running) or (
+                job.retried and self.running
+            ):
+                break
+            self.queue.popleft()
+            try:
+                job.future = self.executor.submit(convert_one_epub, *job.args)
+            except BrokenProcessPool:
+                self.queue.appendleft(job)
+                self.broken = self.executor
+                self.wakeup.set()
+                break
+            self.running.add(job)
+            started.append((job, job.future, self.executor))
+        return started
+
+    def pending(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.result is None)
+
+    def expire(self) -> None:
+        now: float = time.time()
+        for job in list(self.jobs.values()):
+            if job.finished is not None and now - job.finished > self.result_ttl:
+                self.remove(job.id)
+
+    def submit(
+        self,
+        name: str,
+        data: BinaryIO,
+        length: int,
+        method: str = "to_vertical",
+        options: Optional[Dict[str, Any]] = None,
+    ) -> Job:
+        """
+        save the upload and queue the job, QueueFull if there are too many
+        jobs already
+        """
+        assert method in METHODS, "must be to_horizontal or to_vertical."
+        name = Path(name).name
+        if Path(name).suffix != ".epub":
+            raise ValueError(f"{name} must be epub file")
+        with self.lock:
+            self.expire()
+            if self.pending() >= self.workers + self.max_queue:
+                raise QueueFull()
+            # the slot is taken before the upload is read
+            job_id: str = uuid.uuid4().hex
+            job = Job(job_id, self.workdir / job_id)
+            self.jobs[job.id] = job
+        try:
+            epub: Path = job.workdir / "input" / name
+            epub.parent.mkdir(parents=True)
+            with open(epub, "wb") as f:
+                remaining: int = length
+                while remaining > 0:
+                    chunk: bytes = data.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError("the upload is shorter than its length")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+        except BaseException:
+            with self.lock:
+                self.remove(job.id)
+            raise
+        job.args = (
+            epub,
+            method,
+            job.workdir,
+            dict(options or {}, result_cache=self.result_cache),
+        )
+        with self.lock:
+            self.queue.append(job)
+        self.wakeup.set()
+        return job
+
+    def finish(self, job: Job, executor: ProcessPoolExecutor, future: Future) -> None:
+        error: Optional[BaseException] = (
+            None if future.cancelled() else future.exception()
+        )
+        retry: bool = False
+        with self.lock:
+            self.running.discard(job)
+            if isinstance(error, BrokenProcessPool):
+                # a worker died, running this job or another one
+                self.broken = executor
+                retry = not job.retried and job.id in self.jobs
+                if retry:
+                    job.retried = True
+                    self.queue.appendleft(job)
+        self.wakeup.set()
+        if future.cancelled() or retry:
+            # the job was removed, or it waits for the new pool
+            return
+        result: BatchResult = (
+            future.result()
+            if error is None
+            else BatchResult(epub=job.workdir, error=str(error) or type(error).__name__)
+        )
+        # a finished job is one with a result, `Job.info` reads them without
+        # the lock, so finished must be set first
+        job.finished = time.time()
+        job.result = result
+        job.done.set()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def remove(self, job_id: str) -> None:
+        """
+        forget the job and remove its files, with the lock held
+        """
+        job: Optional[Job] = self.jobs.pop(job_id, None)
+        if job is not None:
+            if job.future is not None:
+                job.future.cancel()
+            shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def health(self) -> Dict[str, Any]:
+        with self.lock:
+            statuses: List[str] = [job.status for job in self.jobs.values()]
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "finished": len(statuses)
+            - statuses.count("queued")
+            - statuses.count("running"),
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+        self.wakeup.set()
+        self.dispatcher.join()
+        with self.lock:
+            for job in self.jobs.values():
+                if job.future is not None:
+                    job.future.cancel()
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for job_id in list(self.jobs):
+                self.remove(job_id)
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    server: "ConversionServer"
+
+    def send_json(
+        self,
+        status: HTTPStatus,
+        body: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        data: bytes = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: HTTPStatus, message: str, **headers: str):
+        self.send_json(status, {"error": message}, headers)
+
+    def route(self) -> List[str]:
+        return [part for part in urlsplit(self.path).path.split("/") if part]
+
+    def find_job(self, job_id: str) -> Optional[Job]:
+        job: Optional[Job] = self.server.service.get(job_id)
+        if job is None:
+            self.send_error_json(HTTPStatus.NOT_FOUND, "no such job")
+        return job
+
+    def do_GET(self) -> None:
+        route: List[str] = self.route()
+        if route == ["health"]:
+            self.send_json(HTTPStatus.OK, self.server.service.health())
+        elif len(route) == 2 and route[0] == "jobs":
+            job: Optional[Job] = self.find_job(route[1])
+            if job is not None:
+                self.send_json(HTTPStatus.OK, job.info())
+        elif len(route) == 3 and route[0] == "jobs" and route[2] == "result":
+            job = self.find_job(route[1])
+            if job is not None:
+                self.send_result(job)
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, "not found")
+
+    def send_result(self, job: Job) -> None:
+        if job.result is None:
+            self.send_error_json(HTTPStatus.CONFLICT, "the job is not finished")
+            return
+        if job.result.output is None:
+            self.send_error_json(HTTPStatus.CONFLICT, job.result.error or "failed")
+            return
+        output: Path = job.result.output
+        try:
+            f = open(output, "rb")
+        except OSError:
+            # deleted by another request
+            self.send_error_json(HTTPStatus.NOT_FOUND, "no such job")
+            return
+        with f:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/epub+zip")
+            self.send_header("Content-Length", str(output.stat().st_size))
+            self.send_header("Content-Disposition", content_disposition(output.name))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+    def do_POST(self) -> None:
+        if self.route() != ["jobs"]:
+            self.send_error_json(HTTPStatus.NOT_FOUND, "not found")
+            return
+        header: Optional[str] = self.headers.get("Content-Length")
+        if header is None:
+            self.send_error_json(HTTPStatus.LENGTH_REQUIRED, "Content-Length")
+            return
+        try:
+            length: int = int(header)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, "bad Content-Length")
+            # the body can not be read without its length
+            self.close_connection = True
+            return
+        if length > self.server.max_upload:
+            self.send_error_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "too large")
+            # the body is not read, so the connection can not be reused
+            self.close_connection = True
+            return
+        query: Dict[str, List[str]] = parse_qs(urlsplit(self.path).query)
+        method: str = query.get("method", ["to_vertical"])[-1]
+        try:
+            if method not in METHODS:
+                raise ValueError(f"unknown method {method}")
+            options: Dict[str, Any] = epub_options(query)
+            job: Job = self.server.service.submit(
+                query.get("name", ["book.epub"])[-1],
+                self.rfile,
+                length,
+                method,
+                options,
+            )
+        except QueueFull:
+            self.close_connection = True
+            self.send_error_json(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                "the queue is full",
+                **{"Retry-After": "5"},
+            )
+            return
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self.send_json(HTTPStatus.ACCEPTED, job.info())
+
+    def do_DELETE(self) -> None:
+        route: List[str] = self.route()
+        if len(route) != 2 or route[0] != "jobs":
+            self.send_error_json(HTTPStatus.NOT_FOUND, "not found")
+        elif self.find_job(route[1]) is not None:
+            with self.server.service.lock:
+                self.server.service.remove(route[1])
+            self.send_json(HTTPStatus.OK, {"id": route[1], "status": "deleted"})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Any,
+        service: ConversionService,
+        max_upload: int = 512 << 20,
+        quiet: bool = False,
+    ) -> None:
+        super().__init__(address, ConversionHandler)
+        self.service: ConversionService = service
+        self.max_upload: int = max_upload
+        self.quiet: bool = quiet
+
+
+class Options:
+    host: str
+    port: int
+    workers: int
+    max_queue: int
+    max_upload: int
+    workdir: Path
+    result_ttl: float
+    cache_dir: Optional[Path]
+    cache_size: int
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument(
+        "--workers", default=2, type=int, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--max-queue",
+        dest="max_queue",
+        default=8,
+        type=int,
+        help="number of jobs waiting for a worker, more are refused with 503",
+    )
+    parser.add_argument(
+        "--max-upload",
+        dest="max_upload",
+        default=512,
+        type=int,
+        help="max size of an upload in MiB",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=Path(".epubhv_server"),
+        type=Path,
+        help="dir to keep the uploads and results",
+    )
+    parser.add_argument(
+        "--result-ttl",
+        dest="result_ttl",
+        default=3600.0,
+        type=float,
+        help="seconds to keep a finished job",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        default=None,
+        type=Path,
+        help="dir to keep the converted books across jobs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        default=1024,
+        type=int,
+        help="max size of --cache-dir in MiB",
+    )
+    options = cast(Options, parser.parse_args())
+    if options.workers < 1 or options.max_queue < 0:
+        parser.error("--workers must be at least 1, --max-queue at least 0")
+    service = ConversionService(
+        options.workdir,
+        workers=options.workers,
+        max_queue=options.max_queue,
+        result_ttl=options.result_ttl,
+        warmup_conversions=available_conversions(),
+        result_cache=(
+            ResultCache(options.cache_dir, max_bytes=options.cache_size << 20)
+            if options.cache_dir is not None
+            else None
+        ),
+    )
+    server = ConversionServer(
+        (options.host, options.port), service, max_upload=options.max_upload << 20
+    )
+    print(f"epubhv server on http://{options.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Where the time of a conversion goes.
+
+`Stats` records the wall time and CPU time of each stage of `EPUBHV.run`
+and of each content document, and counters like the text nodes converted,
+the ruby tags emitted and the bytes read and written.
+Subclass it and override `add_stage` or `add_document` to send them
+somewhere else as they come.
+
+The documents may be converted in worker processes, so the code inside
+`convert_document` does not know about `Stats`, it calls `count` and
+`step`, which add to the innermost `measure` of the thread, and do nothing
+outside of one.
+
+The memory is only recorded for the whole run, as the max RSS of this
+process when the last stage ends (`Stats.max_rss`), the kernel keeps a
+single peak for the life of the process, not one for each stage. The
+workers which convert documents are not in it.
+"""
+
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+
+def peak_rss() -> int:
+    """
+    max resident set size of this process in bytes, 0 if it is unknown
+    """
+    if resource is None:
+        return 0
+    rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Timing(NamedTuple):
+    wall: float = 0.0
+    cpu: float = 0.0
+
+    def add(self, other: "Timing") -> "Timing":
+        return Timing(self.wall + other.wall, self.cpu + other.cpu)
+
+
+class Measurement:
+    def __init__(self) -> None:
+        self.timing: Timing = Timing()
+        self.counters: Counter[str] = Counter()
+        # wall time of the steps inside, like `parse` or `opencc`
+        self.steps: Dict[str, float] = defaultdict(float)
+
+
+# every thread has its own innermost measurement
+_current: ContextVar[Optional[Measurement]] = ContextVar(
+    "epubhv_measurement", default=None
+)
+
+
+def count(name: str, n: int = 1) -> None:
+    """
+    add n to a counter of the innermost measurement, if any
+    """
+    m: Optional[Measurement] = _current.get()
+    if m is not None:
+        m.counters[name] += n
+
+
+@contextmanager
+def step(name: str) -> Iterator[None]:
+    """
+    add the wall time of the block to the innermost measurement, if any
+    """
+    m: Optional[Measurement] = _current.get()
+    if m is None:
+        yield
+        return
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        m.steps[name] += time.perf_counter() - start
+
+
+@contextmanager
+def measure() -> Iterator[Measurement]:
+    """
+    time the block, `count` and `step` inside add to the measurement, the
+    outer measurement does not get them
+    """
+    m: Measurement = Measurement()
+    token = _current.set(m)
+    wall: float = time.perf_counter()
+    cpu: float = time.process_time()
+    try:
+        yield m
+    finally:
+        _current.reset(token)
+        m.timing = Timing(time.perf_counter() - wall, time.process_time() - cpu)
+
+
+class DocumentStats(NamedTuple):
+    # path in the epub
+    name: str
+    timing: Timing
+    changed: bool
+    # served by the document cache, the timing is zero
+    cached: bool = False
+    counters: Dict[str, int] = {}
+    steps: Dict[str, float] = {}
+
+
+class Stats:
+    def __init__(self) -> None:
+        # like the epub and the method, set by `EPUBHV.run`
+        self.info: Dict[str, Any] = {}
+        self.stages: Dict[str, Timing] = {}
+        self.documents: List[DocumentStats] = []
+        self.counters: Counter[str] = Counter()
+        # bytes, of this process at the end of the last stage
+        self.max_rss: int = 0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Measurement]:
+        with measure() as m:
+            yield m
+        self.max_rss = max(self.max_rss, peak_rss())
+        self.add_stage(name, m.timing, m.counters)
+
+    def add_stage(self, name: str, timing: Timing, counters: Dict[str, int]) -> None:
+        """
+        called at the end of each stage, a stage may run more than once
+        """
+        self.stages[name] = self.stages.get(name, Timing()).add(timing)
+        self.counters.update(counters)
+
+    def add_document(self, document: DocumentStats) -> None:
+        self.documents.append(document)
+        self.counters.update(document.counters)
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            **self.info,
+            "stages": {name: t._asdict() for name, t in self.stages.items()},
+            "documents": [
+                {
+                    "name": d.name,
+                    **d.timing._asdict(),
+                    "changed": d.changed,
+                    "cached": d.cached,
+                    "counters": d.counters,
+                    "steps": d.steps,
+                }
+                for d in self.documents
+            ],
+            "counters": dict(self.counters),
+            "max_rss": self.max_rss,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), ensure_ascii=False)
@@ -0,0 +1,294 @@
+"""
+Add or remove the writing mode of css files.
+
+Only three declarations of the top level style rules are changed, so a
+tokenizer finds the rules and their declarations and the rest of the file is
+kept as is. cssutils parses and writes the whole file again which is slow for
+the big stylesheets of some publishers, it is only used for the files the
+tokenizer can not handle: other encodings, escapes in the names, nested
+rules or broken files.
+"""
+
+import logging
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+
+WRITING_KEY_LIST: List[str] = [
+    "writing-mode",
+    "-webkit-writing-mode",
+    "-epub-writing-mode",
+]
+HTML_RULE: str = """html {
+  -epub-writing-mode: vertical-rl;
+  writing-mode: vertical-rl;
+  -webkit-writing-mode: vertical-rl;
+}
+"""
+
+UTF8_BOM: bytes = b"\xef\xbb\xbf"
+# comments, strings, escapes and the chars of the structure, the last ones
+# are unterminated comments and strings, or things cssutils handles its own way
+TOKEN_RE = re.compile(
+    r"""/\*.*?\*/|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|\\.|[{}();]"""
+    r"""|/\*|["'\\]|<!--|-->""",
+    re.S,
+)
+UNSUPPORTED_TOKENS = ("/*", '"', "'", "\\", "<!--", "-->")
+COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+# top level comments are rules of their own for cssutils
+LEADING_RE = re.compile(r"(?:\s|/\*.*?\*/)*", re.S)
+CHARSET_RE = re.compile(r'@charset "([^"]*)";')
+
+
+class UnsupportedStylesheet(Exception):
+    """
+    the stylesheet needs a full parse by cssutils
+    """
+
+
+class StyleRule(NamedTuple):
+    selector: str
+    # index of the "{" and "}" of the block
+    open: int
+    close: int
+
+
+class Declaration(NamedTuple):
+    name: str
+    # from the end of the last declaration to the end of its ";"
+    start: int
+    end: int
+    terminated: bool
+
+
+def tokens(text: str, start: int = 0, end: Optional[int] = None):
+    for m in TOKEN_RE.finditer(text, start, len(text) if end is None else end):
+        token: str = m.group()
+        if token in UNSUPPORTED_TOKENS:
+            raise UnsupportedStylesheet(f"{token!r} at {m.start()}")
+        yield m.start(), token
+
+
+def style_rules(text: str) -> List[StyleRule]:
+    """
+    the top level style rules, at-rules like `@media` are skipped as a whole
+    """
+    rules: List[StyleRule] = []
+    depth: int = 0
+    parens: int = 0
+    prelude: int = 0
+    open: int = 0
+    for i, token in tokens(text):
+        if token == "(":
+            parens += 1
+        elif token == ")":
+            if parens == 0:
+                raise UnsupportedStylesheet(f"unbalanced ')' at {i}")
+            parens -= 1
+        elif parens:
+            continue
+        elif token == "{":
+            if depth == 0:
+                open = i
+            depth += 1
+        elif token == "}":
+            if depth == 0:
+                raise UnsupportedStylesheet(f"unbalanced '}}' at {i}")
+            depth -= 1
+            if depth == 0:
+                selector: str = text[prelude:open]
+                selector = selector[LEADING_RE.match(selector).end() :]  # type: ignore
+                if not selector.startswith("@"):
+                    rules.append(StyleRule(" ".join(selector.split()), open, i))
+                prelude = i + 1
+        elif token == ";" and depth == 0:
+            prelude = i + 1
+    if depth or parens:
+        raise UnsupportedStylesheet("unterminated block")
+    return rules
+
+
+def declaration(text: str, start: int, end: int, terminated: bool):
+    name, colon, _ = COMMENT_RE.sub("", text[start:end]).partition(":")
+    if not colon:
+        return None
+    if "\\" in name:
+        raise UnsupportedStylesheet(f"escape in {name.strip()!r}")
+    return Declaration(name.strip().lower(), start, end, terminated)
+
+
+def declarations(text: str, rule: StyleRule) -> List[Declaration]:
+    result: List[Declaration] = []
+    start: int = rule.open + 1
+    parens: int = 0
+    d: Optional[Declaration]
+    for i, token in tokens(text, rule.open + 1, rule.close):
+        if token == "(":
+            parens += 1
+        elif token == ")":
+            parens -= 1
+        elif parens:
+            continue
+        elif token in ("{", "}"):
+            raise UnsupportedStylesheet(f"nested rule at {i}")
+        elif token == ";":
+            d = declaration(text, start, i + 1, True)
+            if d is not None:
+                result.append(d)
+            start = i + 1
+    d = declaration(text, start, rule.close, False)
+    if d is not None:
+        result.append(d)
+    return result
+
+
+def apply_edits(text: str, edits: List[Tuple[int, int, str]]) -> str:
+    parts: List[str] = []
+    last: int = 0
+    for start, end, new in edits:
+        parts.append(text[last:start])
+        parts.append(new)
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def add_vertical(text: str) -> Optional[str]:
+    """
+    add the missing vertical writing modes to every `html` rule, or a new
+    `html` rule at the end, None if nothing is missing
+    """
+    edits: List[Tuple[int, int, str]] = []
+    has_html: bool = False
+    for rule in style_rules(text):
+        if rule.selector != "html":
+            continue
+        has_html = True
+        decls: List[Declaration] = declarations(text, rule)
+        names = {d.name for d in decls}
+        missing: List[str] = [w for w in WRITING_KEY_LIST if w not in names]
+        if not missing:
+            continue
+        # replace the whitespace before "}"
+        start: int = rule.close
+        while start > rule.open + 1 and text[start - 1].isspace():
+            start -= 1
+        new: str = "".join(f"\n  {w}: vertical-rl;" for w in missing)
+        if decls and not decls[-1].terminated:
+            new = ";" + new
+        edits.append((start, rule.close, new + "\n"))
+    if not has_html:
+        separator: str = "\n" if text and not text.endswith("\n") else ""
+        edits.append((len(text), len(text), separator + HTML_RULE))
+    if not edits:
+        return None
+    return apply_edits(text, edits)
+
+
+def remove_writing_mode(text: str) -> Optional[str]:
+    """
+    remove the writing modes of all the style rules, None if there is none
+    """
+    edits: List[Tuple[int, int, str]] = [
+        (d.start, d.end, "")
+        for rule in style_rules(text)
+        for d in declarations(text, rule)
+        if d.name in WRITING_KEY_LIST
+    ]
+    if not edits:
+        return None
+    return apply_edits(text, edits)
+
+
+def decode(data: bytes) -> Tuple[str, bytes]:
+    """
+    the text and the BOM of an utf-8 stylesheet
+    """
+    bom: bytes = UTF8_BOM if data.startswith(UTF8_BOM) else b""
+    try:
+        text: str = data[len(bom) :].decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise UnsupportedStylesheet(str(e))
+    m: Optional[re.Match[str]] = CHARSET_RE.match(text)
+    if m and m.group(1).lower() not in ("utf-8", "utf8"):
+        raise UnsupportedStylesheet(f"charset {m.group(1)}")
+    return text, bom
+
+
+@lru_cache(maxsize=None)
+def load_cssutils() -> Any:
+    import cssutils
+
+    # it logs every property it does not know, like `-epub-writing-mode`
+    cssutils.log.setLevel(logging.CRITICAL)  # type: ignore
+    return cssutils
+
+
+def parse_cssutils(data: bytes, path: Optional[Path] = None) -> Any:
+    cssutils = load_cssutils()
+    from cssutils.helper import path2url
+
+    # same as `parseFile`, which reads the bytes and detects the encoding
+    href: Optional[str] = None if path is None else path2url(str(path))
+    return cssutils.CSSParser().parseString(data, href=href)
+
+
+def cssutils_add_vertical(data: bytes, path: Optional[Path] = None):
+    p = parse_cssutils(data, path)
+    has_html_or_body: bool = False
+    css_changed: bool = False
+    for s in p.cssRules.rulesOfType(1):
+        if s.selectorText == "html":
+            has_html_or_body = True
+            for w in WRITING_KEY_LIST:
+                if w not in s.style.keys():
+                    # set it to vertical
+                    s.style[w] = "vertical-rl"
+                    css_changed = True
+    if not has_html_or_body:
+        css_changed = True
+        p.add(HTML_RULE)
+    return p.cssText if css_changed else None
+
+
+def cssutils_remove_writing_mode(data: bytes, path: Optional[Path] = None):
+    p = parse_cssutils(data, path)
+    css_changed: bool = False
+    for s in p.cssRules.rulesOfType(1):
+        for k in s.style.keys():
+            if k in WRITING_KEY_LIST:
+                del s.style[k]
+                css_changed = True
+    return p.cssText if css_changed else None
+
+
+def rewrite(
+    data: bytes,
+    path: Optional[Path],
+    fast: Callable[[str], Optional[str]],
+    fallback: Callable[[bytes, Optional[Path]], Optional[bytes]],
+) -> Optional[bytes]:
+    try:
+        text, bom = decode(data)
+        new_text: Optional[str] = fast(text)
+    except UnsupportedStylesheet:
+        return fallback(data, path)
+    return None if new_text is None else bom + new_text.encode("utf-8")
+
+
+def to_vertical(data: bytes, path: Optional[Path] = None) -> Optional[bytes]:
+    """
+    the stylesheet with the vertical writing mode on `html`, None if it
+    already has it. path is where the file is, to resolve `@import` in
+    cssutils, None if it is not on the disk.
+    """
+    return rewrite(data, path, add_vertical, cssutils_add_vertical)
+
+
+def to_horizontal(data: bytes, path: Optional[Path] = None) -> Optional[bytes]:
+    """
+    the stylesheet without any writing mode, None if it has none
+    """
+    return rewrite(data, path, remove_writing_mode, cssutils_remove_writing_mode)
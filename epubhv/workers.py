@@ -0,0 +1,63 @@
+"""
+Process pools whose workers share the language backends copy-on-write.
+
+The backends add up to hundreds of MB (the jieba dictionary, the unidic
+dictionary of fugashi, the pypinyin tables, ToJyutping and the OpenCC
+dictionaries), and a plain process pool loads a copy of them in every
+worker. `preloaded_executor` loads them once in this process, freezes the
+GC heap and forks all the workers at once, so the workers share the pages
+of the backends as long as they only read them. Without `gc.freeze` the
+collector of every worker would write to all the objects it visits, and
+copy the pages anyway.
+
+Where fork is not available, or not safe like on macOS, every worker loads
+its own copy when it starts, like before.
+"""
+
+import gc
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+
+def can_fork() -> bool:
+    return (
+        sys.platform.startswith("linux")
+        and "fork" in multiprocessing.get_all_start_methods()
+    )
+
+
+def preloaded_executor(
+    max_workers: int, preload: Optional[Callable[[], None]] = None
+) -> ProcessPoolExecutor:
+    """
+    a process pool whose workers have run preload, it is run once in this
+    process when the workers are forked, or in every worker when they can
+    not be, so it must be picklable
+    """
+    if not can_fork():
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=preload)
+    if preload is not None:
+        preload()
+    # a worker of another preloaded pool already has its heap frozen, it is
+    # left as it is
+    frozen: bool = gc.get_freeze_count() > 0
+    if not frozen:
+        # the garbage is not frozen in the workers forever
+        gc.collect()
+        gc.freeze()
+    try:
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+        )
+        # fork all the workers now, with the heap frozen, and before the
+        # caller starts more threads
+        executor.submit(os.getpid).result()
+    finally:
+        if not frozen:
+            # the workers keep their heap frozen, this process collects as
+            # before
+            gc.unfreeze()
+    return executor
@@ -6,17 +6,20 @@ I made some change
 """
 
 # coding: utf-8
+import html
+import json
+import os
 import re
-from itertools import groupby
+import sqlite3
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate, groupby
 
-import jieba
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString, Script, Stylesheet, Tag, TemplateString
-from fugashi import Tagger
-from pypinyin import pinyin
-from ToJyutping import get_jyutping_list
 
-tagger = Tagger()  # pyright: ignore
+from epubhv.stats import count
 
 katakana_chart = "ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペホボポマミムメモャヤュユョヨラリルレロヮワヰヱヲンヴヵヶヽヾ"
 hiragana_chart = "ぁあぃいぅうぇえぉおかがきぎくぐけげこごさざしじすずせぜそぞただちぢっつづてでとどなにぬねのはばぱひびぴふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろゎわゐゑをんゔゕゖゝゞ"
@@ -25,6 +28,62 @@ k2h = str.maketrans(katakana_chart, hiragana_chart)
 
 white_space_re = re.compile(r"(\s+)")
 
+# the text of these tags is segmented with the text around them by the
+# `block` scope, any other tag ends the run of text
+inline_tags = {
+    "a", "abbr", "b", "bdi", "bdo", "big", "cite", "code", "data", "del", "dfn",
+    "em", "font", "i", "ins", "kbd", "mark", "q", "s", "samp", "small", "span",
+    "strike", "strong", "sub", "sup", "time", "tt", "u", "var",
+}  # fmt: skip
+
+
+# the language backends are heavy (the unidic dictionary of fugashi, the jieba
+# and pypinyin dictionaries, the ToJyutping trie), they are only imported on
+# the first use of the language, or by `warmup`
+@lru_cache(maxsize=None)
+def load_tagger():
+    from fugashi import Tagger
+
+    return Tagger()
+
+
+@lru_cache(maxsize=None)
+def load_jieba():
+    import jieba
+
+    jieba.initialize()
+    return jieba
+
+
+@lru_cache(maxsize=None)
+def load_pinyin():
+    from pypinyin import pinyin
+
+    return pinyin
+
+
+@lru_cache(maxsize=None)
+def load_jyutping():
+    from ToJyutping import get_jyutping_list
+
+    return get_jyutping_list
+
+
+language_backends = {
+    "ja": (load_tagger,),
+    "zh": (load_jieba, load_pinyin),
+    "zh-cn": (load_jieba, load_pinyin),
+    "zh-tw": (load_jieba, load_pinyin),
+    "cantonese": (load_jyutping,),
+}
+
+
+def warmup(languages=("ja", "zh", "cantonese")):
+    """load the backends of the languages now instead of on the first use"""
+    for language in languages:
+        for load in language_backends[language]:
+            load()
+
 
 class RBString(NavigableString):
     """class for <ruby> tag"""
@@ -44,6 +103,13 @@ class RPString(NavigableString):
     pass
 
 
+class RubyFragment(NavigableString):
+    """already escaped ruby markup, it is output as is"""
+
+    def output_ready(self, formatter="minimal"):
+        return str(self)
+
+
 # strings in tag which in string_containers will not appear in bs4's get_text()
 # this could be controlled by a parameter of get_text() ,see its docstring
 string_containers = {
@@ -90,12 +156,33 @@ def hantei_japanese(word):
 def hantei_chinese(word):
     # follow the old api for Chinese pinyin
     pin = " "
-    for wordt in pinyin(word):
+    for wordt in load_pinyin()(word):
         pin = " " + pin + " " + wordt[0]
     pin += " "
     return word, True, pin
 
 
+@lru_cache(maxsize=1 << 18)
+def chinese_reading(word):
+    """
+    the reading table for jieba tokens, same yomi as `hantei_chinese`,
+    every token only calls `pinyin` once.
+    """
+    readings = [wordt[0] for wordt in load_pinyin()(word)]
+    if not readings:
+        return "  "
+    # same spacing as the old api
+    return " " * (len(readings) + 2) + " ".join(readings) + " "
+
+
+def hantei_chinese_text(sentence):
+    """
+    segment the whole text then look up the readings of all the tokens,
+    the same tuples as `map(hantei_chinese, jieba.cut(sentence))`
+    """
+    return [(word, True, chinese_reading(word)) for word in load_jieba().lcut(sentence)]
+
+
 def hantei_cantonese(word):
     # follow the old api for Chinese pinyin for cantonese
     if word[1] is not None:
@@ -117,24 +204,172 @@ def cut_end(text, hira):
 
 def yomituki(sentence, lang="zh"):
     assert lang in ["zh", "zh-cn", "zh-tw", "ja", "cantonese"], "Language must zh or ja"
-    if lang in ["zh", "zh-cn"]:
-        words_list = jieba.cut(sentence)
-        hantei = hantei_chinese
+    if lang in ["zh", "zh-cn", "zh-tw"]:
+        hanteis = hantei_chinese_text(sentence)
     elif lang == "ja":
-        words_list = tagger(sentence)
-        hantei = hantei_japanese
+        hanteis = map(hantei_japanese, load_tagger()(sentence))
     elif lang in ["cantonese"]:
-        words_list = get_jyutping_list(sentence)
-        hantei = hantei_cantonese
-    for text, ruby, yomi in map(hantei, words_list):
+        hanteis = map(hantei_cantonese, load_jyutping()(sentence))
+    for text, ruby, yomi in hanteis:
         if ruby:
             yield from cut_end(text, yomi)
         else:
             yield text
 
 
+# the sqlite connections inherited from the parent process
+forked_connections = []
+
+
+class YomiCache:
+    """
+    memoize `yomituki` results by (language, text)
+
+    an LRU dict in this process, and optional a sqlite file which survives
+    across runs and is shared by the processes. every process opens its own
+    connection on first use, a forked worker must not use the one of its
+    parent, but it keeps the readings of the LRU.
+    """
+
+    def __init__(self, maxsize=65536, path=None, commit_every=1000):
+        self.maxsize = maxsize
+        self.path = path
+        self.commit_every = commit_every
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.db = None
+        # the process which opened db
+        self.pid = None
+
+    def connect(self):
+        """
+        the sqlite connection of this process, None for memory only
+        """
+        if self.path is None:
+            return None
+        if self.db is None or self.pid != os.getpid():
+            if self.db is not None:
+                # closing the connection of the parent could checkpoint and
+                # remove the WAL it still uses, it is never closed here
+                forked_connections.append(self.db)
+            self.db = sqlite3.connect(str(self.path), timeout=30)
+            self.pid = os.getpid()
+            # the writes of the parent are its own to commit
+            self.pending = 0
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS yomi "
+                "(lang TEXT, text TEXT, pieces TEXT, PRIMARY KEY (lang, text))"
+            )
+            self.db.commit()
+        return self.db
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.memory),
+        }
+
+    def _remember(self, key, pieces):
+        self.memory[key] = pieces
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def _load(self, lang, text):
+        db = self.connect()
+        if db is None:
+            return None
+        row = db.execute(
+            "SELECT pieces FROM yomi WHERE lang = ? AND text = ?", (lang, text)
+        ).fetchone()
+        if row is None:
+            return None
+        return tuple(p if isinstance(p, str) else tuple(p) for p in json.loads(row[0]))
+
+    def _save(self, lang, text, pieces):
+        db = self.connect()
+        if db is None:
+            return
+        try:
+            db.execute(
+                "INSERT OR REPLACE INTO yomi VALUES (?, ?, ?)",
+                (lang, text, json.dumps(pieces, ensure_ascii=False)),
+            )
+        except sqlite3.Error:
+            # the disk tier is only a cache, never fail the conversion for it
+            return
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if self.db is None or self.pid != os.getpid() or not self.pending:
+            return
+        try:
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
+
+    def yomituki(self, sentence, lang="zh"):
+        """
+        same as `yomituki` but returns a tuple of the pieces
+        """
+        key = (lang, sentence)
+        pieces = self.memory.get(key)
+        if pieces is not None:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return pieces
+        pieces = self._load(lang, sentence)
+        if pieces is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            pieces = tuple(yomituki(sentence, lang=lang))
+            self._save(lang, sentence, pieces)
+        self._remember(key, pieces)
+        return pieces
+
+
+@lru_cache(maxsize=None)
+def load_yomi_cache(path=None):
+    """
+    one cache per process for each sqlite file, None for memory only
+    """
+    return YomiCache(path=path)
+
+
+def ruby_wraps(yomis, rp=("（", "）")):
+    """
+    the <ruby> markup for a list of (text, yomi), the text is escaped.
+    rp is the pair of <rp> strings, None for no <rp>
+    """
+    plain = "<ruby>"
+    for text, yomi in yomis:
+        plain += html.escape(text, quote=False)
+        if rp:
+            plain += f"<rp>{html.escape(rp[0], quote=False)}</rp>"
+        plain += f"<rt>{html.escape(yomi, quote=False)}</rt>"
+        if rp:
+            plain += f"<rp>{html.escape(rp[1], quote=False)}</rp>"
+    return plain + "</ruby>"
+
+
 def ruby_wrap(text, yomi):
-    return f"<ruby>{text}<rp>（</rp><rt>{yomi}</rt><rp>）</rp></ruby>"
+    return ruby_wraps([(text, yomi)])
 
 
 def tag_wrap(name, str):
@@ -152,40 +387,199 @@ def ruby_text(text, lang="zh"):
         if i in (None, ""):
             continue
         if isinstance(i, str):
-            plain += i
+            plain += html.escape(i, quote=False)
         else:
             plain += ruby_wrap(*i)
     return plain
 
 
 class RubySoup:
-    def __init__(self, ruby_language, is_ruby_rp=True) -> None:
+    def __init__(
+        self, ruby_language, is_ruby_rp=True, cache=None, emit="tags", scope="text"
+    ):
         self.is_ruby_rp = is_ruby_rp
         self.ruby_language = ruby_language
+        # a `YomiCache`, None to always run the segmentation
+        self.cache = cache
+        # `tags` builds bs4 tags for every <ruby>, `string` builds the
+        # escaped markup of a whole text node as one `RubyFragment`
+        assert emit in ("tags", "string"), "emit must be tags or string"
+        self.emit = emit
+        # `text` segments every text node on its own, `block` segments the
+        # text of a paragraph at once, across its inline tags like <em>
+        assert scope in ("text", "block"), "scope must be text or block"
+        self.scope = scope
+
+    def ruby_fragment(self, string):
+        return self.pieces_fragment(self.ruby_string(string))
+
+    def pieces_fragment(self, pieces):
+        rp = ("(", ")") if self.is_ruby_rp else None
+        plain = ""
+        for piece in pieces:
+            if isinstance(piece, str):
+                plain += html.escape(piece, quote=False)
+            else:
+                plain += ruby_wraps(piece, rp=rp)
+        return RubyFragment(plain)
 
     def ruby_soup(self, soup):
+        """
+        ruby all the text in the soup, return True if anything changed,
+        the strings without any reading are not touched
+        """
+        if self.scope == "block":
+            return self.ruby_runs(soup)
+        changed = False
         for i in soup.children:
             if i is not None and type(i) is NavigableString and i.strip():
-                new_i = basesoup.new_tag("temptag")
-                # mecab will ignore some whitespace,so we handle it here
-                for ele in white_space_re.split(i):
-                    if ele.strip():
-                        for ele2 in self.ruby_navigablestring(ele):
-                            new_i.append(ele2)
-                i.replace_with(new_i)
-                new_i.unwrap()
+                changed = self.replace_string(i, list(self.ruby_string(i))) or changed
             elif isinstance(i, Tag) and i.name not in ("ruby", "rt", "rp"):
-                self.ruby_soup(i)
-
-    def ruby_navigablestring(self, navigablestring):
-        yomi = yomituki(str(navigablestring), lang=self.ruby_language)
+                changed = self.ruby_soup(i) or changed
+        return changed
+
+    def ruby_runs(self, soup):
+        """
+        `ruby_soup` for the `block` scope
+        """
+        runs = [[]]
+        self.text_runs(soup, runs)
+        changed = False
+        for run in runs:
+            pieces = self.ruby_block(run)
+            if pieces is None:
+                pieces = [list(self.ruby_string(i)) for i in run]
+            for i, string_pieces in zip(run, pieces):
+                if i.strip():
+                    changed = self.replace_string(i, string_pieces) or changed
+        return changed
+
+    def text_runs(self, tag, runs):
+        """
+        add the strings of the tag to runs, a new run starts at every tag
+        which is not inline, and at comments
+        """
+        for i in tag.children:
+            if type(i) is NavigableString:
+                runs[-1].append(i)
+            elif isinstance(i, Tag) and i.name in inline_tags:
+                self.text_runs(i, runs)
+            else:
+                if runs[-1]:
+                    runs.append([])
+                if isinstance(i, Tag) and i.name not in ("ruby", "rt", "rp"):
+                    self.text_runs(i, runs)
+                    if runs[-1]:
+                        runs.append([])
+
+    def replace_string(self, i, pieces):
+        """
+        replace the string with the pieces, return False if they are the same
+        """
+        if all(isinstance(p, str) for p in pieces) and "".join(pieces) == i:
+            return False
+        if self.emit == "string":
+            i.replace_with(self.pieces_fragment(pieces))
+            return True
+        new_i = basesoup.new_tag("temptag")
+        for piece in pieces:
+            if isinstance(piece, str):
+                new_i.append(piece)
+            else:
+                new_i.append(self.ruby_wraps_bs4(piece))
+        i.replace_with(new_i)
+        new_i.unwrap()
+        return True
+
+    def ruby_block(self, strings):
+        """
+        the pieces of `ruby_string` for each of the strings, the text of all
+        of them is segmented at once and the tokens are mapped back onto the
+        strings by offset. A token across two strings is segmented again in
+        each of them. None if the tokens are not the same as the text
+        """
+        text = "".join(strings)
+        ends = list(accumulate(len(s) for s in strings))
+        pieces = [[] for _ in strings]
+        start = 0
+        # mecab will ignore some whitespace, same as `ruby_string`
+        for ele in white_space_re.split(text):
+            end = start + len(ele)
+            if not ele.strip():
+                start = end
+                continue
+            # the tokens of this fragment in each string
+            parts = {}
+            pos = start
+            for token in self.segment(ele):
+                if token is None:
+                    continue
+                surface = token if isinstance(token, str) else token[0]
+                token_end = pos + len(surface)
+                if text[pos:token_end] != surface:
+                    return None
+                first = bisect_right(ends, pos)
+                last = bisect_right(ends, token_end - 1)
+                if first == last:
+                    parts.setdefault(first, []).append(token)
+                else:
+                    for n in range(first, last + 1):
+                        lo = max(pos, ends[n] - len(strings[n]))
+                        hi = min(token_end, ends[n])
+                        if lo >= hi:
+                            # an empty string
+                            continue
+                        if isinstance(token, str):
+                            parts.setdefault(n, []).append(text[lo:hi])
+                        else:
+                            parts.setdefault(n, []).extend(self.segment(text[lo:hi]))
+                pos = token_end
+            if pos != end:
+                return None
+            for n, tokens in parts.items():
+                pieces[n].extend(self.group(tokens))
+            start = end
+        return pieces
+
+    def ruby_string(self, string):
+        """
+        yield plain strings and lists of (text, yomi) for one <ruby> tag,
+        so the parser backends can build the tags their own way
+        """
+        # mecab will ignore some whitespace,so we handle it here
+        for ele in white_space_re.split(string):
+            if ele.strip():
+                yield from self.ruby_pieces(ele)
+
+    def segment(self, text):
+        count("segmentations")
+        if self.cache is None:
+            return tuple(yomituki(str(text), lang=self.ruby_language))
+        return self.cache.yomituki(str(text), lang=self.ruby_language)
+
+    def ruby_pieces(self, text):
+        yield from self.group(self.segment(text))
+
+    def group(self, yomi):
+        """
+        join the plain strings, and the (text, yomi) of one <ruby> tag
+        """
         for k, g in groupby(yomi, lambda x: type(x)):
             if k is None:
                 continue
             elif k == str:
                 yield "".join(g)
             else:
-                yield self.ruby_wraps_bs4(g)
+                # one <ruby> tag
+                count("ruby_tags")
+                yield list(g)
+
+    def ruby_navigablestring(self, navigablestring):
+        for piece in self.ruby_pieces(navigablestring):
+            if isinstance(piece, str):
+                yield piece
+            else:
+                yield self.ruby_wraps_bs4(piece)
 
     def ruby_wrap_bs4(self, text, yomi):
         ruby_tag = basesoup.new_tag("ruby")
@@ -1,16 +1,66 @@
+import gc
+import http.client
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
 from pathlib import Path
-from shutil import rmtree
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
+import jieba
 import opencc
 import pytest
+from bs4 import BeautifulSoup as bs
 
+import epubhv.batch as batch
+from epubhv.batch import BatchResult, convert_one_epub, run_batch
+from epubhv.cache import DocumentCache, ResultCache
+from epubhv.detect import LanguageDetector, detect_by_script, pick_samples
+import epubhv.epubhv as epubhv_module
 from epubhv.epubhv import (
     EPUBHV,
+    V_STYLE_LINE,
+    DocumentOptions,
     Punctuation,
+    PARSERS,
+    batch_convert,
+    convert_document,
+    copy_zip_member,
+    load_converter,
     list_all_epub_in_dir,
+    measure_document,
     make_epub_files_dict,
 )
+from epubhv.memory import MemoryBudgetExceeded
+from epubhv.opencc_engine import compile_config
+from epubhv.opf import Package
+from epubhv.server import ConversionServer, ConversionService
+from epubhv.stats import Stats, count, measure
+from epubhv.stylesheet import (
+    add_vertical,
+    cssutils_add_vertical,
+    cssutils_remove_writing_mode,
+    parse_cssutils,
+    remove_writing_mode,
+    to_vertical,
+)
+from epubhv.workers import can_fork, preloaded_executor
+from epubhv.yomituki import (
+    RubySoup,
+    YomiCache,
+    hantei_chinese,
+    hantei_chinese_text,
+    load_yomi_cache,
+    string_containers,
+    yomituki,
+)
 
 TEST_DIR = Path(__file__).with_name("test_epub")
 
@@ -32,25 +82,27 @@ def test_find_epub_books() -> None:
 
 def test_extract_epub_path(epub: EPUBHV) -> None:
     epub.extract_one_epub_to_dir()
-    assert Path(".epub_temp_dir/animal_farm").exists()
-    rmtree(".epub_temp_dir/animal_farm")
+    assert epub.book_path.exists()
+    assert epub.book_path.parent == Path(".epub_temp_dir")
+    assert epub.book_path.name.startswith("animal_farm-")
+    epub.cleanup()
+    assert not epub.book_path.exists()
 
 
 def test_make_files_dict(epub: EPUBHV) -> None:
     epub.extract_one_epub_to_dir()
-    d: Dict[str, List[Path]] = dict(
-        make_epub_files_dict(dir_path=Path(".epub_temp_dir/animal_farm"))
-    )
+    d: Dict[str, List[Path]] = dict(make_epub_files_dict(dir_path=epub.book_path))
     assert sorted(
         [".html", ".css", ".xhtml", "", ".opf", ".ncx", ".jpg", ".xml"]
     ) == sorted(list(d.keys()))
     assert 19 == len(d.get(".html", []))
-    rmtree(".epub_temp_dir/animal_farm")
+    epub.cleanup()
 
 
 def test_change_epub_to_vertical(epub: EPUBHV, tmp_path: Path) -> None:
     epub.run(dest=tmp_path)
-    assert epub.opf_file == Path(".epub_temp_dir/animal_farm/content.opf")
+    assert epub.opf_file == epub.book_path / "content.opf"
+    assert not epub.book_path.exists()
     assert tmp_path.joinpath("animal_farm-v-original.epub").exists()
 
 
@@ -153,3 +205,854 @@ def test_punctuation():
         res
         == """『我最赞成罗素先生的一句话：「须知参差多态，乃是幸福的本源。」大多数的参差多态都是敏于思索的人创造出来的。』"""
     )
+
+
+@pytest.mark.parametrize(
+    "book, convert_to, method",
+    [
+        ("animal_farm.epub", None, "to_vertical"),
+        ("sanguo.epub", "s2t", "to_vertical"),
+        ("books/lemo.epub", None, "to_horizontal"),
+    ],
+)
+def test_streaming_same_as_extract(
+    book: str, convert_to: Optional[str], method: str, tmp_path: Path
+) -> None:
+    extract_dest = tmp_path / "extract"
+    streaming_dest = tmp_path / "streaming"
+    extract_dest.mkdir()
+    streaming_dest.mkdir()
+    extract_output = EPUBHV(TEST_DIR / book, convert_to).run(method, extract_dest)
+    streaming_output = EPUBHV(TEST_DIR / book, convert_to, streaming=True).run(
+        method, streaming_dest
+    )
+    assert extract_output.name == streaming_output.name
+
+    with zipfile.ZipFile(TEST_DIR / book) as source, zipfile.ZipFile(
+        extract_output
+    ) as extracted, zipfile.ZipFile(streaming_output) as streamed:
+        assert streamed.testzip() is None
+        extracted_names = {i.filename for i in extracted.infolist() if not i.is_dir()}
+        streamed_names = {i.filename for i in streamed.infolist() if not i.is_dir()}
+        assert extracted_names == streamed_names
+        source_infos = {i.filename: i for i in source.infolist()}
+        for info in streamed.infolist():
+            if info.is_dir():
+                continue
+            assert streamed.read(info) == extracted.read(info.filename)
+            source_info = source_infos.get(info.filename)
+            if source_info is not None and source.read(source_info) == streamed.read(
+                info
+            ):
+                # untouched members are copied without recompressing
+                assert source_info.compress_size == info.compress_size
+                assert source_info.CRC == info.CRC
+
+
+@pytest.mark.parametrize("raw", [True, False])
+def test_copy_zip_member(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, raw: bool
+) -> None:
+    monkeypatch.setattr(epubhv_module, "RAW_ZIP_COPY", raw)
+    members = {
+        "mimetype": (b"application/epub+zip", zipfile.ZIP_STORED),
+        "OEBPS/text.html": (
+            "<p>滚滚长江东逝水</p>".encode() * 100,
+            zipfile.ZIP_DEFLATED,
+        ),
+    }
+    with zipfile.ZipFile(tmp_path / "source.epub", "w") as f:
+        for name, (data, compress_type) in members.items():
+            f.writestr(name, data, compress_type=compress_type)
+    with zipfile.ZipFile(tmp_path / "source.epub") as source, zipfile.ZipFile(
+        tmp_path / "target.epub", "w"
+    ) as target:
+        for info in source.infolist():
+            copy_zip_member(source, info, target)
+    with zipfile.ZipFile(tmp_path / "target.epub") as f:
+        assert f.testzip() is None
+        assert f.namelist() == list(members)
+        for name, (data, compress_type) in members.items():
+            assert f.read(name) == data
+            assert f.getinfo(name).compress_type == compress_type
+
+
+def test_run_batch_keeps_order_and_failures(tmp_path: Path) -> None:
+    bad_epub = tmp_path / "bad.epub"
+    bad_epub.write_bytes(b"not a zip file")
+    epubs = [TEST_DIR / "animal_farm.epub", bad_epub, TEST_DIR / "sanguo.epub"]
+    results = run_batch(epubs, method="to_vertical", dest=tmp_path, jobs=2)
+    assert [r.epub for r in results] == epubs
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[0].output == tmp_path / "animal_farm-v-original.epub"
+    assert results[0].output.exists()
+    assert results[1].output is None and results[1].error
+
+
+def convert_or_exit(epub: Path, *args: Any) -> BatchResult:
+    if epub.name == "crash.epub":
+        # like a worker killed by the OOM killer
+        os._exit(1)
+    return convert_one_epub(epub, *args)
+
+
+@pytest.mark.skipif(not can_fork(), reason="the patched worker needs fork")
+def test_run_batch_survives_a_dead_worker(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(batch, "convert_one_epub", convert_or_exit)
+    crash = tmp_path / "crash.epub"
+    shutil.copyfile(TEST_DIR / "animal_farm.epub", crash)
+    epubs = [
+        TEST_DIR / "animal_farm.epub",
+        crash,
+        TEST_DIR / "sanguo.epub",
+        TEST_DIR / "books" / "lemo.epub",
+    ]
+    results = run_batch(epubs, dest=tmp_path, jobs=2)
+    assert [r.epub for r in results] == epubs
+    assert [r.ok for r in results] == [True, False, True, True]
+
+
+def test_document_workers_same_as_serial(tmp_path: Path) -> None:
+    serial_dest = tmp_path / "serial"
+    parallel_dest = tmp_path / "parallel"
+    serial_dest.mkdir()
+    parallel_dest.mkdir()
+    serial_output = EPUBHV(TEST_DIR / "sanguo.epub", "s2t", streaming=True).run(
+        dest=serial_dest
+    )
+    parallel_output = EPUBHV(
+        TEST_DIR / "sanguo.epub",
+        "s2t",
+        streaming=True,
+        document_workers=2,
+        document_chunksize=8,
+    ).run(dest=parallel_dest)
+    with zipfile.ZipFile(serial_output) as serial, zipfile.ZipFile(
+        parallel_output
+    ) as parallel:
+        assert serial.namelist() == parallel.namelist()
+        for name in serial.namelist():
+            assert serial.read(name) == parallel.read(name)
+
+
+@pytest.mark.parametrize("document_workers", [1, 2])
+def test_memory_budget_same_output(tmp_path: Path, document_workers: int) -> None:
+    dest = tmp_path / "dest"
+    bounded_dest = tmp_path / "bounded"
+    dest.mkdir()
+    bounded_dest.mkdir()
+    output = EPUBHV(TEST_DIR / "sanguo.epub", "s2t", streaming=True).run(dest=dest)
+    bounded = EPUBHV(
+        TEST_DIR / "sanguo.epub",
+        "s2t",
+        streaming=True,
+        document_workers=document_workers,
+        temp_dir=tmp_path / "temp",
+        memory_budget=1 << 40,
+        max_documents_in_flight=1,
+    )
+    bounded_output = bounded.run(dest=bounded_dest)
+    # the rewritten members were kept on disk and are removed
+    assert bounded.workspace is None and not list((tmp_path / "temp").iterdir())
+    with zipfile.ZipFile(output) as f, zipfile.ZipFile(bounded_output) as g:
+        assert f.namelist() == g.namelist()
+        for name in f.namelist():
+            assert f.read(name) == g.read(name)
+
+
+def test_memory_budget_exceeded(tmp_path: Path) -> None:
+    f = EPUBHV(
+        TEST_DIR / "animal_farm.epub",
+        "s2t",
+        document_workers=2,
+        temp_dir=tmp_path / "temp",
+        memory_budget=1 << 20,
+    )
+    with pytest.raises(MemoryBudgetExceeded):
+        f.run(dest=tmp_path)
+    assert not list((tmp_path / "temp").iterdir())
+    assert not (tmp_path / f.output_name()).exists()
+
+
+def test_convert_document_keeps_conversion_with_ruby() -> None:
+    content = (
+        "<html><head></head><body><p>滚滚长江东逝水</p><!-- 长江 --></body></html>"
+    )
+    res = convert_document(
+        content,
+        DocumentOptions(
+            stylesheet_line=V_STYLE_LINE, convert_to="s2t", ruby_language="zh"
+        ),
+    )
+    assert "<ruby>" in res
+    assert "滚" not in res and "滾" in res
+    assert "<!-- 長江 -->" in res
+    assert res.count('href="../Style/style.css"') == 1
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>三国</title></head>'
+        "<body><p>滚滚<em>长江</em>东逝水<!-- 长江 --></p><style>p{}</style></body></html>",
+        # not well-formed, falls back to html.parser
+        "<html><head></head><body><p>滚滚长江<br>东逝水</p></body></html>",
+    ],
+)
+def test_lxml_parser_same_as_html_parser(content: str) -> None:
+    options = DocumentOptions(
+        stylesheet_line=V_STYLE_LINE,
+        convert_to="s2t",
+        punctuation="s2t",
+        ruby_language="zh",
+    )
+    soup = bs(convert_document(content, options), "html.parser")
+    lxml_soup = bs(
+        convert_document(content, options._replace(parser="lxml")), "html.parser"
+    )
+    assert soup.body and lxml_soup.body
+    assert soup.body.get_text() == lxml_soup.body.get_text()
+    assert len(soup.find_all("ruby")) == len(lxml_soup.find_all("ruby")) > 0
+    assert len(lxml_soup.find_all("link")) == 1
+    assert "滾" in lxml_soup.get_text()
+
+
+def test_run_with_lxml_parser(tmp_path: Path) -> None:
+    f = EPUBHV(TEST_DIR / "books/lemo.epub", need_ruby=True, parser="lxml")
+    output = f.run("to_vertical", dest=tmp_path)
+    with zipfile.ZipFile(output) as z:
+        assert any(b"<ruby>" in z.read(n) for n in z.namelist() if n.endswith("html"))
+
+
+def test_detect_by_script() -> None:
+    assert (
+        detect_by_script(
+            "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。"
+        )
+        == "ja"
+    )
+    assert (
+        detect_by_script("我们这个国家的人说话的时候，对别人会很客气，这是我们的习惯。")
+        == "zh-cn"
+    )
+    assert (
+        detect_by_script("我們這個國家的人說話的時候，對別人會很客氣，這是我們的習慣。")
+        == "zh-tw"
+    )
+    assert detect_by_script("Animal Farm is a beast fable by George Orwell.") is None
+
+
+def test_pick_samples_and_early_stop() -> None:
+    assert pick_samples(list(range(100)), 4) == [12, 37, 62, 87]
+    assert pick_samples([1, 2], 4) == [1, 2]
+    read: List[str] = []
+
+    def contents():
+        for i in range(10):
+            read.append(str(i))
+            yield "<html><body><p>吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。</p></body></html>"
+
+    c = LanguageDetector(samples=10).detect(contents())
+    assert c.most_common()[0] == ("ja", 6)
+    assert len(read) == 6
+
+
+def test_yomi_cache(tmp_path: Path) -> None:
+    db = tmp_path / "yomi.sqlite"
+    cache = YomiCache(maxsize=2, path=db)
+    ruby = RubySoup("ja", True, cache)
+    first = list(ruby.ruby_string("吾輩は猫である"))
+    assert first == list(RubySoup("ja", True).ruby_string("吾輩は猫である"))
+    assert list(ruby.ruby_string("吾輩は猫である")) == first
+    assert cache.info()["hits"] == 1 and cache.info()["misses"] == 1
+    cache.close()
+
+    # the readings survive in the sqlite file
+    cache = YomiCache(path=db)
+    assert list(RubySoup("ja", True, cache).ruby_string("吾輩は猫である")) == first
+    assert cache.info()["disk_hits"] == 1 and cache.info()["misses"] == 0
+    cache.close()
+
+
+def yomi_in_worker(path: str) -> bool:
+    cache = load_yomi_cache(path)
+    inherited = cache.db
+    cache.yomituki("我輩は犬である", "ja")
+    cache.flush()
+    return cache.db is not inherited
+
+
+@pytest.mark.skipif(not can_fork(), reason="the worker must inherit the cache")
+def test_yomi_cache_after_fork(tmp_path: Path) -> None:
+    db = str(tmp_path / "yomi.sqlite")
+    cache = load_yomi_cache(db)
+    cache.yomituki("吾輩は猫である", "ja")
+    cache.flush()
+    with preloaded_executor(1) as executor:
+        assert executor.submit(yomi_in_worker, db).result()
+    # the connection of this process still works
+    cache.yomituki("吾輩は鳥である", "ja")
+    cache.close()
+    cache = YomiCache(path=db)
+    for text in ("吾輩は猫である", "我輩は犬である", "吾輩は鳥である"):
+        cache.yomituki(text, "ja")
+    assert cache.info()["disk_hits"] == 3
+    cache.close()
+
+
+def test_ruby_traditional_chinese(tmp_path: Path) -> None:
+    assert (
+        "".join(
+            p if isinstance(p, str) else p[0] for p in yomituki("長江東逝水", "zh-tw")
+        )
+        == "長江東逝水"
+    )
+    # detected as zh-tw, warmed up for the worker processes
+    f = EPUBHV(TEST_DIR / "books" / "animal.epub", need_ruby=True, document_workers=2)
+    output = f.run(dest=tmp_path)
+    assert f.ruby_language == "zh"
+    with zipfile.ZipFile(output) as book:
+        assert any(
+            b"<ruby>" in book.read(name)
+            for name in book.namelist()
+            if name.endswith("html")
+        )
+
+
+def test_traditional_chinese_ruby_is_pinyin() -> None:
+    text = "這個時候，他們說還沒見過長江東邊的國門，馬車經過書院時，學生問這樣對不對。"
+    assert detect_by_script(text) == "zh-tw"
+    assert list(yomituki(text, "zh-tw")) == list(yomituki(text, "zh"))
+
+
+def test_hantei_chinese_text_same_as_hantei_chinese() -> None:
+    sentence = "滚滚长江东逝水，浪花淘尽英雄。是非成败转头空，Hello 2023！"
+    assert hantei_chinese_text(sentence) == [
+        hantei_chinese(word) for word in jieba.cut(sentence)
+    ]
+
+
+@pytest.mark.parametrize("language", ["ja", "zh", "cantonese"])
+def test_ruby_emit_string_same_as_tags(language: str) -> None:
+    content = (
+        "<html><body><p>吾輩は猫である &amp; <em>名前</em>はまだ無い</p>"
+        "<p>滚滚长江东逝水 &lt;浪花&gt;</p><style>p{}</style></body></html>"
+    )
+    tags_soup = bs(content, "html.parser", string_containers=string_containers)
+    RubySoup(language, True, emit="tags").ruby_soup(tags_soup.body)
+    string_soup = bs(content, "html.parser", string_containers=string_containers)
+    RubySoup(language, True, emit="string").ruby_soup(string_soup.body)
+    assert str(string_soup) == str(tags_soup)
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+def test_ruby_block_scope_same_as_text(parser: str) -> None:
+    content = (
+        "<html><head></head><body><p>吾輩は<em>猫</em>である。名前は<b>ま</b>だ無い。"
+        "</p><p>東京<br/>大阪 京都<!-- 名前 --><span>名前</span></p></body></html>"
+    )
+    text, text_m = measure_document(
+        content, DocumentOptions(ruby_language="ja", parser=parser)
+    )
+    block, block_m = measure_document(
+        content, DocumentOptions(ruby_language="ja", parser=parser, ruby_scope="block")
+    )
+    assert block == text
+    assert block_m.counters["segmentations"] < text_m.counters["segmentations"]
+
+
+def test_ruby_block_maps_tokens_back() -> None:
+    ruby = RubySoup("zh", True)
+    strings = ["滚滚长", "江东", "", "逝水 浪花", "  "]
+    pieces = ruby.ruby_block(strings)
+    assert pieces is not None and len(pieces) == len(strings)
+    for string, string_pieces in zip(strings, pieces):
+        # whitespace is dropped, same as `ruby_string`
+        assert "".join(
+            p if isinstance(p, str) else "".join(t for t, _ in p) for p in string_pieces
+        ) == "".join(string.split())
+    # 长江 is across two strings, each part is segmented on its own
+    assert pieces[0][-1][-1] == ruby.segment("长")[0]
+    assert pieces[1][0][0] == ruby.segment("江")[0]
+    assert pieces[3][-1] == list(ruby.ruby_string("浪花"))[-1]
+
+
+@pytest.mark.parametrize("horizontal", [True, False])
+@pytest.mark.parametrize("source", ["hans", "hant"])
+@pytest.mark.parametrize("target", ["hans", "hant"])
+def test_punctuation_table_same_as_replacement_chain(
+    horizontal: bool, source: str, target: str
+) -> None:
+    punctuation = Punctuation()
+    text = "﹁﹂﹃﹄‘’“”「」『』，。abc"
+    expected = text
+    for replacement_dict in punctuation.replacement_chain(horizontal, source, target):
+        expected = punctuation.batch_replace(expected, replacement_dict)
+    assert punctuation.convert(text, horizontal, source, target) == expected
+
+
+@pytest.mark.parametrize("convert_to", ["s2t", "t2s", "s2twp"])
+def test_batch_convert_same_as_per_string(convert_to: str) -> None:
+    converter = load_converter(convert_to)
+    texts = ["头发", "", "\n  ", "后面\n", "\n里面 ", "计算机软件", "鼠标"]
+    expected = [converter.convert(text) for text in texts]  # type: ignore
+    assert batch_convert(converter, texts) == expected
+    # the sentinel in the text falls back to one call per string
+    texts.append("a\x00b")
+    expected.append("a\x00b")
+    assert batch_convert(converter, texts) == expected
+
+
+@pytest.mark.parametrize(
+    "convert_to",
+    ["s2t", "s2tw", "s2twp", "s2hk", "t2s", "t2tw", "t2hk", "tw2s", "tw2sp", "hk2s"],
+)
+def test_compiled_opencc_same_as_opencc(convert_to: str, tmp_path: Path) -> None:
+    texts = [
+        "头发发展，计算机软件和鼠标。",
+        "頭髮發展，計算機軟件和鼠標。",
+        "电脑程式设计的资讯网路",
+        "電腦程式設計的資訊網路",
+        "乾隆皇帝的干支，后来的皇后",
+        "",
+    ]
+    reference = opencc.OpenCC(convert_to)
+    compiled = compile_config(convert_to, tmp_path)
+    # the second time it is loaded from the cache dir
+    assert len(list(tmp_path.glob(f"{convert_to}-*.pickle"))) == 1
+    cached = compile_config(convert_to, tmp_path)
+    for text in texts:
+        expected = reference.convert(text)  # type: ignore
+        assert compiled.convert(text) == expected
+        assert cached.convert(text) == expected
+
+
+def test_language_backends_are_lazy() -> None:
+    code = (
+        "import sys, epubhv.epubhv; "
+        "assert not {'fugashi', 'jieba', 'pypinyin', 'ToJyutping', 'langdetect',"
+        " 'cssutils'}"
+        " & set(sys.modules); "
+        "epubhv.epubhv.warmup(['ja'], detect=False); "
+        "assert 'fugashi' in sys.modules and 'jieba' not in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+@pytest.mark.parametrize("language", ["ja", "zh-hans", "zh-hant"])
+def test_benchmarks_smoke(tmp_path: Path, language: str) -> None:
+    output = tmp_path / "results.json"
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks", "--language", language]
+        + ["--chapters", "1", "--chapter-chars", "200", "--assets", "0"]
+        + ["--repeat", "1", "--output", str(output)],
+        cwd=TEST_DIR.parent.parent,
+        check=True,
+    )
+    modes = json.loads(output.read_text())["modes"]
+    assert ("convert" in modes) == (language != "ja")
+    assert all(mode["wall"] > 0 for mode in modes.values())
+
+
+def test_conversion_server(tmp_path: Path) -> None:
+    service = ConversionService(
+        tmp_path, workers=1, max_queue=0, warmup_languages=(), warmup_detect=False
+    )
+    server = ConversionServer(("127.0.0.1", 0), service, quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    data = Path("tests/test_epub/animal_farm.epub").read_bytes()
+
+    def request(path: str, method: str = "GET", body: Optional[bytes] = None):
+        req = urllib.request.Request(url + path, data=body, method=method)
+        try:
+            with urllib.request.urlopen(req) as r:
+                return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    try:
+        status, body = request("/jobs?name=animal_farm.epub", "POST", data)
+        assert status == 202
+        job_id = json.loads(body)["id"]
+        # one worker and no queue, the second upload is refused
+        status, _ = request("/jobs?name=animal_farm.epub", "POST", data)
+        assert status == 503
+        status, _ = request("/jobs?name=animal_farm.txt", "POST", data)
+        assert status == 400
+        for length in ("abc", "-1"):
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+            conn.putrequest("POST", "/jobs?name=animal_farm.epub")
+            conn.putheader("Content-Length", length)
+            conn.endheaders()
+            assert conn.getresponse().status == 400
+            conn.close()
+        assert service.jobs[job_id].wait(60)
+        status, body = request(f"/jobs/{job_id}")
+        assert json.loads(body)["status"] == "done"
+        status, body = request(f"/jobs/{job_id}/result")
+        assert status == 200
+        assert zipfile.ZipFile(io.BytesIO(body)).testzip() is None
+        status, _ = request(f"/jobs/{job_id}", "DELETE")
+        assert status == 200
+        assert not (tmp_path / job_id).exists()
+        status, _ = request(f"/jobs/{job_id}")
+        assert status == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def test_conversion_server_non_ascii_name(tmp_path: Path) -> None:
+    service = ConversionService(
+        tmp_path, workers=1, warmup_languages=(), warmup_detect=False
+    )
+    server = ConversionServer(("127.0.0.1", 0), service, quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    name = urllib.parse.quote('动物农场"\r\nX-Injected: 1.epub')
+    try:
+        req = urllib.request.Request(
+            f"{url}/jobs?name={name}",
+            data=(TEST_DIR / "animal_farm.epub").read_bytes(),
+            method="POST",
+        )
+        with urllib.request.urlopen(req) as r:
+            job_id = json.loads(r.read())["id"]
+        assert service.jobs[job_id].wait(60)
+        with urllib.request.urlopen(f"{url}/jobs/{job_id}/result") as r:
+            assert r.status == 200
+            assert r.headers["X-Injected"] is None
+            disposition = r.headers["Content-Disposition"]
+            assert zipfile.ZipFile(io.BytesIO(r.read())).testzip() is None
+        assert 'filename="____X-Injected: 1-v-original.epub"' in disposition
+        assert (
+            "filename*=UTF-8''"
+            + urllib.parse.quote("动物农场X-Injected: 1-v-original.epub", safe="")
+            in disposition
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+@pytest.mark.skipif(not can_fork(), reason="the patched worker needs fork")
+def test_conversion_service_survives_a_dead_worker(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("epubhv.server.convert_one_epub", convert_or_exit)
+    service = ConversionService(
+        tmp_path, workers=2, warmup_languages=(), warmup_detect=False
+    )
+    try:
+        jobs = []
+        for name in ("crash.epub", "animal_farm.epub", "sanguo.epub"):
+            epub = TEST_DIR / ("animal_farm.epub" if name == "crash.epub" else name)
+            with open(epub, "rb") as f:
+                jobs.append(service.submit(name, f, epub.stat().st_size))
+        assert all(job.wait(120) for job in jobs)
+        assert [job.status for job in jobs] == ["failed", "done", "done"]
+    finally:
+        service.close()
+
+
+def test_workspaces_are_isolated(tmp_path: Path) -> None:
+    a = EPUBHV(TEST_DIR / "animal_farm.epub", temp_dir=tmp_path / "work")
+    b = EPUBHV(TEST_DIR / "animal_farm.epub", temp_dir=tmp_path / "work")
+    a.extract_one_epub_to_dir()
+    b.extract_one_epub_to_dir()
+    assert a.book_path != b.book_path
+    a.cleanup()
+    assert b.book_path.joinpath("content.opf").exists()
+    b.cleanup()
+    assert list((tmp_path / "work").iterdir()) == []
+
+
+def test_workspace_removed_on_failure(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def fail(method: str = "to_vertical") -> None:
+        raise RuntimeError("boom")
+
+    f = EPUBHV(TEST_DIR / "animal_farm.epub", temp_dir=tmp_path / "work")
+    monkeypatch.setattr(f, "convert", fail)
+    with pytest.raises(RuntimeError):
+        f.run(dest=tmp_path)
+    assert list((tmp_path / "work").iterdir()) == []
+
+
+def test_result_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = ResultCache(tmp_path / "cache")
+    first = EPUBHV(TEST_DIR / "animal_farm.epub", "s2t", result_cache=cache)
+    output = first.run(dest=tmp_path / "a")
+    expected = output.read_bytes()
+
+    def fail() -> None:
+        raise RuntimeError("should come from the cache")
+
+    second = EPUBHV(TEST_DIR / "animal_farm.epub", "s2t", result_cache=cache)
+    monkeypatch.setattr(second, "make_epub_values", fail)
+    cached = second.run(dest=tmp_path / "b")
+    assert cached.name == output.name
+    assert cached.read_bytes() == expected
+    # other options are another key
+    third = EPUBHV(TEST_DIR / "animal_farm.epub", "t2s", result_cache=cache)
+    monkeypatch.setattr(third, "make_epub_values", fail)
+    with pytest.raises(RuntimeError):
+        third.run(dest=tmp_path / "b")
+
+
+def test_result_cache_keeps_the_output_name(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = ResultCache(tmp_path / "cache")
+    # no ruby language is detected in this book, so ruby is not in the name
+    output = EPUBHV(
+        TEST_DIR / "animal_farm.epub", need_ruby=True, result_cache=cache
+    ).run(dest=tmp_path / "a")
+    second = EPUBHV(TEST_DIR / "animal_farm.epub", need_ruby=True, result_cache=cache)
+    monkeypatch.setattr(second, "make_epub_values", lambda: 1 / 0)
+    cached = second.run(dest=tmp_path / "b")
+    assert cached.name == output.name and cached.exists()
+    # the detector settings are in the key
+    third = EPUBHV(
+        TEST_DIR / "animal_farm.epub",
+        need_ruby=True,
+        result_cache=cache,
+        language_detector=LanguageDetector(samples=1),
+    )
+    assert cache.key(third.epub_file, "to_vertical", third.cache_options()) != (
+        cache.key(second.epub_file, "to_vertical", second.cache_options())
+    )
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path: Path) -> None:
+    output = tmp_path / "book.epub"
+    output.write_bytes(b"x" * 100)
+    cache = ResultCache(tmp_path / "cache", max_bytes=250)
+    for key, mtime in (("aa1", 1), ("bb2", 3), ("cc3", 2)):
+        cache.put(key, output)
+        os.utime(cache.entry(key), (mtime, mtime))
+    cache.put("dd4", output)
+    assert not cache.entry("aa1").exists()
+    assert not cache.entry("cc3").exists()
+    assert cache.get("bb2", tmp_path / "out.epub")
+    assert cache.get("dd4", tmp_path / "out.epub")
+
+
+def test_document_cache_only_converts_changed_documents(tmp_path: Path) -> None:
+    # a new edition with one chapter changed
+    edition = tmp_path / "edition" / "animal_farm.epub"
+    edition.parent.mkdir()
+    with zipfile.ZipFile(TEST_DIR / "animal_farm.epub") as source, zipfile.ZipFile(
+        edition, "w"
+    ) as target:
+        changed = [n for n in source.namelist() if n.endswith(".html")][3]
+        for info in source.infolist():
+            data = source.read(info)
+            if info.filename == changed:
+                data = data.replace(b"</body>", "<p>勘误</p></body>".encode())
+            target.writestr(info, data)
+
+    cache = DocumentCache(tmp_path / "cache")
+    first = EPUBHV(TEST_DIR / "animal_farm.epub", "s2t", document_cache=cache)
+    first.run(dest=tmp_path / "first")
+    assert first.documents_reused == 0
+    total = first.documents_recomputed
+
+    second = EPUBHV(edition, "s2t", document_cache=cache)
+    output = second.run(dest=tmp_path / "second")
+    assert (second.documents_reused, second.documents_recomputed) == (total - 1, 1)
+
+    expected = EPUBHV(edition, "s2t").run(dest=tmp_path / "expected")
+    with zipfile.ZipFile(output) as a, zipfile.ZipFile(expected) as b:
+        assert sorted(a.namelist()) == sorted(b.namelist())
+        for name in a.namelist():
+            assert a.read(name) == b.read(name), name
+
+
+def test_unchanged_files_are_kept_as_is(tmp_path: Path) -> None:
+    # horizontal without any conversion only changes the opf
+    source = TEST_DIR / "animal_farm.epub"
+    f = EPUBHV(source)
+    output = f.run("to_horizontal", dest=tmp_path)
+    assert f.documents_changed == 0
+    with zipfile.ZipFile(source) as a, zipfile.ZipFile(output) as b:
+        for name in a.namelist():
+            if not name.endswith(".opf"):
+                assert a.read(name) == b.read(name), name
+
+
+def style_rules(css: bytes) -> List[tuple]:
+    sheet = parse_cssutils(css)
+    return [
+        (r.selectorText, sorted((k, r.style[k]) for k in r.style.keys()))
+        for r in sheet.cssRules.rulesOfType(1)
+        if r.style.keys()
+    ]
+
+
+@pytest.mark.parametrize(
+    "css",
+    [
+        "",
+        "html{}",
+        "html {\n  color: red\n}\np { writing-mode: x }",
+        "/* c */ html { WRITING-MODE: x; -epub-writing-mode: y; }",
+        "html/* c */{ color: red }",
+        "@media print { html { writing-mode: x } }\nhtml, body { writing-mode: x }",
+        "a[title='}{;'] { writing-mode: x; background: url(data:a;b) }",
+        "html { writing-mode: x !important; writing-mode: y; /* writing-mode: z; */ }",
+    ],
+)
+def test_stylesheet_rewrite_same_as_cssutils(css: str) -> None:
+    for fast, slow in (
+        (add_vertical, cssutils_add_vertical),
+        (remove_writing_mode, cssutils_remove_writing_mode),
+    ):
+        new_css = fast(css)
+        expected = slow(css.encode())
+        assert (new_css is None) == (expected is None)
+        if new_css is not None:
+            assert style_rules(new_css.encode()) == style_rules(expected)
+
+
+def test_stylesheet_rewrite_keeps_the_rest() -> None:
+    css = "p {\n  color: red;\n  writing-mode: x;\n}\n"
+    assert remove_writing_mode(css) == "p {\n  color: red;\n}\n"
+    assert add_vertical(css + "html { color: red }") == (
+        css + "html { color: red;\n  writing-mode: vertical-rl;\n"
+        "  -webkit-writing-mode: vertical-rl;\n  -epub-writing-mode: vertical-rl;\n}"
+    )
+    # falls back to cssutils for what the tokenizer does not handle
+    escaped = b"html { writing-mod\\65: x; -webkit-writing-mode: x }"
+    assert to_vertical(escaped) == cssutils_add_vertical(escaped)
+    latin = '@charset "iso-8859-1";\np { content: "\xe9" }'.encode("latin-1")
+    assert to_vertical(latin) == cssutils_add_vertical(latin)
+
+
+def test_opf_package_patch() -> None:
+    opf = (
+        "<?xml version='1.0'?>\n<opf:package xmlns:opf='http://www.idpf.org/2007/opf'>"
+        "<opf:metadata><dc:language>ja</dc:language><!-- <item id='x'/> -->"
+        "<opf:meta name='primary-writing-mode' content='horizontal-lr' />"
+        "</opf:metadata><opf:manifest>"
+        "<opf:item id='a' href='a%20b.html' media-type='application/xhtml+xml'/>"
+        '<opf:item id="c" href="s&amp;t.css" media-type="text/css"/>'
+        "</opf:manifest><opf:spine toc='ncx'><opf:itemref idref='a'/></opf:spine>"
+        "</opf:package>"
+    )
+    package = Package(opf.encode())
+    assert package.languages == ["ja"]
+    assert [i.href for i in package.items] == ["a%20b.html", "s&t.css"]
+    assert package.spine == ["a"]
+    assert package.patch("ltr", "horizontal-lr") == opf.replace(
+        "toc='ncx'", "toc='ncx' page-progression-direction=\"ltr\""
+    ).encode("utf-8")
+    new_opf = package.patch("rtl", "vertical-rl", '<item id="s" href="s.css"/>')
+    assert new_opf is not None
+    assert Package(new_opf).patch("rtl", "vertical-rl") is None
+    new_soup = bs(new_opf, "xml")
+    assert new_soup.find("meta").attrs["content"] == "vertical-rl"
+    assert new_soup.find("spine").attrs["page-progression-direction"] == "rtl"
+    assert [i.attrs["id"] for i in new_soup.find_all("item")] == ["a", "c", "s"]
+
+
+@pytest.mark.parametrize("document_workers", [1, 2])
+def test_stats(tmp_path: Path, document_workers: int) -> None:
+    stats = Stats()
+    f = EPUBHV(
+        TEST_DIR / "animal_farm.epub",
+        "s2t",
+        stats=stats,
+        document_workers=document_workers,
+    )
+    f.run(dest=tmp_path)
+    assert {"extract", "opf", "stylesheets", "documents", "pack"} <= set(stats.stages)
+    assert len(stats.documents) == len(f.content_files_list)
+    assert all(d.steps["opencc"] > 0 for d in stats.documents)
+    assert stats.counters["text_nodes"] == sum(
+        d.counters["text_nodes"] for d in stats.documents
+    )
+    assert stats.counters["documents_changed"] == f.documents_changed > 0
+    assert stats.counters["bytes_read"] > 0 and stats.counters["bytes_written"] > 0
+    assert json.loads(stats.to_json())["documents"][0]["name"].endswith("html")
+    assert json.loads(stats.to_json())["max_rss"] == stats.max_rss > 0
+
+
+def test_stats_count_outside_measure() -> None:
+    count("nothing")
+    with measure() as outer:
+        with measure() as inner:
+            count("a", 2)
+        count("b")
+    assert inner.counters == {"a": 2} and outer.counters == {"b": 1}
+    assert inner.timing.wall > 0
+
+
+def test_stats_measure_threads() -> None:
+    both_in = threading.Barrier(2)
+
+    def run(name: str) -> Dict[str, int]:
+        with measure() as m:
+            both_in.wait()
+            count(name)
+            both_in.wait()
+        return dict(m.counters)
+
+    results: Dict[str, Dict[str, int]] = {}
+    threads = [
+        threading.Thread(target=lambda name=name: results.update({name: run(name)}))
+        for name in ("a", "b")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"a": {"a": 1}, "b": {"b": 1}}
+
+
+PRELOADED: List[str] = []
+
+
+def preload_for_test() -> None:
+    PRELOADED.append("backend")
+
+
+def preloaded_state() -> Tuple[List[str], int]:
+    return list(PRELOADED), gc.get_freeze_count()
+
+
+def test_preloaded_executor() -> None:
+    before = gc.get_freeze_count()
+    with preloaded_executor(2, preload_for_test) as executor:
+        loaded, frozen = executor.submit(preloaded_state).result()
+        if can_fork():
+            # all the workers are forked at once, from the preloaded process
+            assert len(executor._processes) == 2
+    assert loaded == ["backend"]
+    if can_fork():
+        assert PRELOADED == ["backend"] and frozen > 0
+    assert gc.get_freeze_count() == before
+    PRELOADED.clear()
+
+
+def nested_freeze_counts() -> Tuple[int, int]:
+    # like a book worker of `--jobs` starting its own `--doc-jobs` pool
+    before: int = gc.get_freeze_count()
+    with preloaded_executor(1) as executor:
+        executor.submit(os.getpid).result()
+    return before, gc.get_freeze_count()
+
+
+@pytest.mark.skipif(not can_fork(), reason="the heap is only frozen with fork")
+def test_preloaded_executor_nested() -> None:
+    with preloaded_executor(1) as executor:
+        before, after = executor.submit(nested_freeze_counts).result()
+    # still frozen, the count drops when frozen objects are freed
+    assert before > 0 and after > 0
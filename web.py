@@ -1,11 +1,11 @@
-import base64
 import tempfile
 from pathlib import Path
 
 import streamlit as st
-import streamlit.components.v1 as components
 
-from epubhv import EPUBHV
+from epubhv.cache import ResultCache
+from epubhv.opencc_engine import available_conversions
+from epubhv.server import ConversionService, QueueFull
 
 LABELS = {
     "none": "None",
@@ -27,23 +27,16 @@ LABELS = {
 }
 
 
-def download_button(data: bytes, download_filename: str) -> None:
-    b64 = base64.b64encode(data).decode()
-
-    dl_link = f"""
-    <html>
-    <head>
-    <title>Start Auto Download file</title>
-    <script>
-        const a = document.createElement('a')
-        a.setAttribute('href', "data:text/csv;base64,{b64}")
-        a.setAttribute('download', "{download_filename}")
-        a.click()
-    </script>
-    </head>
-    </html>
-    """
-    components.html(dl_link, height=0)
+@st.cache_resource
+def load_service() -> ConversionService:
+    # streamlit runs the script again for every interaction, the pool of
+    # warmed up workers is made once for the whole server
+    return ConversionService(
+        Path(tempfile.mkdtemp(prefix="epubhv-web-")),
+        warmup_conversions=available_conversions(),
+        # the same upload with the same options is served from the cache
+        result_cache=ResultCache(Path(tempfile.gettempdir()) / "epubhv-web-cache"),
+    )
 
 
 st.set_page_config(
@@ -57,6 +50,7 @@ st.header("📖 EPUBHV, a toolset to convert your EPUB", divider="rainbow")
 st.caption(
     "Author: [@yihong0618](https://github.com/yihong0618) | [GitHub](https://github.com/yihong0618/epubhv) | [PyPI](https://pypi.org/project/epubhv/)",
 )
+load_service()
 
 
 def run():
@@ -64,19 +58,39 @@ def run():
         st.error("Please upload an epub file")
         return
     epubfile = st.session_state["epubfile"]
-    with tempfile.TemporaryDirectory() as tmpdir, st.spinner("Processing..."):
-        with open(Path(tmpdir) / epubfile.name, "wb") as f:
-            f.write(epubfile.read())
-        convert = st.session_state["convert"]
-        epubhv = EPUBHV(
-            file_path=Path(tmpdir) / epubfile.name,
-            need_ruby=st.session_state["need_ruby"],
-            need_cantonese=st.session_state["need_cantonese"],
-            convert_to=None if convert == "none" else convert,
-            convert_punctuation=st.session_state["punctuation"],
+    convert = st.session_state["convert"]
+    service = load_service()
+    try:
+        job = service.submit(
+            epubfile.name,
+            epubfile,
+            epubfile.size,
+            method=st.session_state["method"],
+            options=dict(
+                need_ruby=st.session_state["need_ruby"],
+                need_cantonese=st.session_state["need_cantonese"],
+                convert_to=None if convert == "none" else convert,
+                convert_punctuation=st.session_state["punctuation"],
+                streaming=True,
+            ),
+        )
+    except QueueFull:
+        st.error("Too many books are being converted, please try again later")
+        return
+    with st.spinner("Processing..."):
+        job.wait()
+    result = job.result
+    if result is None or result.output is None:
+        st.error(f"Failed: {result.error if result else 'cancelled'}")
+    else:
+        st.download_button(
+            "Download",
+            data=result.output.read_bytes(),
+            file_name=result.output.name,
+            mime="application/epub+zip",
         )
-        result = epubhv.run(method=st.session_state["method"], dest=Path(tmpdir))
-        download_button(result.read_bytes(), result.name)
+    with service.lock:
+        service.remove(job.id)
 
 
 with st.form(key="my_form"):